@@ -0,0 +1,252 @@
+#
+# Astrometry routines used by PAEngine.py and TSXSim.py, so that the
+# coordinate maths needed for each image can be done here rather than by
+# asking TSX over the network:
+#    sidereal time from the site longitude and the system clock,
+#    precession and nutation between J2000 and the date,
+#    conversion between HA/Dec and Alt/Az,
+#    reading the HA and LST from the header of a FITS image.
+#
+# Precession is IAU 1976 and nutation the larger terms of the IAU 1980
+# series, following Meeus, Astronomical Algorithms. Together they are good
+# to a few hundredths of an arcsec over this century.
+#
+# Angles are degrees, and HA, RA and sidereal time are hours. Longitudes
+# are positive to the west, as in TSX.
+
+import math
+import time
+
+def sind(ang):
+    return math.sin(math.radians(ang))
+
+def cosd(ang):
+    return math.cos(math.radians(ang))
+
+######################### VECTORS ######################################
+
+def MatVec(m, v):
+    return [m[0][0]*v[0] + m[0][1]*v[1] + m[0][2]*v[2],
+            m[1][0]*v[0] + m[1][1]*v[1] + m[1][2]*v[2],
+            m[2][0]*v[0] + m[2][1]*v[1] + m[2][2]*v[2]]
+
+def MatMul(a, b):
+    return [[sum(a[i][k]*b[k][j] for k in range(3)) for j in range(3)]
+            for i in range(3)]
+
+def Transpose(m):
+    return [[m[j][i] for j in range(3)] for i in range(3)]
+
+# Rotation matrices about the x, y and z axes, angles in degrees
+def RotX(ang):
+    c, s = cosd(ang), sind(ang)
+    return [[1, 0, 0], [0, c, -s], [0, s, c]]
+
+def RotY(ang):
+    c, s = cosd(ang), sind(ang)
+    return [[c, 0, s], [0, 1, 0], [-s, 0, c]]
+
+def RotZ(ang):
+    c, s = cosd(ang), sind(ang)
+    return [[c, -s, 0], [s, c, 0], [0, 0, 1]]
+
+def RADecToVec(ra, dec):
+    return [cosd(dec)*cosd(ra*15.0), cosd(dec)*sind(ra*15.0), sind(dec)]
+
+def VecToRADec(v):
+    return (math.degrees(math.atan2(v[1], v[0])) / 15.0) % 24.0, \
+        math.degrees(math.asin(max(-1.0, min(1.0, v[2]))))
+
+######################### TIME #########################################
+
+# Julian date of a time in seconds since 1970, by default now
+def JulianDate(t=None):
+    if t is None:
+        t = time.time()
+    return t / 86400.0 + 2440587.5
+
+# Julian centuries since J2000
+def Centuries(t):
+    return (JulianDate(t) - 2451545.0) / 36525.0
+
+# Greenwich mean sidereal time in hours (IAU 1982)
+def GMST(t=None):
+    jd = JulianDate(t)
+    T = (jd - 2451545.0) / 36525.0
+    theta = 280.46061837 + 360.98564736629 * (jd - 2451545.0) + \
+        0.000387933 * T*T - T*T*T / 38710000.0
+    return (theta / 15.0) % 24.0
+
+# Greenwich apparent sidereal time in hours, allowing for nutation
+def GAST(t=None):
+    dpsi, deps, eps = Nutation(t)
+    return (GMST(t) + dpsi * cosd(eps) / 15.0) % 24.0
+
+# Local apparent sidereal time in hours, for a longitude west of Greenwich
+def LST(longitude, t=None):
+    return (GAST(t) - longitude / 15.0) % 24.0
+
+######################### PRECESSION AND NUTATION ######################
+
+# Multiples of D, M, M', F and Omega, and the coefficients of the nutation
+# in longitude and obliquity in units of 0.0001 arcsec and their rates per
+# century, for each term of the series (Meeus table 22.A)
+NUTATION_TERMS = (
+    ( 0,  0,  0,  0, 1, -171996, -174.2, 92025,  8.9),
+    (-2,  0,  0,  2, 2,  -13187,   -1.6,  5736, -3.1),
+    ( 0,  0,  0,  2, 2,   -2274,   -0.2,   977, -0.5),
+    ( 0,  0,  0,  0, 2,    2062,    0.2,  -895,  0.5),
+    ( 0,  1,  0,  0, 0,    1426,   -3.4,    54, -0.1),
+    ( 0,  0,  1,  0, 0,     712,    0.1,    -7,  0.0),
+    (-2,  1,  0,  2, 2,    -517,    1.2,   224, -0.6),
+    ( 0,  0,  0,  2, 1,    -386,   -0.4,   200,  0.0),
+    ( 0,  0,  1,  2, 2,    -301,    0.0,   129, -0.1),
+    (-2, -1,  0,  2, 2,     217,   -0.5,   -95,  0.3),
+    (-2,  0,  1,  0, 0,    -158,    0.0,     0,  0.0),
+    (-2,  0,  0,  2, 1,     129,    0.1,   -70,  0.0),
+    ( 0,  0, -1,  2, 2,     123,    0.0,   -53,  0.0),
+    ( 2,  0,  0,  0, 0,      63,    0.0,     0,  0.0),
+    ( 0,  0,  1,  0, 1,      63,    0.1,   -33,  0.0),
+    ( 2,  0, -1,  2, 2,     -59,    0.0,    26,  0.0),
+    ( 0,  0, -1,  0, 1,     -58,   -0.1,    32,  0.0),
+    ( 0,  0,  1,  2, 1,     -51,    0.0,    27,  0.0),
+    (-2,  0,  2,  0, 0,      48,    0.0,     0,  0.0),
+    ( 0,  0, -2,  2, 1,      46,    0.0,   -24,  0.0),
+    ( 2,  0,  0,  2, 2,     -38,    0.0,    16,  0.0),
+    ( 0,  0,  2,  2, 2,     -31,    0.0,    13,  0.0),
+    ( 0,  0,  2,  0, 0,      29,    0.0,     0,  0.0),
+    (-2,  0,  1,  2, 2,      29,    0.0,   -12,  0.0),
+    ( 0,  0,  0,  2, 0,      26,    0.0,     0,  0.0),
+    (-2,  0,  0,  2, 0,     -22,    0.0,     0,  0.0),
+    ( 0,  0, -1,  2, 1,      21,    0.0,   -10,  0.0),
+    ( 0,  2,  0,  0, 0,      17,   -0.1,     0,  0.0),
+    ( 2,  0, -1,  0, 1,      16,    0.0,    -8,  0.0),
+    (-2,  2,  0,  2, 2,     -16,    0.1,     7,  0.0),
+    ( 0,  1,  0,  0, 1,     -15,    0.0,     9,  0.0),
+    (-2,  0,  1,  0, 1,     -13,    0.0,     7,  0.0),
+    ( 0, -1,  0,  0, 1,     -12,    0.0,     6,  0.0),
+    ( 0,  0,  2, -2, 0,      11,    0.0,     0,  0.0),
+    ( 2,  0, -1,  2, 1,     -10,    0.0,     5,  0.0),
+    ( 2,  0,  1,  2, 2,      -8,    0.0,     3,  0.0),
+    ( 0,  1,  0,  2, 2,       7,    0.0,    -3,  0.0),
+    (-2,  1,  1,  0, 0,      -7,    0.0,     0,  0.0),
+    ( 0, -1,  0,  2, 2,      -7,    0.0,     3,  0.0),
+    ( 2,  0,  0,  2, 1,      -7,    0.0,     3,  0.0),
+    ( 2,  0,  1,  0, 0,       6,    0.0,     0,  0.0),
+    (-2,  0,  2,  2, 2,       6,    0.0,    -3,  0.0),
+    (-2,  0,  1,  2, 1,       6,    0.0,    -3,  0.0),
+    ( 2,  0, -2,  0, 1,      -6,    0.0,     3,  0.0),
+    ( 2,  0,  0,  0, 1,      -6,    0.0,     3,  0.0),
+    ( 0, -1,  1,  0, 0,       5,    0.0,     0,  0.0),
+    (-2, -1,  0,  2, 1,      -5,    0.0,     3,  0.0),
+    (-2,  0,  0,  0, 1,      -5,    0.0,     3,  0.0),
+    ( 0,  0,  2,  2, 1,      -5,    0.0,     3,  0.0),
+)
+
+# Nutation in longitude and obliquity, and the true obliquity of the
+# ecliptic, all in degrees
+def Nutation(t=None):
+    T = Centuries(t)
+    D  = 297.85036 + 445267.111480*T - 0.0019142*T*T + T*T*T/189474.0
+    M  = 357.52772 + 35999.050340*T - 0.0001603*T*T - T*T*T/300000.0
+    Mm = 134.96298 + 477198.867398*T + 0.0086972*T*T + T*T*T/56250.0
+    F  = 93.27191 + 483202.017538*T - 0.0036825*T*T + T*T*T/327270.0
+    Om = 125.04452 - 1934.136261*T + 0.0020708*T*T + T*T*T/450000.0
+
+    dpsi = 0.0
+    deps = 0.0
+    for d, m, mm, f, om, psi, psit, eps, epst in NUTATION_TERMS:
+        arg = d*D + m*M + mm*Mm + f*F + om*Om
+        dpsi += (psi + psit*T) * sind(arg)
+        deps += (eps + epst*T) * cosd(arg)
+    dpsi = dpsi / 36000000.0
+    deps = deps / 36000000.0
+
+    # Mean obliquity
+    eps0 = 23.0 + 26.0/60.0 + (21.448 - 46.8150*T - 0.00059*T*T +
+                               0.001813*T*T*T) / 3600.0
+    return dpsi, deps, eps0 + deps
+
+# Precession matrix from J2000 to the date (IAU 1976)
+def PrecessionMatrix(t=None):
+    T = Centuries(t)
+    zeta  = (2306.2181*T + 0.30188*T*T + 0.017998*T*T*T) / 3600.0
+    z     = (2306.2181*T + 1.09468*T*T + 0.018203*T*T*T) / 3600.0
+    theta = (2004.3109*T - 0.42665*T*T - 0.041833*T*T*T) / 3600.0
+    return MatMul(RotZ(z), MatMul(RotY(-theta), RotZ(zeta)))
+
+# Nutation matrix from the mean to the true equator and equinox of the date
+def NutationMatrix(t=None):
+    dpsi, deps, eps = Nutation(t)
+    return MatMul(RotX(eps), MatMul(RotZ(dpsi), RotX(-(eps - deps))))
+
+# Matrix taking J2000 coordinates to those of the date
+def J2000ToNowMatrix(t=None):
+    return MatMul(NutationMatrix(t), PrecessionMatrix(t))
+
+# Precesses J2000 RA and Dec to the true equator and equinox of the date,
+# by default now
+def Precess2000ToNow(ra, dec, t=None):
+    return VecToRADec(MatVec(J2000ToNowMatrix(t), RADecToVec(ra, dec)))
+
+def PrecessNowTo2000(ra, dec, t=None):
+    return VecToRADec(MatVec(Transpose(J2000ToNowMatrix(t)),
+                             RADecToVec(ra, dec)))
+
+######################### HORIZON COORDINATES ##########################
+
+# Alt Az from HA (hours) and Dec, azimuth measured from north through east
+def AltAzfromHADEC(ha, dec, lat):
+    alt = math.degrees(math.asin(sind(dec)*sind(lat) +
+                                 cosd(dec)*cosd(lat)*cosd(ha*15.0)))
+    az = math.degrees(math.atan2(-cosd(dec)*cosd(lat)*sind(ha*15.0),
+                                 sind(dec) - sind(lat)*sind(alt)))
+    return alt, az
+
+def HADECfromAltAz(alt, az, lat):
+    dec = math.degrees(math.asin(sind(alt)*sind(lat) +
+                                 cosd(alt)*cosd(lat)*cosd(az)))
+    ha = math.degrees(math.atan2(-cosd(alt)*sind(az),
+                                 sind(alt)*cosd(lat) -
+                                 cosd(alt)*sind(lat)*cosd(az))) / 15.0
+    return ha, dec
+
+######################### FITS HEADERS #################################
+
+# Reads the header of a FITS file. Returns a dictionary of the values as
+# strings and the offset in the file of the image data.
+def ReadFITSHeader(path):
+    header = {}
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(2880)
+            if len(block) < 2880:
+                raise ValueError("No END in FITS header: " + str(path))
+            for i in range(0, 2880, 80):
+                card = block[i:i+80].decode("ascii", "replace")
+                key = card[:8].strip()
+                if key == "END":
+                    return header, f.tell()
+                if card[8:10] != "= ":
+                    continue
+                value = card[10:].strip()
+                if value.startswith("'"):
+                    value = value[1:]
+                    if "'" in value:
+                        value = value[:value.find("'")]
+                    header[key] = value.rstrip()
+                else:
+                    header[key] = value.split("/")[0].strip()
+
+# Turns a FITS "H M S" string into decimal hours, keeping the sign
+def HMSToDecimal(hms):
+    sphms = hms.split()
+    dec = abs(float(sphms[0])) + float(sphms[1])/60.0 + \
+          float(sphms[2])/3600.0
+    return math.copysign(dec, float(sphms[0]))
+
+# Reads the telescope HA and the LST written in the header of an image, as
+# TSX would from its FITS keywords TELEHA and LST
+def ImageHAandLST(path):
+    header, offset = ReadFITSHeader(path)
+    return HMSToDecimal(header["TELEHA"]), HMSToDecimal(header["LST"])
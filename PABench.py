@@ -0,0 +1,528 @@
+#!/usr/bin/env -S python3 -u
+#
+# Benchmark and accuracy check of the polar alignment calculations in
+# PAEngine.py, so that a change to them can be judged on speed and accuracy
+# together.
+#
+# To run this program type:
+#
+# PABench.py or python3 PABench.py --help
+#
+# Each case is a mount whose polar axis is misaligned by a known amount.
+# The two alignment images, and FRAMES more as the mount tracks, are worked
+# out exactly (with optional plate solve noise). The first two are put
+# through PASolve, and the rest through FrameReducer - refining the axis
+# (--axis-fit) and smoothing the adjustments (unless --no-smooth) - as
+# PolarAlign does. The axis found, and the adjustment shown for each
+# image, are compared with the truth, and each is timed. These cases hold
+# the mount still. They cover a range of latitudes, declinations and HA
+# separations, and the difficult places the README warns about: the second
+# image near the zenith or near the east-west axis.
+#
+# The adjusting cases take images ADJUST_STEP seconds apart while the
+# misalignment is reduced a little before each one, as when the knobs are
+# turned. The error is of the adjustment still shown once the mount is
+# aligned. The smoothing is also timed following a sudden change in the
+# adjustment, e.g. a quick turn of a knob.
+#
+# With no noise the axis and adjustments should be exact, so a case out by
+# more than NOISELESS_LIMIT is counted as wrong in the summary.
+#
+# Prints a summary of each group of cases and the time for each routine.
+# Use --json to save the results, e.g. to compare before and after a change.
+
+import argparse
+import json
+import math
+import random
+import signal
+import sys
+import time
+import timeit
+
+import PAEngine
+from Astrometry import MatVec, MatMul, RotX, RotZ, AltAzfromHADEC, \
+    HADECfromAltAz
+
+# Seconds before a case is given up as not converging
+CASE_TIMEOUT = 5.0
+
+# Hours between the images taken after the two alignment images
+FRAME_STEP   = 2.0 / 60.0
+
+# Arcsec the misalignment is reduced by between images in the adjusting
+# cases, as if an adjustment knob were turned while the images are taken
+ADJUST_TURNS = (5.0, 10.0, 20.0, 40.0, 120.0)
+
+# Seconds between the images in the adjusting cases
+ADJUST_STEP  = 5.0
+
+# Images in the adjusting cases before the knobs are turned, and after the
+# mount is aligned
+ADJUST_HOLD  = 3
+ADJUST_AFTER = 10
+
+# Largest misalignment in arcmin of the random adjusting cases
+ADJUST_MAX_ERROR = 10.0
+
+# Arcsec by which the adjustment changes all at once in the smoothing lag
+# cases, and the images after it they are followed for
+LAG_CHANGES  = (30.0, 60.0, 120.0, 300.0)
+LAG_FRAMES   = 30
+LAG_TRIALS   = 100 # Runs averaged with noise
+
+# Largest misalignment in arcmin of the random cases
+MAX_ERROR    = 60.0
+
+# Arcsec - with no noise the axis and adjustments should be exact, so a
+# case further out than this (the grid search's resolution) is wrong
+NOISELESS_LIMIT = 10.0
+
+######################### CASES ########################################
+
+# Each case is the latitude, declination, HA of the two alignment images
+# and which group it is in. Declinations are given for the northern
+# hemisphere and are mirrored in the southern.
+def Cases():
+    cases = []
+    for lat in (-60.0, -35.0, -10.0, 10.0, 20.0, 35.0, 51.37, 65.0, 80.0):
+        cases.append(("latitude", lat, 60.0, 1.0, 5.0))
+    for dec in (20.0, 30.0, 45.0, 60.0, 75.0, 85.0, 89.0):
+        cases.append(("declination", 51.37, dec, 1.0, 5.0))
+    for ha1, ha2 in ((1.0, 1.25), (1.0, 1.5), (1.0, 2.0), (1.0, 3.0),
+                     (1.0, 5.0), (-3.0, 3.0), (-5.0, 5.0)):
+        cases.append(("separation", 51.37, 60.0, ha1, ha2))
+    # Second image at or near the zenith
+    for offset in (0.0, 0.5, 2.0, 5.0):
+        cases.append(("zenith", 51.37, 51.37 - offset, -4.0, 0.0))
+    # Second image on or near the east-west axis (on the horizon due west)
+    for dec in (0.0, 2.0, 5.0, 10.0):
+        cases.append(("east-west", 51.37, dec, 2.0, 6.0))
+    return cases
+
+# A mount at latitude lat whose polar axis is misaligned by alterror and
+# azerror (degrees), as modelled by TSXSim.py
+class Mount:
+    def __init__(self, lat, alterror, azerror):
+        self.lat = lat
+        self.matrix = MatMul(RotZ(-azerror), RotX(alterror))
+
+    # RA, Dec, LST and telescope HA of an image taken with the mount at
+    # hour angle ha and declination dec in its own frame. Plate solve
+    # noise of noise arcsec is added using rnd.
+    def Image(self, ha, dec, lst, noise=0.0, rnd=None):
+        alt, az = AltAzfromHADEC(ha, dec, self.lat)
+        talt, taz = PAEngine.VecToAltAz(
+            MatVec(self.matrix, PAEngine.VfromAltAz(alt, az)))
+        tha, tdec = HADECfromAltAz(talt, taz, self.lat)
+        ra = (lst - tha) % 24.0
+        if noise > 0:
+            tdec += rnd.gauss(0.0, noise / 3600.0)
+            ra += rnd.gauss(0.0, noise / 3600.0) / 15.0 / \
+                max(math.cos(math.radians(tdec)), 1e-6)
+        return ra, tdec, lst, ha
+
+    # HA and Dec of the polar axis, and the adjustment which would align
+    # it, with the signs as given by PolarAlign
+    def Truth(self):
+        alt, az = PAEngine.VecToAltAz(
+            MatVec(self.matrix, PAEngine.VfromAltAz(self.lat, 0.0)))
+        ha, dec = HADECfromAltAz(alt, az, self.lat)
+        sign = math.copysign(1, self.lat)
+        return ha, dec, (alt - self.lat) * sign, az * sign
+
+# Angle in arcsec between two directions given as HA (hours) and Dec
+def Separation(ha1, dec1, ha2, dec2):
+    v1 = PAEngine.VfromAltAz(dec1, ha1 * 15.0)
+    v2 = PAEngine.VfromAltAz(dec2, ha2 * 15.0)
+    cross = PAEngine.VCross(v1, v2)
+    return math.degrees(math.atan2(math.sqrt(PAEngine.VDot(cross, cross)),
+                                   PAEngine.VDot(v1, v2))) * 3600.0
+
+######################### RUNNING ######################################
+
+# Stands in for PAEngine's clock, so images can be taken ADJUST_STEP apart
+# without waiting
+class BenchClock:
+    def __init__(self):
+        self.now = 1e9
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+# Stands in for PAEngine's EventBus, keeping the adjustments shown
+class Events:
+    def __init__(self):
+        self.adjustments = []
+
+    def put(self, event):
+        if isinstance(event, PAEngine.Adjustment):
+            self.adjustments.append(event)
+
+class CaseTimeout(Exception):
+    pass
+
+def Alarm(signum, frame):
+    raise CaseTimeout()
+
+# Puts the images after the two alignment images through FrameReducer,
+# step seconds apart, refining the axis if fitting is set and smoothing
+# the adjustments if PAEngine.SMOOTH is set, just as PolarAlign does.
+# Returns the adjustment (alt, az) shown for each image and the samples the
+# axis was finally fitted to.
+def Reduce(lat, images, target, fitting, step):
+    ra2, dec2, lst2, tha2 = images[1]
+    i2alt, i2az = PAEngine.AltAzfromHADECLat(lst2 - ra2, dec2, lat)
+    events = Events()
+    reducer = PAEngine.FrameReducer(events, lat, i2alt, i2az, lst2,
+                                    target[4], target[5], list(images[:2]),
+                                    fitting, PAEngine.AlignmentFilter())
+    for n, sample in enumerate(images[2:], 3):
+        PAEngine.clock.sleep(step)
+        reducer.submit(n, sample)
+        reducer.wait()
+    return [(a.alt, a.az) for a in events.adjustments], reducer.samples
+
+# Works out the axis and adjustments for one case as PolarAlign does: the
+# axis and adjustment from the two alignment images with PASolve, then the
+# images after them, step seconds apart, through Reduce. Returns the axis
+# (as refined, if fitting), the reference values needed for each image and
+# the adjustment shown for each image from the second.
+def Solve(lat, images, fitting, step):
+    (ra1, dec1, lst1, tha1), (ra2, dec2, lst2, tha2) = images[:2]
+    paha, padec = PAEngine.PASolve(ra1, dec1, lst1, tha1,
+                                   ra2, dec2, lst2, tha2)
+    i2alt, i2az = PAEngine.AltAzfromHADECLat(lst2 - ra2, dec2, lat)
+    target = PAEngine.AlignmentTarget(paha, padec, lat, i2alt, i2az)
+    first = PAEngine.ImageAdjustment(ra2, dec2, lst2, lat, lst2,
+                                     target[4], target[5])
+    shown, samples = Reduce(lat, images, target, fitting, step)
+    if len(samples) > 2:
+        paha, padec = PAEngine.PASolveN(samples)[:2]
+    return paha, padec, target, [first] + shown
+
+# Best time in microseconds of one call of func, over repeat runs of
+# number calls (enough for 0.2 seconds if None)
+def Time(func, repeat, number=None):
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+# Runs one case with the given misalignment. Returns a dictionary of the
+# errors (arcsec) and times (microseconds), or with "failed" saying why.
+def RunCase(case, alterror, azerror, args, rnd):
+    group, lat, dec, ha1, ha2 = case
+    dec = math.copysign(dec, lat)
+    mount = Mount(lat, alterror / 60.0, azerror / 60.0)
+    lst = 3.0
+    images = [mount.Image(ha1, dec, lst, args.noise, rnd),
+              mount.Image(ha2, dec, lst + 0.05, args.noise, rnd)]
+    images += [mount.Image(ha2 + i * FRAME_STEP, dec,
+                           lst + 0.05 + i * FRAME_STEP, args.noise, rnd)
+               for i in range(1, args.frames + 1)]
+    result = {"group": group, "lat": lat, "dec": dec, "ha1": ha1, "ha2": ha2,
+              "alt_error": alterror, "az_error": azerror}
+
+    signal.setitimer(signal.ITIMER_REAL, CASE_TIMEOUT)
+    try:
+        paha, padec, target, adjustments = Solve(lat, images, args.fitting,
+                                                 FRAME_STEP * 3600.0)
+    except CaseTimeout:
+        result["failed"] = "no convergence"
+        return result
+    except (ZeroDivisionError, ValueError, OverflowError) as e:
+        result["failed"] = type(e).__name__ + ": " + str(e)
+        return result
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+    trueha, truedec, truealt, trueaz = mount.Truth()
+    result["axis"] = Separation(paha, padec, trueha, truedec)
+    result["alt"] = max(abs(theta - truealt) for theta, phi in adjustments) \
+        * 3600.0
+    result["az"] = max(abs(phi - trueaz) for theta, phi in adjustments) \
+        * 3600.0
+
+    (ra1, dec1, lst1, tha1), (ra2, dec2, lst2, tha2) = images[:2]
+    result["pasolve_us"] = Time(lambda: PAEngine.PASolve(
+        ra1, dec1, lst1, tha1, ra2, dec2, lst2, tha2), args.repeat,
+        args.number)
+    if args.frames > 0:
+        result["frame_us"] = Time(lambda: Reduce(
+            lat, images, target, args.fitting, FRAME_STEP * 3600.0),
+            args.repeat, 1) / args.frames
+    else:
+        result["frame_us"] = Time(lambda: PAEngine.ImageAdjustment(
+            ra2, dec2, lst2, lat, lst2, target[4], target[5]), args.repeat,
+            args.number)
+    return result
+
+# Runs an adjusting case: the standard case's mount, misaligned by alterror
+# and azerror, held still for ADJUST_HOLD images, then moved turn arcsec
+# nearer alignment before each image until it is aligned, and held there
+# for ADJUST_AFTER images. The errors are of the adjustment shown for the
+# last image, when the mount is aligned.
+def RunAdjusting(turn, alterror, azerror, args, rnd):
+    lat, dec, ha1, ha2 = 51.37, 60.0, 1.0, 5.0
+    result = {"group": "adjust %g\"" % turn, "lat": lat, "dec": dec, "ha1": ha1,
+              "ha2": ha2, "alt_error": alterror, "az_error": azerror,
+              "turn": turn}
+    mount = Mount(lat, alterror / 60.0, azerror / 60.0)
+    lst = 3.0
+    images = [mount.Image(ha1, dec, lst, args.noise, rnd),
+              mount.Image(ha2, dec, lst + 0.05, args.noise, rnd)]
+    step = ADJUST_STEP / 3600.0
+    alt, az = alterror / 60.0, azerror / 60.0
+    hold, after = ADJUST_HOLD, ADJUST_AFTER
+    while after > 0:
+        if hold > 0:
+            hold -= 1
+        elif alt or az:
+            left = math.hypot(alt, az) * 3600.0
+            scale = max(0.0, left - turn) / left
+            alt, az = alt * scale, az * scale
+        else:
+            after -= 1
+        mount = Mount(lat, alt, az)
+        n = len(images) - 1
+        images.append(mount.Image(ha2 + n * step, dec, lst + 0.05 + n * step,
+                                  args.noise, rnd))
+
+    start = time.perf_counter()
+    paha, padec, target, shown = Solve(lat, images, args.fitting, ADJUST_STEP)
+    result["frame_us"] = (time.perf_counter() - start) / len(shown) * 1e6
+    result["pasolve_us"] = Time(lambda: PAEngine.PASolve(
+        *(images[0] + images[1])), args.repeat, args.number)
+
+    trueha, truedec = Mount(lat, alterror / 60.0, azerror / 60.0).Truth()[:2]
+    result["axis"] = Separation(paha, padec, trueha, truedec)
+    result["alt"] = abs(shown[-1][0]) * 3600.0
+    result["az"] = abs(shown[-1][1]) * 3600.0
+    return result
+
+# Number of images, ADJUST_STEP seconds apart, the smoothed adjustment
+# takes to get within 10% of a change of change arcsec (e.g. a quick turn
+# of a knob), after LAG_FRAMES images of it holding still. With trials, each
+# adjustment has the error SMOOTH_NOISE expects, and the smoothed
+# adjustment is averaged over that many runs. Returns LAG_FRAMES + 1 if it
+# doesn't get there.
+def FilterLag(change, rnd, trials=0):
+    noise = PAEngine.SMOOTH_NOISE if trials else 0.0
+    shown = [0.0] * LAG_FRAMES
+    for trial in range(max(trials, 1)):
+        smoothing = PAEngine.AlignmentFilter()
+        for n in range(-LAG_FRAMES, LAG_FRAMES):
+            PAEngine.clock.sleep(ADJUST_STEP)
+            value = (change / 3600.0 if n >= 0 else 0.0) + \
+                rnd.gauss(0.0, noise)
+            theta = smoothing.update(value, 0.0)[0]
+            if n >= 0:
+                shown[n] += theta * 3600.0 / max(trials, 1)
+    return next((n + 1 for n, theta in enumerate(shown)
+                 if abs(theta - change) < 0.1 * change), LAG_FRAMES + 1)
+
+# Times each of the routines on their own, for the first standard case.
+# Cosang and VGCC are timed with the arguments PASolve first gives them.
+def TimeRoutines(args):
+    mount = Mount(51.37, 0.5, -1.0 / 3.0)
+    images = [mount.Image(1.0, 60.0, 3.0), mount.Image(5.0, 60.0, 3.05)]
+    paha, padec, target, adjustments = Solve(51.37, images, False, 0.0)
+    i2alt, i2az = PAEngine.AltAzfromHADECLat(3.05 - images[1][0],
+                                             images[1][1], 51.37)
+    talt, taz = target[2], target[3]
+
+    calls = []
+    cosang = PAEngine.Cosang
+    def record(*a):
+        calls.append(a)
+        return cosang(*a)
+    PAEngine.Cosang = record
+    try:
+        PAEngine.PASolve(*(images[0] + images[1]))
+    finally:
+        PAEngine.Cosang = cosang
+    cosargs = calls[0]
+
+    flat = images[0] + images[1]
+    routines = [
+        ("PASolve", lambda: PAEngine.PASolve(*flat)),
+        ("Cosang", lambda: PAEngine.Cosang(*cosargs)),
+        ("VGCC", lambda: PAEngine.VGCC(*cosargs[:5])),
+        ("AltAzfromHADECLat", lambda: PAEngine.AltAzfromHADECLat(
+            1.0, 60.0, 51.37)),
+        ("RotateAltAz", lambda: PAEngine.RotateAltAz(i2alt, i2az, 0.5, -0.3)),
+        ("BruteRotationSearch", lambda: PAEngine.BruteRotationSearch(
+            i2alt, i2az, talt, taz)),
+        ("LMRotationSearch", lambda: PAEngine.LMRotationSearch(
+            i2alt, i2az, talt, taz)),
+        ("AlignmentTarget", lambda: PAEngine.AlignmentTarget(
+            paha, padec, 51.37, i2alt, i2az)),
+    ]
+    if PAEngine.np is not None:
+        samples = [mount.Image(1.0 + i * 0.5, 60.0, 3.0 + i * 0.05)
+                   for i in range(10)]
+        routines.append(("PASolveN (10 images)",
+                         lambda: PAEngine.PASolveN(samples)))
+    return [(name, Time(func, args.repeat)) for name, func in routines]
+
+######################### REPORT #######################################
+
+def Median(values):
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return math.nan
+    return values[n // 2] if n % 2 else (values[n//2 - 1] + values[n//2]) / 2
+
+def PrintCase(r):
+    text = "%-11s lat %6.2f dec %6.2f HA %5.2f %5.2f err %6.1f' %6.1f'  " % \
+        (r["group"], r["lat"], r["dec"], r["ha1"], r["ha2"], r["alt_error"],
+         r["az_error"])
+    if "failed" in r:
+        print(text + "FAILED " + r["failed"])
+    else:
+        print(text + "axis %9.2f\" alt %9.2f\" az %9.2f\" %7.1f us %7.1f us"
+              % (r["axis"], r["alt"], r["az"], r["pasolve_us"],
+                 r["frame_us"]) + ("  WRONG" if r.get("wrong") else ""))
+
+# Marks a case run with no noise as wrong if its axis or an adjustment is
+# further from the truth than NOISELESS_LIMIT
+def CheckNoiseless(r, args):
+    if args.noise == 0 and "failed" not in r:
+        r["wrong"] = max(r["axis"], r["alt"], r["az"]) > NOISELESS_LIMIT
+
+def PrintSummary(results):
+    print()
+    print("%-11s %5s %6s %5s %22s %22s %22s %9s %9s" %
+          ("group", "cases", "failed", "wrong", "axis \" median/max",
+           "alt \" median/max", "az \" median/max", "PASolve", "frame"))
+    groups = []
+    for r in results:
+        if r["group"] not in groups:
+            groups.append(r["group"])
+    for group in groups + ["all"]:
+        rs = [r for r in results if group in ("all", r["group"])]
+        ok = [r for r in rs if "failed" not in r]
+        line = "%-11s %5d %6d %5d" % (group, len(rs), len(rs) - len(ok),
+                                      sum(1 for r in ok if r.get("wrong")))
+        for key in ("axis", "alt", "az"):
+            values = [r[key] for r in ok]
+            line += " %10.2f/%11.2f" % (Median(values),
+                                        max(values, default=math.nan))
+        for key in ("pasolve_us", "frame_us"):
+            line += " %6.1f us" % Median([r[key] for r in ok])
+        print(line)
+    wrong = sum(1 for r in results if r.get("wrong"))
+    if wrong:
+        print("%d cases are more than %g\" out with no noise (--cases shows "
+              "which)" % (wrong, NOISELESS_LIMIT))
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and accuracy "
+                                     "check of the polar alignment "
+                                     "calculations.")
+    parser.add_argument("--solver", choices=["brute", "lm"],
+                        default=PAEngine.ROT_SOLVER,
+                        help="how to work out the adjustment for each image")
+    parser.add_argument("--no-numpy", action="store_true",
+                        help="don't use NumPy even if it is installed")
+    parser.add_argument("--axis-fit", choices=["on", "off"],
+                        default="on" if PAEngine.AXIS_FIT else "off",
+                        help="refine the polar axis with the images after "
+                        "the first two (needs NumPy)")
+    parser.add_argument("--no-smooth", action="store_true",
+                        help="don't smooth the adjustments")
+    parser.add_argument("--noise", type=float, default=0.0,
+                        help="plate solve noise in arcsec (1 sigma)")
+    parser.add_argument("--trials", type=int, default=3,
+                        help="random misalignments for each case, as well "
+                        "as the standard one (30' alt, -20' az)")
+    parser.add_argument("--frames", type=int, default=5,
+                        help="images after the two alignment images")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timing runs; the best is used")
+    parser.add_argument("--number", type=int, default=10,
+                        help="calls in each timing run of a case")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cases", action="store_true",
+                        help="print the result of every case")
+    parser.add_argument("--json", help="save the results to this file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = ParseArgs(argv)
+    PAEngine.ROT_SOLVER = args.solver
+    if args.no_numpy:
+        PAEngine.usenumpy = False
+    PAEngine.SMOOTH = not args.no_smooth
+    PAEngine.clock = BenchClock()
+    args.fitting = args.axis_fit == "on" and PAEngine.np is not None
+    rnd = random.Random(args.seed)
+    signal.signal(signal.SIGALRM, Alarm)
+
+    print("Solver %s, NumPy %s, axis fit %s, smoothing %s, noise %.1f\", "
+          "%d frames per case" %
+          (args.solver, "used" if PAEngine.usenumpy and
+           PAEngine.np is not None else "not used",
+           "on" if args.fitting else "off", "off" if args.no_smooth else "on",
+           args.noise, args.frames))
+    results = []
+    for case in Cases():
+        errors = [(30.0, -20.0)] + \
+            [(rnd.uniform(-MAX_ERROR, MAX_ERROR),
+              rnd.uniform(-MAX_ERROR, MAX_ERROR)) for i in range(args.trials)]
+        for alterror, azerror in errors:
+            result = RunCase(case, alterror, azerror, args, rnd)
+            CheckNoiseless(result, args)
+            results.append(result)
+            if args.cases:
+                PrintCase(result)
+    for turn in ADJUST_TURNS:
+        errors = [(5.0, -3.0)] + \
+            [(rnd.uniform(-ADJUST_MAX_ERROR, ADJUST_MAX_ERROR),
+              rnd.uniform(-ADJUST_MAX_ERROR, ADJUST_MAX_ERROR))
+             for i in range(args.trials)]
+        for alterror, azerror in errors:
+            result = RunAdjusting(turn, alterror, azerror, args, rnd)
+            CheckNoiseless(result, args)
+            results.append(result)
+            if args.cases:
+                PrintCase(result)
+    PrintSummary(results)
+
+    lags = {}
+    print()
+    print("Images (%g s apart) for the smoothed adjustment to follow a change"
+          % ADJUST_STEP)
+    print("%8s %9s %16s" % ("change", "no noise", "noise (average)"))
+    for change in LAG_CHANGES:
+        lags[change] = {"no noise": FilterLag(change, rnd),
+                        "noise": FilterLag(change, rnd, LAG_TRIALS)}
+        print("%7g\" %9d %16d" % (change, lags[change]["no noise"],
+                                   lags[change]["noise"]))
+
+    routines = TimeRoutines(args)
+    print()
+    for name, us in routines:
+        print("%-22s %10.2f us per call" % (name, us))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"solver": args.solver, "noise": args.noise,
+                       "numpy": PAEngine.usenumpy and PAEngine.np is not None,
+                       "frames": args.frames, "seed": args.seed,
+                       "axis_fit": args.fitting, "smooth": not args.no_smooth,
+                       "cases": results, "lags": lags,
+                       "routines": dict(routines)}, f,
+                      indent=1)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
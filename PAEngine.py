@@ -0,0 +1,4514 @@
+#!/usr/bin/env -S python3 -u
+#
+# Polar alignment engine used by PAUI.py. Does all the work of talking to
+# TSX and calculating the alignment, without needing a display, so it can
+# also be run on its own from the command line:
+#
+# PAEngine.py or python3 PAEngine.py --help
+#
+# which prints each update as a line of JSON, e.g.
+#
+# {"type": "adjust", "alt": 0.5, "az": -0.33, "alt_error": 0.004,
+#  "az_error": 0.004, "time": 1760000000.0}
+#
+# Stop with Ctrl-C - the image or slew in progress is abandoned (see
+# STOP_ABORT).
+#
+# The settings below are the ones described in the README. They can be
+# edited here, or most can be given on the command line.
+
+import socket
+import select
+import time
+import sys
+import signal
+import argparse
+import datetime
+import os.path
+import random, math, cmath
+import re
+import json
+import collections
+import threading
+import atexit
+import logging, logging.handlers
+import gzip, shutil
+import contextlib
+import concurrent.futures, multiprocessing
+import cProfile
+import http.server
+from queue import SimpleQueue, Empty
+from pathlib import Path
+
+# Sidereal time, precession and reading image headers, worked out here
+# rather than by TSX
+import Astrometry
+from Astrometry import ReadFITSHeader, HMSToDecimal
+
+# NumPy is optional - used to speed up the rotation search and needed to
+# track images by comparing them (TRACK_METHOD "image")
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Used to lock the device cache while it is saved. Not on Windows, where it
+# is saved without.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Parameters for controlling take picture
+CAM_DURATION = 4.0    # Number of seconds for picture
+CAM_BINNING  = 4      # Binning of image
+CAM_SCALE    = 6.872  # Arcsec/pixel of binned image - used for platesolve
+CAM_FILTER   = ""     # Set if you want to specify a filter for platesolve
+CAM_PIPELINE = False  # Take the next image while the last one is plate solved
+CAM_TRACK    = False  # Follow the shift between images instead of plate solving
+                      # every one - needs the images on this computer
+TRACK_SOLVE_EVERY = 10 # When tracking, plate solve at least every n images
+TRACK_METHOD = "image" # "image" to track by comparing the images, "stars" to
+                      # match the stars TSX finds in them
+TRACK_MIN_PEAK = 0.05 # When tracking images, plate solve if the match is worse
+TRACK_MIN_STARS = 6   # When tracking stars, plate solve if fewer are matched
+CAM_AUTO     = False  # Adjust the exposure and binning to the quickest that
+                      # reliably plate solve, within the limits below
+CAM_MIN_DURATION = 0.5 # Shortest exposure in seconds
+CAM_MAX_DURATION = 30.0 # Longest exposure in seconds
+CAM_MAX_BINNING = 4   # Most binning (never less than CAM_BINNING)
+AUTO_MIN_STARS = 20   # Plate solves with fewer stars are too close to failing
+AUTO_GOOD    = 3      # Good plate solves in a row before speeding up
+CAM_ROI      = False  # Once the alignment images are solved, read out only a
+                      # subframe of the sensor big enough to plate solve
+ROI_STARS    = 60     # Number of stars the subframe should hold
+ROI_MIN_FIELD = 20.0  # Smallest width of the subframe in arcmin
+# 2.31 for Nerpio, 6.872 for Weybridge, 1.7 for DSS images
+
+# Parameters for controlling where to take images
+PA_DEC       = 60.0   # Which declination to take images?
+HAI1         = 1.0   # HA for Image 1
+HAI2         = 5.0   # HA for Image 2
+PLAN_POINTS  = True   # Choose where to take the images (see PlanPoints), to
+                      # need the least slewing. PA_DEC, HAI1 and HAI2 are
+                      # used if False, or if nowhere suitable is found.
+PLAN_ACCURACY = 60.0  # Arcsec - largest likely (1 sigma) error in the
+                      # adjustments from the chosen positions
+PLAN_NOISE   = 10.0   # Arcsec - error in the position of each image, from
+                      # plate solving, refraction, flexure etc
+PLAN_MIN_ALT = 25.0   # Lowest altitude for an image, degrees
+PLAN_MIN_HA  = 0.5    # Nearest an image may be to the meridian, hours
+PLAN_MAX_HA  = 6.0    # Furthest an image may be from the meridian, hours.
+                      # Both images are on the same side of the meridian.
+PLAN_MIN_DEC = 20.0   # Range of declinations (north or south) for the
+PLAN_MAX_DEC = 80.0   # images, degrees
+PLAN_ADJUST_TIME = 0.5 # Hours the mount may be adjusted for, while tracking
+                      # the second position, which must stay in range
+PLAN_SLEW_RATE = 2.0  # Degrees/sec the mount slews at
+PLAN_SETTLE  = 2.0    # Seconds for the mount to settle after a slew
+
+# Address of the TSX TCP server
+TSX_HOST     = '127.0.0.1'
+TSX_PORT     = 3040
+TSX_TIMEOUT  = 120.0  # Seconds to wait for a reply to a normal command
+TSX_SLEW_TIMEOUT = 600.0 # Seconds to wait for a slew to complete
+TSX_POLL     = 0.1    # Seconds between checks on an exposure or slew, and
+                      # on whether to stop while waiting for TSX
+STOP_ABORT   = True   # Stop abandons the exposure or slew in progress. If
+                      # False they are finished first - some versions of
+                      # TSX can crash if an exposure is aborted.
+
+# Where facts about the devices are kept between runs, and for how many
+# seconds each is trusted before being read from TSX again
+CACHE_FILE   = os.path.join(os.path.expanduser("~"), ".PAEngine-cache.json")
+CACHE_TTL    = {"filters": 7*86400, "site": 86400}
+
+# Where everything the PA routine prints and sends to the display is kept.
+# When the file reaches LOG_MAX_BYTES it is compressed and a new one started,
+# keeping LOG_BACKUPS old ones. "" for no log.
+LOG_FILE     = os.path.join(os.path.expanduser("~"), "PAEngine.log")
+LOG_MAX_BYTES = 1000000
+LOG_BACKUPS  = 5
+
+# Where a report of how long each stage of each image took is written at
+# the end of every session ("" for none), and over how many of the latest
+# images the running medians etc are worked out
+TIMING_DIR   = os.path.join(os.path.expanduser("~"), "PAEngine-timing")
+TIMING_WINDOW = 100
+PROFILE      = False  # Profile the calculations with cProfile, saved with
+                      # the timing report
+PROFILE_STAGES = ("pasolve", "rotation", "track")
+
+# Where each session is recorded, so it can be replayed later (see
+# TSXReplay), and how many recordings are kept. "" to not record.
+RECORD_DIR   = os.path.join(os.path.expanduser("~"), "PAEngine-traces")
+RECORD_KEEP  = 20
+
+# A web page showing the adjustments, messages and timings as they arrive,
+# for watching a remote observatory over a slow link without forwarding
+# the display. Open http://<computer>:DASHBOARD_PORT/ in a browser. 0 for
+# no dashboard.
+DASHBOARD_PORT = 0
+DASHBOARD_HOST = "127.0.0.1" # Address to listen on. This computer only:
+                      # "" for every address, so other computers can see it
+                      # - it has no password, so only on a trusted network
+DASHBOARD_LINES = 20  # Number of the latest messages shown
+DASHBOARD_KEEPALIVE = 15.0 # Seconds between keepalives when nothing changes
+DASHBOARD_QUEUE = 1000 # Events waiting for a page before it is taken to have
+                      # stalled and is dropped
+
+# Parameters for controlling the calculations
+usenumpy     = True   # Use NumPy for the rotation search if it is installed
+ROT_SOLVER   = "lm"   # "lm" for least squares solver, "brute" for grid search
+AXIS_FIT     = False  # Refine the polar axis with the images taken after the
+                      # first two, until the mount is adjusted (needs NumPy)
+AXIS_MAX_RESIDUAL = 30.0 # Arcsec - images further than this from the fitted
+                      # axis are not used
+AXIS_REJECT  = 3.5    # Nor, once it is fitted to 4 images, are images more
+                      # than this times its rms residual from it
+AXIS_MIN_NOISE = 1.0  # Arcsec - smallest error expected for an image
+AXIS_MAX_IMAGES = 50  # Stop refining the axis after this many images
+SMOOTH       = True   # Smooth the adjustments over several images
+SMOOTH_NOISE = 0.01   # Degrees error in the adjustment from one solved image
+SMOOTH_DRIFT = 0.001  # Degrees per second the adjustment drifts by itself
+SMOOTH_STEP  = 3.0    # Changes bigger than this many sigma are taken to be
+                      # the mount being adjusted
+SMOOTH_SHIFT = 4.0    # So are changes the same way over several images
+                      # adding up to this many sigma (beyond half a sigma
+                      # each)
+COMPUTE_WORKERS = 1   # Processes to work out the adjustments in, so the next
+                      # image and the display aren't held up by them. 0 to
+                      # work them out in the PA thread. Linux only.
+
+######################### TESTING ######################################
+# Parameters for testing - ensure are are false for a real run
+verbose    = False # Flag to say how much data to print out
+simulating = False  # Flag to indicate that using simulated images from DSS
+testdata   = False # Flag to indicate using test data from Mathematica
+keepfiles  = False # Keep the image and source files rather than delete them  
+
+######################### CODE #########################################
+# Where the PA routine gets the time and sleeps: the time module, or the
+# virtual clock of a session being replayed (see TSXReplay)
+clock = time
+
+# Set up CAM scale if using DSS images
+if simulating:
+    CAM_SCALE = 1.7
+    CAM_BINNING = 1
+
+# Events sent by the PA routine to whoever is showing its progress. Each
+# has the time it was sent.
+#    Adjustment: the latest adjustment and its 1 sigma errors, in degrees
+#    Message:    text, with a type of "info", "warning" (no new adjustment
+#                but the routine will continue) or "error" (the routine
+#                will stop)
+#    Finished:   the PA routine has finished
+#                exposed is when the exposure of its image started (None
+#                if not known)
+Adjustment = collections.namedtuple("Adjustment",
+                                    ["alt", "az", "alt_error", "az_error",
+                                     "time", "exposed"], defaults=(None,))
+Message = collections.namedtuple("Message", ["type", "text", "time"])
+Finished = collections.namedtuple("Finished", ["time"])
+
+# Carries events from the PA thread to the display. put may be given an
+# event, or a message string as described for DecodeMessage. wakeup, if
+# set, is called from the PA thread when events arrive and none were
+# waiting, so the display needn't keep checking.
+class EventBus:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.events = collections.deque()
+        self.wakeup = None
+
+    def put(self, event):
+        if isinstance(event, str):
+            event = MakeEvent(event)
+        with self.lock:
+            wake = not self.events
+            self.events.append(event)
+            self.lock.notify_all()
+        sessionlog.info("event " + json.dumps(EventDict(event),
+                                              ensure_ascii=False))
+        if dashboard is not None:
+            dashboard.Publish(event)
+        # Read once, as the display may set it to None at any time
+        wakeup = self.wakeup
+        if wake and wakeup is not None:
+            wakeup()
+
+    def empty(self):
+        with self.lock:
+            return not self.events
+
+    # Waits up to timeout seconds for the next event. Returns None if there
+    # isn't one.
+    def get(self, timeout=None):
+        with self.lock:
+            if not self.events:
+                self.lock.wait(timeout)
+            return self.events.popleft() if self.events else None
+
+    # Returns all the waiting events. If coalesce is True only the last
+    # adjustment is kept, for a display which only shows the latest one.
+    def drain(self, coalesce=False):
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+        if coalesce:
+            last = max([i for i, event in enumerate(events)
+                        if isinstance(event, Adjustment)], default=-1)
+            events = [event for i, event in enumerate(events)
+                      if i == last or not isinstance(event, Adjustment)]
+        return events
+
+# The session log. Records go on a queue and are written by a thread of
+# their own, so neither the PA routine nor the display waits for the disk.
+sessionlog = logging.getLogger("PAEngine")
+sessionlog.setLevel(logging.DEBUG)
+sessionlog.propagate = False
+loglistener = None
+
+# Rotated logs are compressed, e.g. PAEngine.log.1.gz
+def LogNamer(name):
+    return name + ".gz"
+
+def LogRotator(source, dest):
+    with open(source, "rb") as fin, gzip.open(dest, "wb") as fout:
+        shutil.copyfileobj(fin, fout)
+    os.remove(source)
+
+# Copies whatever is written to a stream into the session log, a line at a
+# time, so the existing prints (including the verbose ones) are kept
+class LogTee:
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.partial = ""
+
+    def write(self, text):
+        self.stream.write(text)
+        with self.lock:
+            lines = (self.partial + text).split("\n")
+            self.partial = lines.pop()
+        for line in lines:
+            if line.strip():
+                sessionlog.debug(line)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+# Starts writing the session log to LOG_FILE, if it isn't already
+def StartSessionLog():
+    global loglistener
+    if loglistener is not None or not LOG_FILE:
+        return
+    try:
+        handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    except OSError as e:
+        print(logtime() + "Cannot write the log to " + LOG_FILE + ": " + str(e))
+        return
+    handler.namer = LogNamer
+    handler.rotator = LogRotator
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s "
+                                           "%(message)s"))
+    logqueue = SimpleQueue()
+    sessionlog.addHandler(logging.handlers.QueueHandler(logqueue))
+    loglistener = logging.handlers.QueueListener(logqueue, handler)
+    loglistener.start()
+    atexit.register(StopSessionLog)
+    if not isinstance(sys.stdout, LogTee):
+        sys.stdout = LogTee(sys.stdout)
+
+# Writes out what is left of the session log and closes it
+def StopSessionLog():
+    global loglistener
+    if loglistener is None:
+        return
+    if isinstance(sys.stdout, LogTee):
+        sys.stdout = sys.stdout.stream
+    for handler in list(sessionlog.handlers):
+        sessionlog.removeHandler(handler)
+    loglistener.stop()
+    for handler in loglistener.handlers:
+        handler.close()
+    loglistener = None
+
+# How long each stage of each frame takes. A frame is one image, from
+# starting to take it (or slew for it) to its adjustment being sent. The
+# stages are:
+#    slew       slewing to the alignment points
+#    exposure   taking and downloading the image, or waiting for it when
+#               pipelined
+#    header     reading the image's HA and LST
+#    imagelink  plate solving
+#    results    reading the plate solve results
+#    transfer   time of the round trips to TSX not spent running scripts
+#    read       reading an image to track it
+#    track      comparing an image with the last solved one
+#    pasolve    finding the polar axis
+#    rotation   finding the adjustment
+#    dispatch   from the adjustment being sent to it being shown (from
+#               its image being measured, for FrameReducer)
+#    photon     from the exposure starting to the adjustment being shown
+#               ("photon to arrow")
+# The stages of TSX scripts are timed by TSX (see TSXBatch). dispatch and
+# photon are recorded by whatever shows the adjustments, using Shown.
+class StageTimer:
+    def __init__(self, profile=False):
+        self.lock = threading.Lock()
+        self.began = clock.time()
+        self.frames = []    # Stage times of each finished frame
+        self.frame = None   # Stage times of the frame in progress
+        self.start = None
+        self.recent = collections.defaultdict(
+            lambda: collections.deque(maxlen=TIMING_WINDOW))
+        self.profiler = cProfile.Profile() if profile else None
+
+    def StartFrame(self, label):
+        with self.lock:
+            self.frame = {"frame": label, "time": clock.time()}
+            self.start = clock.monotonic()
+
+    def EndFrame(self):
+        with self.lock:
+            if self.frame is None:
+                return
+            frame = self.frame
+            frame["cycle"] = clock.monotonic() - self.start
+            self.frames.append(frame)
+            for stage, seconds in frame.items():
+                if stage not in ("frame", "time"):
+                    self.recent[stage].append(seconds)
+            self.frame = None
+        if dashboard is not None:
+            dashboard.Timing(frame)
+        if verbose:
+            print("Frame " + str(frame["frame"]) + " " + \
+                  " ".join("%s %.3f" % (stage, seconds) for stage, seconds
+                           in frame.items() if stage not in ("frame", "time")))
+
+    # Adds seconds to a stage of the frame in progress, or of the last one
+    # if it has finished. If sent is given, the frame is the one in
+    # progress at that time (e.g. for dispatch).
+    def Add(self, stage, seconds, sent=None):
+        finished = None
+        with self.lock:
+            if self.frame is not None and \
+               (sent is None or self.frame["time"] <= sent):
+                self.frame[stage] = self.frame.get(stage, 0.0) + seconds
+            elif self.frames:
+                self.frames[-1][stage] = self.frames[-1].get(stage, 0.0) + \
+                    seconds
+                self.recent[stage].append(seconds)
+                finished = dict(self.frames[-1])
+        if finished is not None and dashboard is not None:
+            dashboard.Timing(finished)
+
+    # Times the code in a with block as a stage, profiling it if it is one
+    # of PROFILE_STAGES
+    @contextlib.contextmanager
+    def Stage(self, stage):
+        profile = self.profiler is not None and stage in PROFILE_STAGES
+        if profile:
+            self.profiler.enable()
+        start = clock.monotonic()
+        try:
+            yield
+        finally:
+            self.Add(stage, clock.monotonic() - start)
+            if profile:
+                self.profiler.disable()
+
+    # Called when an adjustment has been shown, with the time it was sent
+    # and when its exposure started (None if not known)
+    def Shown(self, sent, exposed=None):
+        now = clock.time()
+        self.Add("dispatch", now - sent, sent)
+        if exposed is not None:
+            self.Add("photon", now - exposed, sent)
+
+    # Returns the median, 95th percentile and maximum of a stage over the
+    # last TIMING_WINDOW frames, or None if it hasn't been timed
+    def Percentiles(self, stage):
+        with self.lock:
+            return Percentiles(list(self.recent.get(stage, ())))
+
+    # Describes the time for each image, e.g. for the display
+    def CycleText(self):
+        stats = self.Percentiles("cycle")
+        if stats is None:
+            return ""
+        with self.lock:
+            last = self.frames[-1]["cycle"]
+        return "Cycle %.1f s (median %.1f s, 95%% %.1f s)" % \
+            ((last,) + stats[:2])
+
+    # Summary of each stage over the whole session
+    def Summary(self):
+        with self.lock:
+            frames = list(self.frames)
+        stages = [stage for stage in TIMING_STAGES
+                  if any(stage in frame for frame in frames)]
+        for frame in frames:
+            stages += [stage for stage in frame
+                       if stage not in ("frame", "time") and
+                       stage not in stages]
+        summary = {}
+        for stage in stages:
+            values = [frame[stage] for frame in frames if stage in frame]
+            p50, p95, largest = Percentiles(values)
+            summary[stage] = {"count": len(values),
+                              "mean": sum(values) / len(values),
+                              "p50": p50, "p95": p95, "max": largest}
+        return frames, stages, summary
+
+    # Writes the report to directory as session-<date and time>.json (the
+    # summary of each stage), .csv (the stages of each frame) and, if
+    # profiling, .prof (for pstats). Returns the name of the JSON file.
+    def Write(self, directory):
+        frames, stages, summary = self.Summary()
+        if not frames:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, "session-" + time.strftime(
+            "%Y%m%d-%H%M%S", time.localtime(self.began)))
+        with open(base + ".json", "w") as f:
+            json.dump({"started": self.began, "finished": clock.time(),
+                       "frames": len(frames), "stages": summary}, f,
+                      indent=1)
+        with open(base + ".csv", "w") as f:
+            f.write(",".join(["frame", "time"] + stages) + "\n")
+            for frame in frames:
+                f.write(",".join([str(frame["frame"]), "%.3f" % frame["time"]] +
+                                 ["%.4f" % frame[stage] if stage in frame
+                                  else "" for stage in stages]) + "\n")
+        if self.profiler is not None:
+            self.profiler.dump_stats(base + ".prof")
+        return base + ".json"
+
+# Order of the stages in the report
+TIMING_STAGES = ("cycle", "slew", "exposure", "header", "imagelink",
+                 "results", "transfer", "read", "track", "pasolve",
+                 "rotation", "dispatch", "photon")
+
+# Returns the median, 95th percentile and maximum of values, or None if
+# there are none
+def Percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    def rank(p):
+        return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+    return rank(0.5), rank(0.95), values[-1]
+
+# Times the current session. Set up by AlignmentSession.
+timing = StageTimer()
+
+# Writes the timing report for the session, if there is anything in it
+def WriteTimingReport():
+    if not TIMING_DIR:
+        return
+    try:
+        path = timing.Write(TIMING_DIR)
+    except OSError as e:
+        print(logtime() + "Cannot write the timing report: " + str(e))
+        return
+    if path is not None:
+        sessionlog.info("Timing report written to " + path)
+        _, _, summary = timing.Summary()
+        for stage, stats in summary.items():
+            sessionlog.info("%-9s n %4d median %7.3f s 95%% %7.3f s max "
+                            "%7.3f s", stage, stats["count"], stats["p50"],
+                            stats["p95"], stats["max"])
+
+# Events for the display are put on queue. Set up by AlignmentSession.
+queue = EventBus()
+
+# Create an event to signal the thread to stop
+stop_event = threading.Event()
+
+# Create flag to indicate whether process is running
+async_running = False
+
+# Called when the PA routine finishes, e.g. so the UI can reset its buttons
+on_finish = None
+
+# Subframe settings before SetROI changed them, to be put back afterwards
+initsubframe = None
+
+# Utility code to be used by the PA routines
+
+# Has the stop event been set? If so returns true.
+# The PA routine then has the accoutability to tidy up and stop running
+def end_async_code_check():
+    if isinstance(tsx, TSXReplay) and tsx.Stopped():
+        stop_event.set()
+    if stop_event.is_set():
+        if recorder is not None:
+            recorder.Stop()
+        return True
+    return False
+
+# Waits for seconds, or until the PA routine is asked to stop. Returns
+# True if it has been.
+def StopWait(seconds):
+    if clock is time:
+        stop_event.wait(seconds)
+    else:
+        clock.sleep(seconds)
+    return end_async_code_check()
+
+# Called when the PA routine is done and tidied up. Resets the flag and
+# lets whoever started the routine know, with a Finished event and by
+# calling on_finish (from the PA thread). Accountability of RunPolarAlign
+# since the UI can't know when the imaging stops
+def finish_async_code():
+    global async_running
+    async_running = False
+    queue.put(Finished(clock.time()))
+    if on_finish is not None:
+        on_finish()
+
+# Code from here down is used to interact with The Sky X.
+
+# Raised when TSX cannot be reached, or the connection fails part way
+# through a command
+class TSXConnectionError(Exception):
+    pass
+
+# Raised when TSX does not reply to a command in time
+class TSXTimeoutError(TSXConnectionError):
+    pass
+
+# Raised when a session being replayed no longer does what was recorded
+class ReplayError(TSXConnectionError):
+    pass
+
+# Raised when a command is abandoned because the PA routine has been asked
+# to stop
+class TSXCancelled(Exception):
+    pass
+
+# Pattern found at the end of every complete reply from TSX
+TSX_REPLY_END = re.compile(rb"Error = -?\d+\.\s*$")
+
+# A connection to the TSX TCP server which is kept open and reused for
+# each command rather than opening a new socket every time. If TSX has
+# dropped the connection it is reopened and the command sent again.
+class TSXSession:
+    BUFFER_SIZE = 4096
+
+    def __init__(self, host=TSX_HOST, port=TSX_PORT, timeout=TSX_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.close()
+        try:
+            self.sock = socket.create_connection((self.host, self.port), \
+                                                 timeout=self.timeout)
+        except OSError as e:
+            self.sock = None
+            raise TSXConnectionError("Could not connect to TSX at " + \
+                                     self.host + ":" + str(self.port) + \
+                                     ": " + str(e))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    # Sends a script and returns the full reply as a string. timeout is
+    # the number of seconds to wait for the reply (default self.timeout).
+    # If cancel (a threading.Event) is set before the reply arrives, the
+    # connection is dropped and TSXCancelled raised - TSX carries on with
+    # the script regardless.
+    def send(self, message, timeout=None, cancel=None):
+        if recorder is None:
+            return self._send(message, timeout, cancel)
+        sent = time.time()
+        start = time.monotonic()
+        try:
+            reply = self._send(message, timeout, cancel)
+        except (TSXConnectionError, TSXCancelled) as e:
+            recorder.Exchange(sent, time.monotonic() - start, message, error=e)
+            raise
+        recorder.Exchange(sent, time.monotonic() - start, message, reply)
+        return reply
+
+    def _send(self, message, timeout=None, cancel=None):
+        if timeout is None:
+            timeout = self.timeout
+        if cancel is not None and cancel.is_set():
+            raise TSXCancelled("Stopped before sending to TSX")
+        with self.lock:
+            # Try once on the existing connection, then once more on a
+            # fresh connection in case TSX has closed the old one. Only
+            # if the script couldn't be sent: once it has been, TSX may
+            # have run it, and scripts such as taking an image mustn't be
+            # run twice.
+            for attempt in range(2):
+                if self.sock is not None and self.closed():
+                    self.close()
+                fresh = self.sock is None
+                if fresh:
+                    self.connect()
+                try:
+                    self.sock.settimeout(timeout)
+                    self.sock.sendall(message.encode())
+                except socket.timeout:
+                    self.close()
+                    raise TSXTimeoutError("Could not send to TSX in " + \
+                                          str(timeout) + " seconds")
+                except OSError as e:
+                    self.close()
+                    if fresh:
+                        raise TSXConnectionError("Lost connection to TSX: " + \
+                                                 str(e))
+                    continue
+                break
+
+            try:
+                reply = self._readreply(timeout, cancel)
+            except socket.timeout:
+                # Reply may still arrive later - drop the connection so
+                # it cannot be mistaken for the reply to the next command
+                self.close()
+                raise TSXTimeoutError("No reply from TSX after " + \
+                                      str(timeout) + " seconds")
+            except OSError as e:
+                self.close()
+                raise TSXConnectionError("Lost connection to TSX: " + str(e))
+            if reply is None:
+                # Connection closed before anything was received
+                self.close()
+                raise TSXConnectionError("TSX closed the connection")
+            if verbose: print(reply)
+            return reply
+
+    # Whether the connection can't be used: between scripts TSX sends
+    # nothing, so anything to read means it has closed the connection (or
+    # is a reply too late to use).
+    def closed(self):
+        try:
+            return bool(select.select([self.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    # TSX ends every reply with its error status, e.g.
+    # "value|No error. Error = 0." so read until that has arrived or
+    # TSX closes the connection. Returns None if nothing was received.
+    def _readreply(self, timeout, cancel=None):
+        deadline = time.monotonic() + timeout
+        data = b""
+        while True:
+            if cancel is not None:
+                # Wake up every TSX_POLL seconds to check on cancel
+                self.sock.settimeout(max(0.001, min(TSX_POLL, deadline -
+                                                    time.monotonic())))
+            try:
+                chunk = self.sock.recv(self.BUFFER_SIZE)
+            except socket.timeout:
+                if cancel is None or time.monotonic() >= deadline:
+                    raise
+                if cancel.is_set():
+                    self.close()
+                    raise TSXCancelled("Stopped while waiting for TSX")
+                continue
+            if not chunk:
+                self.close()
+                break
+            data += chunk
+            if TSX_REPLY_END.search(data):
+                break
+        if not data:
+            return None
+        return data.decode(errors="replace")
+
+# The session used by all the routines below
+tsx = TSXSession()
+
+# The next routine is used to send the data to TSX. Stolen with pride from Anat.
+# Variant of TSXSend that puts a try/catch statement in to catch errors
+def TSXSendTry(message, timeout=None, cancel=None):
+    tryMessage = " \
+    /* Java Script */\
+    try { \
+   " + message + " \
+    } \
+    catch (e) { \
+       out = e; \
+    } \
+    "
+    data = tsx.send(tryMessage, timeout, cancel)
+    data2 = data.split("|")
+    return data2
+
+# Several scripts (fragments) can be sent to TSX in one round trip using a
+# TSXBatch. Each fragment is run inside its own try/catch, so an error in
+# one fragment is reported against that fragment only.
+
+# Result of one fragment of a batch. ok is False if TSX raised an error for
+# the fragment, or the reply could not be read, and error says why. value
+# is the reply after passing through the fragment's parse routine.
+TSXResult = collections.namedtuple("TSXResult", ["ok", "value", "error"])
+
+# Separates the replies to each fragment of a batch
+TSX_BATCH_SEP = "#PABATCH#"
+
+class TSXBatch:
+    def __init__(self):
+        self.fragments = []
+        self.parsers = []
+        self.stages = []
+
+    # Adds a fragment of java script. parse is given the reply split at '|'
+    # (as returned by TSXSendTry) and returns the value for the result.
+    # If stage is given, the time TSX takes to run the fragment is added
+    # to that stage of timing. Returns the index of the fragment's result
+    # in the list from run.
+    def add(self, fragment, parse=None, stage=None):
+        self.fragments.append(fragment)
+        self.parsers.append(parse)
+        self.stages.append(stage)
+        return len(self.fragments) - 1
+
+    def timed(self):
+        return any(stage is not None for stage in self.stages)
+
+    # Each fragment is run with eval so that its result is the same value
+    # TSX would have returned if it had been sent on its own. If any are
+    # timed, the milliseconds each took follow the replies.
+    def script(self):
+        lines = ["/* Java Script */", "var PABatch = [];"]
+        if self.timed():
+            lines.append("var PABatchTime = []; var PABatchStart;")
+        for fragment in self.fragments:
+            line = "try { PABatch.push('0' + String(eval(" + \
+                json.dumps(fragment) + "))); } " + \
+                "catch (e) { PABatch.push('1' + String(e)); }"
+            if self.timed():
+                line = "PABatchStart = Date.now(); " + line + \
+                    " PABatchTime.push(Date.now() - PABatchStart);"
+            lines.append(line)
+        if self.timed():
+            lines.append("PABatch.push(PABatchTime.join(','));")
+        lines.append("PABatch.join('" + TSX_BATCH_SEP + "');")
+        return "\n".join(lines)
+
+    # Adds the time each timed fragment took to its stage, and the rest of
+    # the round trip to transfer
+    def addtimes(self, times, seconds):
+        try:
+            times = [float(t) / 1000.0 for t in times.split(",")]
+        except ValueError:
+            return
+        if len(times) != len(self.fragments):
+            return
+        for stage, t in zip(self.stages, times):
+            if stage is not None:
+                timing.Add(stage, t)
+        timing.Add("transfer", max(0.0, seconds - sum(times)))
+
+    # Sends all the fragments in one go and returns a list of TSXResult,
+    # one for each fragment in the order they were added. timeout and
+    # cancel are as for TSXSession.send.
+    def run(self, timeout=None, cancel=None):
+        start = clock.monotonic()
+        reply = tsx.send(self.script(), timeout, cancel)
+        seconds = clock.monotonic() - start
+        # The TSX error status follows the last '|'
+        body, sep, status = reply.rpartition("|")
+        parts = body.split(TSX_BATCH_SEP)
+        if sep and self.timed() and len(parts) == len(self.fragments) + 1:
+            self.addtimes(parts.pop(), seconds)
+        if not sep or len(parts) != len(self.fragments):
+            # The batch failed as a whole, so report it for every fragment
+            return [TSXResult(False, None, status.strip())] * \
+                len(self.fragments)
+
+        results = []
+        for part, parse in zip(parts, self.parsers):
+            if part[:1] != "0":
+                results.append(TSXResult(False, None, part[1:]))
+                continue
+            data = part[1:].split("|")
+            if parse is None:
+                results.append(TSXResult(True, data, None))
+                continue
+            try:
+                results.append(TSXResult(True, parse(data), None))
+            except (ValueError, IndexError) as e:
+                results.append(TSXResult(False, None, "Could not read " + \
+                                         part[1:] + ": " + str(e)))
+        return results
+
+# Returns the reply to a fragment in the same form as TSXSendTry, using
+# the error message as the reply if the fragment failed
+def BatchData(result):
+    if result.ok:
+        return result.value
+    return [result.error]
+
+######################### RECORD AND REPLAY ############################
+# A session can be recorded in a trace file: every script sent to TSX and
+# its reply (or error), when it was sent and how long the reply took, what
+# was read from the image files and when the routine was asked to stop.
+# The first line has the settings, the device cache and anything else
+# carried over from earlier sessions. A trace is gzipped JSON, one line per
+# record, and is replayed by TSXReplay in place of TSX.
+
+# Settings recorded with a trace, and used when it is replayed
+RECORD_SETTINGS = ("TSX_HOST", "TSX_PORT", "CAM_DURATION", "CAM_BINNING",
+                   "CAM_SCALE", "CAM_FILTER", "CAM_PIPELINE", "CAM_TRACK",
+                   "TRACK_METHOD", "TRACK_SOLVE_EVERY", "CAM_AUTO",
+                   "CAM_MIN_DURATION", "CAM_MAX_DURATION", "CAM_MAX_BINNING",
+                   "CAM_ROI", "ROI_STARS", "ROI_MIN_FIELD", "PA_DEC", "HAI1",
+                   "HAI2", "PLAN_POINTS", "PLAN_ACCURACY", "PLAN_NOISE",
+                   "PLAN_MIN_ALT", "PLAN_MIN_HA", "PLAN_MAX_HA",
+                   "PLAN_MIN_DEC", "PLAN_MAX_DEC", "PLAN_ADJUST_TIME",
+                   "PLAN_SLEW_RATE", "PLAN_SETTLE", "ROT_SOLVER", "AXIS_FIT",
+                   "SMOOTH", "usenumpy", "simulating", "keepfiles")
+
+class TraceRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.file = gzip.open(path, "wt")
+        devicecache.Load()
+        self.Write({"trace": 1, "started": time.time(),
+                    "settings": {name: globals()[name]
+                                 for name in RECORD_SETTINGS},
+                    "cache": devicecache.values, "site": site,
+                    "localheaders": localheaders})
+
+    def Write(self, record):
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record, separators=(",", ":"),
+                                           default=float) + "\n")
+
+    # A script sent to TSX at time sent, which took seconds to reply
+    def Exchange(self, sent, seconds, message, reply=None, error=None):
+        record = {"t": sent, "d": seconds, "q": message}
+        if error is None:
+            record["r"] = reply
+        else:
+            record["e"] = str(error)
+            if isinstance(error, TSXCancelled):
+                record["x"] = "cancelled"
+            elif isinstance(error, TSXTimeoutError):
+                record["x"] = "timeout"
+            else:
+                record["x"] = "connection"
+        self.Write(record)
+
+    # Something (kind) read from an image file, or the error reading it
+    def File(self, kind, path, value=None, error=None):
+        record = {"t": time.time(), "f": kind, "p": path}
+        if error is None:
+            record["v"] = value
+        else:
+            record["e"] = str(error)
+        self.Write(record)
+
+    # The routine has been asked to stop
+    def Stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.Write({"t": time.time(), "stop": True})
+
+    def Close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+# The session being recorded, if any
+recorder = None
+
+# Starts recording a session in RECORD_DIR, removing the oldest
+# recordings so no more than RECORD_KEEP are kept
+def StartRecording():
+    global recorder
+    if not RECORD_DIR or isinstance(tsx, TSXReplay):
+        return
+    try:
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        old = sorted(f for f in os.listdir(RECORD_DIR)
+                     if f.startswith("session-") and f.endswith(".trace.gz"))
+        for name in old[:max(0, len(old) - RECORD_KEEP + 1)]:
+            os.remove(os.path.join(RECORD_DIR, name))
+        path = os.path.join(RECORD_DIR, "session-" + time.strftime(
+            "%Y%m%d-%H%M%S") + ".trace.gz")
+        recorder = TraceRecorder(path)
+    except OSError as e:
+        print(logtime() + "Cannot record the session: " + str(e))
+        return
+    sessionlog.info("Recording the session in " + path)
+
+def StopRecording():
+    global recorder
+    if recorder is not None:
+        recorder.Close()
+        recorder = None
+
+# Reads something (kind) from the image file path with read(path),
+# recording it when recording. When replaying, it comes from the trace
+# instead. Unless keep is True only whether it could be read is recorded,
+# and the path is returned when replaying (e.g. for whole images, which
+# are only compared using Traced too).
+def Traced(kind, path, read, keep=True):
+    if isinstance(tsx, TSXReplay):
+        value = tsx.File(kind, path)
+        return value if keep else path
+    try:
+        value = read(path)
+    except (OSError, ValueError, KeyError) as e:
+        if recorder is not None:
+            recorder.File(kind, path, error=e)
+        raise
+    if recorder is not None:
+        recorder.File(kind, path, value if keep else None)
+    return value
+
+# Numbers in scripts, which may differ a little when a session is replayed
+# (e.g. the RA to slew to is worked out from the time)
+SCRIPT_NUMBER = re.compile(r"\d+(\.\d*)?([eE][-+]?\d+)?")
+
+# Stands in for TSXSession, replaying a recorded session. Each script sent
+# must be the next one in the trace, apart from the numbers in it, and gets
+# the recorded reply after the recorded time. It is also the clock of the
+# PA routine (see clock): time starts from when the session was recorded,
+# and each script is sent no earlier than it was when recorded, so the
+# routine sees the same times. If fast is True, waiting for TSX, for the
+# recorded time and sleeping take no time at all, so only the time spent
+# working things out is real.
+class TSXReplay:
+    def __init__(self, path, fast=False):
+        with gzip.open(path, "rt") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        if not records or records[0].get("trace") != 1:
+            raise ValueError(path + " is not a trace")
+        self.header = records[0]
+        self.records = records[1:]
+        self.next = 0
+        self.fast = fast
+        self.lock = threading.Lock()
+        self.host = self.header["settings"]["TSX_HOST"]
+        self.port = self.header["settings"]["TSX_PORT"]
+        self.timeout = TSX_TIMEOUT
+        self.offset = self.header["started"] - time.time()
+        self.moffset = 0.0
+
+    def time(self):
+        return time.time() + self.offset
+
+    def monotonic(self):
+        return time.monotonic() + self.moffset
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        if self.fast:
+            self.offset += seconds
+            self.moffset += seconds
+        else:
+            time.sleep(seconds)
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    # Returns the next record, which must have key
+    def Next(self, key, what):
+        if self.next >= len(self.records):
+            raise ReplayError("The trace has ended, expected " + what)
+        record = self.records[self.next]
+        if key not in record:
+            raise ReplayError("Record %d of the trace is not %s" %
+                              (self.next + 1, what))
+        self.next += 1
+        return record
+
+    def send(self, message, timeout=None, cancel=None):
+        with self.lock:
+            record = self.Next("q", "a script")
+            if SCRIPT_NUMBER.sub("#", record["q"]) != \
+               SCRIPT_NUMBER.sub("#", message):
+                raise ReplayError("Script %d differs from the trace" %
+                                  self.next)
+            self.sleep(record["t"] - self.time())
+            self.sleep(record["d"])
+            if "e" in record:
+                if record["x"] == "cancelled":
+                    raise TSXCancelled(record["e"])
+                if record["x"] == "timeout":
+                    raise TSXTimeoutError(record["e"])
+                raise TSXConnectionError(record["e"])
+            if verbose: print(record["r"])
+            return record["r"]
+
+    def File(self, kind, path):
+        with self.lock:
+            record = self.Next("f", "reading " + kind)
+            if record["f"] != kind:
+                raise ReplayError("Record %d of the trace is reading %s, "
+                                  "not %s" % (self.next, record["f"], kind))
+            self.sleep(record["t"] - self.time())
+            if "e" in record:
+                raise OSError(record["e"])
+            return record["v"]
+
+    # True when the recorded session was asked to stop at this point
+    def Stopped(self):
+        with self.lock:
+            if self.next < len(self.records) and \
+               "stop" in self.records[self.next]:
+                self.next += 1
+                return True
+            return False
+
+    # Records left over once the session has finished
+    def Remaining(self):
+        return len(self.records) - self.next
+
+# Replays the session recorded in path instead of using TSX, with the
+# settings it was recorded with
+def StartReplay(path, fast=False):
+    global tsx, clock, site, localheaders
+    replay = TSXReplay(path, fast)
+    for name, value in replay.header["settings"].items():
+        if name in RECORD_SETTINGS:
+            globals()[name] = value
+    tsx = replay
+    clock = replay
+    devicecache.path = None
+    devicecache.values = dict(replay.header["cache"] or {})
+    site = tuple(replay.header["site"]) if replay.header["site"] else None
+    localheaders = replay.header["localheaders"]
+
+# Facts about the devices which rarely change (the filter names and the
+# site) are kept in a DeviceCache so they needn't be read
+# from TSX every session. Each is kept for its time in CACHE_TTL, and is
+# dropped when the script changes it or finds it is wrong. They are saved
+# in CACHE_FILE between runs, separately for each TSX host and port.
+class DeviceCache:
+    def __init__(self, path):
+        self.path = path
+        self.values = None # Key -> [value, time it expires]
+
+    # TSX the values are for
+    def Host(self):
+        return TSX_HOST + ":" + str(TSX_PORT)
+
+    # Reads the saved values the first time they are needed
+    def Load(self):
+        if self.values is None:
+            self.values = {}
+            try:
+                with open(self.path) as f:
+                    self.values = dict(json.load(f).get(self.Host(), {}))
+            except (OSError, ValueError, TypeError, AttributeError):
+                pass
+
+    # Returns the value of key, or None if it isn't known or has expired
+    def Get(self, key):
+        self.Load()
+        entry = self.values.get(key)
+        if entry is None or entry[1] < clock.time():
+            return None
+        return entry[0]
+
+    def Set(self, key, value):
+        self.Load()
+        self.values[key] = [value, clock.time() + CACHE_TTL.get(key, 0)]
+
+    def Invalidate(self, key):
+        self.Load()
+        self.values.pop(key, None)
+
+    # Saves the values, keeping those for other hosts. Other copies of the
+    # script may be saving theirs at the same time (see PASite.py), so the
+    # file is read, changed and replaced holding a lock on path + ".lock" -
+    # otherwise one could replace the file with a copy read before another
+    # saved to it. Each writes its own temporary file.
+    def Save(self):
+        if self.values is None or not self.path:
+            return
+        temp = self.path + ".%d.tmp" % os.getpid()
+        try:
+            with open(self.path + ".lock", "a") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(self.path) as f:
+                        saved = json.load(f)
+                    if not isinstance(saved, dict):
+                        saved = {}
+                except (OSError, ValueError):
+                    saved = {}
+                saved[self.Host()] = self.values
+                with open(temp, "w") as f:
+                    json.dump(saved, f)
+                os.replace(temp, self.path)
+        except OSError as e:
+            if verbose: print("Could not save device cache: " + str(e))
+
+devicecache = DeviceCache(CACHE_FILE)
+
+# Routines for connecting equipment
+
+# Scripts used to bring up the equipment. These can be sent on their own
+# with TSXSendTry or together in a TSXBatch.
+CONNECT_SCOPE_SCRIPT = " \
+    /* Java Script */\
+    sky6RASCOMTele.Connect();\
+    "
+
+CONNECT_CAMERA_SCRIPT = " \
+    /* Java Script */\
+    ccdsoftCamera.Connect();\
+    "
+
+CONNECT_FILTERWHEEL_SCRIPT = " \
+    /* Java Script */\
+    ccdsoftCamera.filterWheelConnect();\
+    "
+
+GET_FILTER_SCRIPT = " \
+    /* Java Script */\
+    out = ccdsoftCamera.FilterIndexZeroBased;\
+    "
+
+# Returns the names of all the filters separated by '|'
+FILTER_NAMES_SCRIPT = " \
+    /* Java Script */\
+    var names = \"\";\
+    var n = ccdsoftCamera.lNumberFilters;\
+    for (var i = 0; i < n; i++) {\
+        if (i > 0) names += \"|\";\
+        names += ccdsoftCamera.szFilterName(i);\
+    }\
+    out = names;\
+    "
+
+GET_BIN_SCRIPT = " \
+    /* Java Script */\
+    out = ccdsoftCamera.BinX;\
+    "
+
+# Routines to check the replies from the connect scripts. Return 0 if the
+# device connected, otherwise report the error and return 1.
+def CheckConnectScope(data):
+    if data[0] != "undefined":
+        queue.put("!"+logtime() + "Could not connect scope: "+ data[0])
+        return 1
+    queue.put(logtime() + "Scope Connected")
+    return 0
+
+def CheckConnectFilterwheel(data):
+    if data[0] != "0":
+        queue.put("!"+logtime() + "Could not connect filterwheel: "+ data[0])
+        return 1
+    queue.put(logtime() + "Filterwheel connected")
+    return 0
+
+def CheckConnectCamera(data):
+    if data[0] != "0":
+        queue.put("!"+logtime() + "Could not connect camera: "+ data[0])
+        return 1
+    queue.put(logtime() + "Camera connected")
+    return 0
+
+def connectscope():
+    return CheckConnectScope(TSXSendTry(CONNECT_SCOPE_SCRIPT))
+
+def connectfilterwheel():
+    return CheckConnectFilterwheel(TSXSendTry(CONNECT_FILTERWHEEL_SCRIPT))
+
+def connectcamera():
+    return CheckConnectCamera(TSXSendTry(CONNECT_CAMERA_SCRIPT))
+
+# Selects the filter by name. names is the list of filter names if already
+# known, otherwise it is read from TSX along with the initial filter
+# position (so it can be reset later).
+def setfilter(filter, names=None):
+    global initfilter
+    if names is None:
+        initfilter = int(TSXSendTry(GET_FILTER_SCRIPT)[0])
+        # Last entry is the TSX error status
+        names = TSXSendTry(FILTER_NAMES_SCRIPT)[:-1]
+
+    # Now look for filter name
+    if filter not in names:
+        queue.put("!"+logtime() + "Could not find filter: "+ filter)
+        return 1
+
+    ifilter = names.index(filter)
+    respond = TSXSendTry("ccdsoftCamera.FilterIndexZeroBased = " + \
+                         str(ifilter) + ";")
+    if respond[0] == str(ifilter):
+        queue.put(logtime() + "Selected filter: " + filter)
+        return 0
+
+    queue.put("!"+logtime() + "Could not set filter: "+ filter + \
+              " Err code: "+ respond[0])
+    return 1
+
+# Precesses a point near the pole, to check TSX and Astrometry agree
+PRECESS_CHECK_RA  = 6.0
+PRECESS_CHECK_DEC = 60.0
+PRECESS_CHECK_SCRIPT = " \
+    /* Java Script */\
+    sky6Utils.Precess2000ToNow(" + str(PRECESS_CHECK_RA) + ", " + \
+        str(PRECESS_CHECK_DEC) + ");\
+    out = sky6Utils.dOut0 + '|' + sky6Utils.dOut1;\
+    "
+
+# Warns if TSX's precession differs from the one worked out here by more
+# than an arcsec, e.g. because TSX also allows for aberration
+def CheckPrecession(data):
+    ra, dec = Astrometry.Precess2000ToNow(PRECESS_CHECK_RA, PRECESS_CHECK_DEC)
+    diff = math.hypot((float(data[0]) - ra) * 15.0 * cosd(dec),
+                      float(data[1]) - dec)
+    if diff * 3600.0 > 1.0:
+        queue.put(logtime() + "Precession differs from TSX by " + \
+                  DegFormat(diff))
+
+# Reads the local sidereal time, when the site is already known
+LST_SCRIPT = " \
+    /* Java Script */\
+    sky6Utils.ComputeLocalSiderealTime();\
+    out = sky6Utils.dOut0;\
+    "
+
+# Script to select filter number i, if it is still called name. Returns
+# the name of filter i and the filter now selected.
+def SelectFilterScript(i, name):
+    return " \
+    /* Java Script */\
+    var PAName = ccdsoftCamera.szFilterName(" + str(i) + ");\
+    if (PAName == " + json.dumps(name) + ") \
+        ccdsoftCamera.FilterIndexZeroBased = " + str(i) + ";\
+    out = PAName + '|' + ccdsoftCamera.FilterIndexZeroBased;\
+    "
+
+# Connects the scope, camera and (if needed) filter wheel, stores the
+# initial bin and filter positions and the site, then selects the filter.
+# The filter names and site are taken from devicecache if known, and the
+# filter is then selected in the same round trip to TSX after checking its
+# name. Otherwise they are read, which takes one more round trip to set
+# the filter. Returns "" if all went well, otherwise a message saying what
+# to check.
+def BringUpDevices():
+    global initbin, initfilter
+    names = devicecache.Get("filters") if CAM_FILTER != "" else None
+    if names is not None and CAM_FILTER not in names:
+        names = None
+    cachedsite = devicecache.Get("site")
+
+    batch = TSXBatch()
+    if cachedsite is None:
+        isite = batch.add(LAT_LONG_LST_UT_SCRIPT, ParseLatLongLstUT)
+    else:
+        isite = batch.add(LST_SCRIPT, lambda data: (cachedsite[0], \
+                                cachedsite[1], float(data[0]), None))
+    iprecess = batch.add(PRECESS_CHECK_SCRIPT)
+    ibin   = batch.add(GET_BIN_SCRIPT, lambda data: int(data[0]))
+    iscope = batch.add(CONNECT_SCOPE_SCRIPT)
+    icam   = batch.add(CONNECT_CAMERA_SCRIPT)
+    if CAM_FILTER != "":
+        iwheel  = batch.add(CONNECT_FILTERWHEEL_SCRIPT)
+        ifilter = batch.add(GET_FILTER_SCRIPT, lambda data: int(data[0]))
+        if names is None:
+            inames = batch.add(FILTER_NAMES_SCRIPT)
+        else:
+            iselect = batch.add(SelectFilterScript(names.index(CAM_FILTER),
+                                                   CAM_FILTER),
+                                lambda data: (data[0], int(data[1])))
+    results = batch.run()
+
+    if results[isite].ok:
+        lat, lon, lst, ut = results[isite].value
+        SetSite(lat, lon, lst)
+        if cachedsite is None:
+            devicecache.Set("site", [lat, lon])
+    if results[iprecess].ok:
+        CheckPrecession(results[iprecess].value)
+    if not results[isite].ok:
+        queue.put("!"+logtime() + "Could not read the site and LST: " + \
+                  results[isite].error)
+        return "Check the location is set in TSX"
+
+    if CheckConnectScope(BatchData(results[iscope])):
+        return "Ensure Scope Connected Properly"
+    if CheckConnectCamera(BatchData(results[icam])):
+        return "Ensure Camera Connected Properly"
+    if not results[ibin].ok:
+        queue.put("!"+logtime() + "Could not read camera binning: " + \
+                  results[ibin].error)
+        return "Ensure Camera Connected Properly"
+    initbin = results[ibin].value
+
+    if CAM_FILTER != "":
+        if CheckConnectFilterwheel(BatchData(results[iwheel])):
+            return "Ensure FilterWheel Connected Properly"
+        if not results[ifilter].ok:
+            return "Could not set filter - check filter name"
+        initfilter = results[ifilter].value
+
+        if names is not None:
+            if results[iselect].ok and \
+               results[iselect].value == (CAM_FILTER,
+                                          names.index(CAM_FILTER)):
+                queue.put(logtime() + "Selected filter: " + CAM_FILTER)
+                devicecache.Save()
+                return ""
+            # The filters have changed, so read them again
+            devicecache.Invalidate("filters")
+            names = TSXSendTry(FILTER_NAMES_SCRIPT)[:-1]
+        elif results[inames].ok:
+            names = results[inames].value
+        else:
+            return "Could not set filter - check filter name"
+        devicecache.Set("filters", names)
+        if setfilter(CAM_FILTER, names):
+            return "Could not set filter - check filter name"
+    devicecache.Save()
+    return ""
+
+def unpark( ):
+    MESSAGE = " \
+    /* Java Script */\
+    sky6RASCOMTele.Connect();\
+    sky6RASCOMTele.Unpark();\
+    "
+    return TSXSendTry(MESSAGE)
+
+def GetImageBin():
+    bin = int(TSXSendTry(GET_BIN_SCRIPT)[0])
+    return bin
+
+def SetImageBin(bin):
+    MESSAGE = " \
+    /* Java Script */\
+    ccdsoftCamera.BinX = " + str(bin) + " ;\
+    ccdsoftCamera.BinY = " + str(bin) + " ;\
+    "
+    return TSXSendTry(MESSAGE)
+
+# Script to set the binning back to bin, if it has been changed
+def RestoreBinScript(bin):
+    return " \
+    /* Java Script */\
+    if (ccdsoftCamera.BinX != " + str(bin) + " || \
+        ccdsoftCamera.BinY != " + str(bin) + ") {\
+        ccdsoftCamera.BinX = " + str(bin) + ";\
+        ccdsoftCamera.BinY = " + str(bin) + ";\
+    }\
+    out = ccdsoftCamera.BinX;\
+    "
+
+# Script to select filter number i again, if it has been changed
+def RestoreFilterScript(i):
+    return " \
+    /* Java Script */\
+    if (ccdsoftCamera.FilterIndexZeroBased != " + str(i) + ") \
+        ccdsoftCamera.FilterIndexZeroBased = " + str(i) + ";\
+    out = ccdsoftCamera.FilterIndexZeroBased;\
+    "
+
+# Reads the subframe settings and the size of the sensor
+SUBFRAME_SCRIPT = " \
+    /* Java Script */\
+    out = ccdsoftCamera.Subframe + '|' + \
+          ccdsoftCamera.SubframeLeft + '|' + \
+          ccdsoftCamera.SubframeTop + '|' + \
+          ccdsoftCamera.SubframeRight + '|' + \
+          ccdsoftCamera.SubframeBottom + '|' + \
+          ccdsoftCamera.WidthInPixels + '|' + \
+          ccdsoftCamera.HeightInPixels;\
+    "
+
+def ParseSubframe(data):
+    return (data[0] in ("1", "true"),) + tuple(int(float(d)) for d in data[1:7])
+
+# Script to turn the subframe on or off and set its edges, in unbinned
+# pixels
+def SetSubframeScript(on, left, top, right, bottom):
+    return " \
+    /* Java Script */\
+    ccdsoftCamera.Subframe = " + ("true" if on else "false") + ";\
+    ccdsoftCamera.SubframeLeft = " + str(left) + ";\
+    ccdsoftCamera.SubframeTop = " + str(top) + ";\
+    ccdsoftCamera.SubframeRight = " + str(right) + ";\
+    ccdsoftCamera.SubframeBottom = " + str(bottom) + ";\
+    "
+
+# Reads out only as much of the sensor as is needed to plate solve, from
+# the number of stars found in the last plate solve (stars) and its scale
+# in arcsec/pixel at binning bin. The subframe is centred on the area the
+# stars were found in, which is the user's own subframe if one is set, and
+# holds about ROI_STARS stars but is never less than ROI_MIN_FIELD arcmin
+# across. The settings are kept so RestoreCameraState can put them back.
+# If the camera can't use a subframe the whole image is read out.
+def SetROI(stars, scale, bin):
+    global initsubframe
+    batch = TSXBatch()
+    isub = batch.add(SUBFRAME_SCRIPT, ParseSubframe)
+    result = batch.run()[isub]
+    if not result.ok:
+        queue.put("<" + logtime() + "Could not read the subframe, so " + \
+                  "reading out the whole image: " + result.error + ">")
+        return
+    current = result.value
+    if current[0]:
+        left, top, right, bottom = current[1:5]
+    else:
+        left, top, right, bottom = 0, 0, current[5], current[6]
+    areawidth, areaheight = right - left, bottom - top
+
+    # Stars go up with the area, so shrink each side by the square root
+    fraction = min(1.0, math.sqrt(ROI_STARS / max(stars, 1)))
+    minside = ROI_MIN_FIELD * 60.0 * bin / scale
+    # Keep the sides whole multiples of the largest binning used
+    step = 2 * max(bin, CAM_MAX_BINNING if CAM_AUTO else bin)
+    roiwidth = min(areawidth, max(fraction * areawidth, minside))
+    roiheight = min(areaheight, max(fraction * areaheight, minside))
+    roiwidth = int(math.ceil(roiwidth / step)) * step
+    roiheight = int(math.ceil(roiheight / step)) * step
+    if roiwidth >= areawidth and roiheight >= areaheight:
+        queue.put(logtime() + "Only " + str(stars) + \
+                  " stars found, reading out the whole image")
+        return
+
+    cx, cy = (left + right) // 2, (top + bottom) // 2
+    roileft, roitop = cx - roiwidth // 2, cy - roiheight // 2
+    initsubframe = current[:5]
+    batch = TSXBatch()
+    isub = batch.add(SetSubframeScript(True, roileft, roitop,
+                                       roileft + roiwidth, roitop + roiheight))
+    result = batch.run()[isub]
+    if not result.ok:
+        queue.put("<" + logtime() + "Could not set the subframe, so " + \
+                  "reading out the whole image: " + result.error + ">")
+        return
+    queue.put(logtime() + "Reading out a " + str(roiwidth) + "x" + \
+              str(roiheight) + " subframe, " + \
+              "%.0f%%" % (100.0 * roiwidth * roiheight /
+                          (areawidth * areaheight)) + " of the image")
+
+# Script to take an image with the given exposure and binning. If
+# asynchronous is True, TSX returns as soon as the exposure has started.
+def TakeImageScript(exp, bin, asynchronous=False):
+    return " \
+    /* Java Script */\
+    ccdsoftCamera.Connect();\
+    ccdsoftCamera.Asynchronous = " + ("true" if asynchronous else "false") + "; \
+    ccdsoftCamera.ExposureTime = " + str(exp) + ";  \
+    ccdsoftCamera.AutoSaveOn = true;\
+    ccdsoftCamera.ImageReduction = 0;   \
+    ccdsoftCamera.Frame = 1;\
+    ccdsoftCamera.Delay = 0;\
+    ccdsoftCamera.BinX = " + str(bin) + " ;\
+    ccdsoftCamera.BinY = " + str(bin) + " ;\
+    ccdsoftCamera.TakeImage();\
+    "
+
+def takeimagebin( exp, bin ):
+    try:
+        tsx.send(TakeImageScript(exp, bin), exp+60)
+    except TSXTimeoutError:
+        print(logtime() + "Timeout from camera.")
+    return
+
+# Script to plate solve the last image taken
+def ImageLinkScript(scale):
+    return " \
+    /* Java Script */\
+    ccdsoftCameraImage.AttachToActiveImager();\
+    ImageLink.pathToFITS = ccdsoftCameraImage.Path;\
+    ImageLink.scale = " + str(scale) + ";\
+    ImageLink.unknownScale = 0;\
+    ImageLink.execute();\
+    "
+
+# Next routine plate solves the last image
+def ImageLinkLastImage(scale):
+    data = TSXSendTry(ImageLinkScript(scale))
+    if data[0] != "undefined":
+        print(logtime()+ data[0])
+        return 1
+    return 0
+
+# Reads the HA and LST from the header of the last image
+IMAGE_HA_LST_SCRIPT = " \
+    /* Java Script */\
+    ccdsoftCameraImage.AttachToActiveImager();\
+    ha = ccdsoftCameraImage.FITSKeyword(\"TELEHA\");\
+    lst = ccdsoftCameraImage.FITSKeyword(\"LST\");\
+    out = ha + '|' + lst;\
+    "
+
+def ParseImageHAandLST(data):
+    return HMSToDecimal(data[0]), HMSToDecimal(data[1])
+
+# True while the image headers can be read here. If TSX is on another
+# computer they can't, and TSX reads them in the same round trip as the
+# plate solve instead.
+localheaders = True
+
+# Adds a fragment to batch to read the HA and LST of an image, if they
+# can't be read here. path is the image file, or None for the last image.
+# Returns the index of the fragment, or None if not needed.
+def AddHAandLST(batch, path=None):
+    if simulating or localheaders:
+        return None
+    if path is None:
+        return batch.add(IMAGE_HA_LST_SCRIPT, ParseImageHAandLST, "header")
+    return batch.add(ImageHAandLSTScript(path), ParseImageHAandLST, "header")
+
+# Returns the HA and LST of the image in path, from the fragment added by
+# AddHAandLST (index ihalst) or read from its header here. Simulated (DSS)
+# images have no HA and LST, so ha is None and lst is the current LST.
+def ReadHAandLST(results, ihalst, path):
+    global localheaders
+    if ihalst is not None:
+        if results[ihalst].ok:
+            return results[ihalst].value
+        print(logtime() + "Could not read image HA and LST: " + \
+              results[ihalst].error)
+        return None, None
+    if simulating:
+        return None, LatLongLstUT()[2]
+    if path is None:
+        return None, None
+    try:
+        with timing.Stage("header"):
+            return tuple(Traced("header", path, Astrometry.ImageHAandLST))
+    except (OSError, ValueError, KeyError) as e:
+        print(logtime() + "Can't read image header, TSX will read it: " + \
+              str(e))
+        localheaders = False
+        data = TSXSendTry(ImageHAandLSTScript(path))
+        try:
+            return ParseImageHAandLST(data)
+        except (ValueError, IndexError):
+            print(logtime() + "Could not read image HA and LST: " + data[0])
+            return None, None
+
+# Next routine gets the actual HA of the image
+def GetImageHAandLST():
+    return ParseImageHAandLST(TSXSendTry(IMAGE_HA_LST_SCRIPT))
+
+def takeimage( exp ):
+    MESSAGE = " \
+    /* Java Script */\
+    ccdsoftCamera.Connect();\
+    ccdsoftCamera.Asynchronous = false; \
+    ccdsoftCamera.ExposureTime = " + str(exp) + ";  \
+    ccdsoftCamera.AutoSaveOn = true;\
+    ccdsoftCamera.ImageReduction = 0;   \
+    ccdsoftCamera.Frame = 1;\
+    ccdsoftCamera.Delay = 0;\
+    ccdsoftCamera.Subframe = false;\
+    ccdsoftCamera.BinX = 1;\
+    ccdsoftCamera.BinY = 1;\
+    ccdsoftCamera.TakeImage();\
+    "
+    try:
+        tsx.send(MESSAGE, exp+60)
+    except TSXTimeoutError:
+        print(logtime() + "Timeout from camera.")
+    return
+
+# Function to attempt flats:
+# The slew is started asynchronously and checked on every TSX_POLL seconds,
+# so it can be stopped part way (raising TSXCancelled). Raises
+# TSXTimeoutError if it takes more than TSX_SLEW_TIMEOUT seconds.
+def SlewToRaAndDec(Ra, Dec, Targetname):
+    MESSAGE = " \
+    /* Java Script */\
+    sky6RASCOMTele.Asynchronous = true;\
+    sky6RASCOMTele.SlewToRaDec(" + str(Ra) + ", " + str(Dec) + ",\"" \
+    + Targetname+"\");\
+    "
+    with timing.Stage("slew"):
+        TSXSendTry(MESSAGE)
+        deadline = clock.monotonic() + TSX_SLEW_TIMEOUT
+        while TSXSendTry(SLEW_STATUS_SCRIPT, cancel=stop_event)[0] \
+              not in ("1", "true"):
+            if clock.monotonic() > deadline:
+                raise TSXTimeoutError("Slew not complete after " + \
+                                      str(TSX_SLEW_TIMEOUT) + " seconds")
+            if StopWait(TSX_POLL):
+                raise TSXCancelled("Stopped while slewing")
+
+# Returns whether the slew is complete
+SLEW_STATUS_SCRIPT = " \
+    /* Java Script */\
+    out = sky6RASCOMTele.IsSlewComplete;\
+    "
+
+# Returns whether the exposure and slew are complete, and the name of the
+# last image
+DEVICE_STATUS_SCRIPT = " \
+    /* Java Script */\
+    out = ccdsoftCamera.IsExposureComplete + '|' + \
+          sky6RASCOMTele.IsSlewComplete + '|' + \
+          ccdsoftCamera.LastImageFileName;\
+    "
+
+# Abandons the exposure and slew, if they are in progress
+ABORT_SCRIPT = " \
+    /* Java Script */\
+    if (!ccdsoftCamera.IsExposureComplete) ccdsoftCamera.Abort();\
+    if (!sky6RASCOMTele.IsSlewComplete) sky6RASCOMTele.Abort();\
+    "
+
+# Leaves the camera and mount as TSX normally has them
+SYNCHRONOUS_SCRIPT = " \
+    /* Java Script */\
+    ccdsoftCamera.Asynchronous = false;\
+    sky6RASCOMTele.Asynchronous = false;\
+    "
+
+# Stops the camera and mount once the PA routine has been asked to stop:
+# abandons the exposure or slew in progress, or without STOP_ABORT lets
+# them finish and removes the unused image
+def StopDevices():
+    if STOP_ABORT:
+        TSXSendTry(ABORT_SCRIPT)
+        return
+    deadline = clock.monotonic() + TSX_SLEW_TIMEOUT
+    exposing = False
+    while True:
+        data = TSXSendTry(DEVICE_STATUS_SCRIPT)
+        if len(data) < 3:
+            print(logtime() + "Could not check the camera and mount: " + \
+                  data[0])
+            return
+        exposed, slewed = data[0] in ("1", "true"), data[1] in ("1", "true")
+        exposing = exposing or not exposed
+        if exposed and slewed:
+            break
+        if clock.monotonic() > deadline:
+            print(logtime() + "Camera or mount is taking too long to stop")
+            return
+        clock.sleep(TSX_POLL)
+    if exposing:
+        RemoveImageFiles(data[2])
+
+# Reads the plate solve results and the image file name
+IMAGE_LINK_RESULTS_SCRIPT = " \
+    /* Java Script */\
+    err = ImageLinkResults.errorCode; \
+    ra = ImageLinkResults.imageCenterRAJ2000; \
+    dec = ImageLinkResults.imageCenterDecJ2000;\
+    file = ccdsoftCamera.LastImageFileName;\
+    out = err+ '|' + ra + '|' + dec + '|' + file;\
+    "
+
+# Returns the error code, the RA and Dec precessed to JNow, and the file
+def ParseImageLinkResults(data):
+    ra, dec = Astrometry.Precess2000ToNow(float(data[1]), float(data[2]))
+    return int(data[0]), ra, dec, data[3]
+
+# Removes the image and the SRC file written by ImageLink
+def RemoveImageFiles(fitsfilename):
+    if not keepfiles:
+        srcfilename = SRCFileName(fitsfilename)
+        Path.unlink(fitsfilename, missing_ok = True)
+        Path.unlink(srcfilename, missing_ok = True)
+
+def GetImageLinkResults():
+    ierrsolve, ra, dec, fitsfilename = \
+        ParseImageLinkResults(TSXSendTry(IMAGE_LINK_RESULTS_SCRIPT))
+    RemoveImageFiles(fitsfilename)
+    return ierrsolve, ra, dec
+
+# Takes an image, then reads the HA and LST from its header, plate solves
+# it and reads the results in one round trip to TSX. The exposure is taken
+# asynchronously so it can be stopped part way (see WaitForExposure).
+# Returns ha, lst, ierr, ierrsolve, ra, dec as the separate routines would.
+# Simulated (DSS) images have no HA and LST, so ha is None and lst is the
+# current LST. If stats is a dictionary, the number of stars used by the
+# plate solve and the seconds taken beyond the exposure are put in it.
+def CaptureAndSolve(exp, bin, scale, stats=None):
+    start = clock.monotonic()
+    if stats is not None:
+        stats["exposed"] = clock.time()
+    tsx.send(TakeImageScript(exp, bin, True))
+    with timing.Stage("exposure"):
+        path = WaitForExposure(exp)
+    if path is None:
+        return None, None, 1, 1, 0.0, 0.0
+
+    batch = TSXBatch()
+    ihalst = AddHAandLST(batch, path)
+    ilink = batch.add(ImageLinkPathScript(path, scale), stage="imagelink")
+    iresults = batch.add(IMAGE_LINK_RESULTS_SCRIPT, ParseImageLinkResults,
+                         "results")
+    istars = batch.add(IMAGE_LINK_STARS_SCRIPT, lambda data: int(data[0]),
+                       "results")
+    iscale = batch.add(IMAGE_LINK_SCALE_SCRIPT, ParseImageLinkScale,
+                       "results")
+    results = batch.run(cancel=stop_event)
+
+    ha, lst, ierr, ierrsolve, ra, dec, fitsfilename = \
+        ReadSolveResults(results, ihalst, ilink, iresults, path)
+    SolveStats(stats, results[istars], clock.monotonic() - start - exp)
+    if stats is not None and results[iscale].ok:
+        stats["scale"] = results[iscale].value[0]
+    RemoveImageFiles(path)
+    return ha, lst, ierr, ierrsolve, ra, dec
+
+# Reads the number of stars used by the last plate solve
+IMAGE_LINK_STARS_SCRIPT = " \
+    /* Java Script */\
+    out = ImageLinkResults.imageStarCount;\
+    "
+
+# Puts the number of stars used by a plate solve (None if not known) and
+# how long it took into stats, if it isn't None
+def SolveStats(stats, stars, seconds):
+    if stats is not None:
+        stats["stars"] = stars.value if stars.ok else None
+        stats["seconds"] = seconds
+
+# Reads the results of a batch which plate solved an image and read the
+# plate solve results, and perhaps its HA and LST (see AddHAandLST). The
+# arguments are the indexes of those fragments, and the image file if
+# known (otherwise the last image is used). Returns ha, lst, ierr,
+# ierrsolve, ra, dec and the name of the image file (None if not known).
+def ReadSolveResults(results, ihalst, ilink, iresults, path=None):
+    ierr = 0
+    if results[ilink].ok:
+        data = results[ilink].value
+        if data[0] != "undefined":
+            print(logtime()+ data[0])
+            ierr = 1
+    else:
+        print(logtime()+ results[ilink].error)
+        ierr = 1
+
+    if results[iresults].ok:
+        ierrsolve, ra, dec, fitsfilename = results[iresults].value
+    else:
+        ierrsolve, ra, dec, fitsfilename = 1, 0.0, 0.0, None
+    ha, lst = ReadHAandLST(results, ihalst, path or fitsfilename)
+
+    # Can't use the image without its LST
+    if lst is None:
+        ierr = 1
+    return ha, lst, ierr, ierrsolve, ra, dec, fitsfilename
+
+# Pipelined capture. As soon as an image has been taken, the next exposure
+# is started in the same round trip that plate solves it, so the camera is
+# exposing while the image is solved and the adjustment worked out. Each
+# image is read and solved by its file name so the HA, LST and solution
+# always come from the same image.
+
+# Returns whether the exposure is complete and the name of the last image
+EXPOSURE_STATUS_SCRIPT = " \
+    /* Java Script */\
+    out = ccdsoftCamera.IsExposureComplete + '|' + \
+          ccdsoftCamera.LastImageFileName;\
+    "
+
+# Waits for the exposure in progress to finish, checking every TSX_POLL
+# seconds, and returns the name of the image, or None if the camera did not
+# finish in time. Raises TSXCancelled if the PA routine is asked to stop
+# first.
+def WaitForExposure(exp):
+    deadline = clock.monotonic() + exp + 60
+    while True:
+        data = TSXSendTry(EXPOSURE_STATUS_SCRIPT, cancel=stop_event)
+        if data[0] in ("1", "true"):
+            return data[1]
+        if clock.monotonic() > deadline:
+            print(logtime() + "Timeout from camera.")
+            return None
+        if StopWait(TSX_POLL):
+            raise TSXCancelled("Stopped while exposing")
+
+# Reads the HA and LST from the header of an image file
+def ImageHAandLSTScript(path):
+    return " \
+    /* Java Script */\
+    ccdsoftCameraImage.Path = " + json.dumps(path) + ";\
+    ccdsoftCameraImage.Open();\
+    ha = ccdsoftCameraImage.FITSKeyword(\"TELEHA\");\
+    lst = ccdsoftCameraImage.FITSKeyword(\"LST\");\
+    ccdsoftCameraImage.Close();\
+    out = ha + '|' + lst;\
+    "
+
+# Plate solves an image file
+def ImageLinkPathScript(path, scale):
+    return " \
+    /* Java Script */\
+    ImageLink.pathToFITS = " + json.dumps(path) + ";\
+    ImageLink.scale = " + str(scale) + ";\
+    ImageLink.unknownScale = 0;\
+    ImageLink.execute();\
+    "
+
+class CapturePipeline:
+    def __init__(self, exp, bin, scale):
+        self.exp = exp
+        self.bin = bin
+        self.scale = scale
+        self.pending = False # True while an exposure is in progress
+        self.exposed = None  # When it was started
+
+    # Waits for the exposure in progress to finish and returns the name of
+    # the image, as for WaitForExposure
+    def wait(self):
+        path = WaitForExposure(self.exp)
+        self.pending = False
+        return path
+
+    # Returns ha, lst, ierr, ierrsolve, ra, dec for the next image in the
+    # same way as CaptureAndSolve. Starts the following exposure unless
+    # startnext is False.
+    def next(self, startnext=True, stats=None):
+        if not self.pending:
+            self.exposed = clock.time()
+            tsx.send(TakeImageScript(self.exp, self.bin, True))
+            self.pending = True
+        with timing.Stage("exposure"):
+            path = self.wait()
+        if path is None:
+            return None, None, 1, 1, 0.0, 0.0
+        if stats is not None:
+            stats["exposed"] = self.exposed
+
+        batch = TSXBatch()
+        ihalst = AddHAandLST(batch, path)
+        if startnext:
+            inext = batch.add(TakeImageScript(self.exp, self.bin, True))
+        ilink = batch.add(ImageLinkPathScript(path, self.scale),
+                          stage="imagelink")
+        iresults = batch.add(IMAGE_LINK_RESULTS_SCRIPT, ParseImageLinkResults,
+                             "results")
+        istars = batch.add(IMAGE_LINK_STARS_SCRIPT, lambda data: int(data[0]),
+                           "results")
+        start = clock.monotonic()
+        self.exposed = clock.time()
+        results = batch.run(cancel=stop_event)
+        SolveStats(stats, results[istars], clock.monotonic() - start)
+        if startnext:
+            self.pending = results[inext].ok
+            if not self.pending:
+                print(logtime() + "Could not start exposure: " + \
+                      results[inext].error)
+
+        ha, lst, ierr, ierrsolve, ra, dec, fitsfilename = \
+            ReadSolveResults(results, ihalst, ilink, iresults, path)
+        # The last image file name may already be the next image, so
+        # remove the file that was solved
+        RemoveImageFiles(path)
+        return ha, lst, ierr, ierrsolve, ra, dec
+
+    # Stops any exposure in progress, as for StopDevices
+    def finish(self):
+        if self.pending:
+            StopDevices()
+            self.pending = False
+    
+######################### IMAGE TRACKING ###############################
+# Between plate solves, where each new image is pointing is found from how
+# far its stars have moved from the last solved image. The shift (and any
+# small rotation) is measured by phase correlation of the two images and
+# turned into RA and Dec using the scale and position angle from the plate
+# solve. This takes tens of milliseconds rather than seconds. An image is
+# still plate solved every TRACK_SOLVE_EVERY images, or when the match is
+# poor, e.g. because the stars have moved too far.
+
+# Reads the scale, position angle and mirroring of the last plate solve
+IMAGE_LINK_SCALE_SCRIPT = " \
+    /* Java Script */\
+    out = ImageLinkResults.imageScale + '|' + \
+          ImageLinkResults.imagePositionAngle + '|' + \
+          ImageLinkResults.imageIsMirrored;\
+    "
+
+def ParseImageLinkScale(data):
+    return float(data[0]), float(data[1]), data[2] in ("1", "true")
+
+# NumPy types of FITS image data for each value of BITPIX
+FITS_TYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8",
+              -32: ">f4", -64: ">f8"}
+
+# Reads the image in a FITS file by mapping it into memory, rather than
+# reading the file through Python. Returns the pixels as a 2D array of
+# floats, in the order of the rows in the file. The mapping is released
+# before returning so the file can be deleted.
+def ReadFITSImage(path):
+    header, offset = ReadFITSHeader(path)
+    bitpix = int(header["BITPIX"])
+    if int(header["NAXIS"]) != 2 or bitpix not in FITS_TYPES:
+        raise ValueError("Not a 2D FITS image: " + str(path))
+    shape = (int(header["NAXIS2"]), int(header["NAXIS1"]))
+    data = np.memmap(path, dtype=FITS_TYPES[bitpix], mode="r",
+                     offset=offset, shape=shape)
+    image = data.astype(np.float32)
+    del data
+    image *= float(header.get("BSCALE", 1.0))
+    image += float(header.get("BZERO", 0.0))
+    return image
+
+# Prepares an image for tracking. Removes the sky background and noise,
+# leaving just the stars, and takes the square root so a few bright stars
+# don't swamp the others.
+def TrackImage(image):
+    background = np.median(image)
+    noise = 1.4826 * np.median(np.abs(image - background))
+    image = image - (background + 3.0 * noise)
+    np.clip(image, 0.0, None, out=image)
+    return np.sqrt(image)
+
+# Finds how far image b is shifted from image a by phase correlation.
+# Returns the shift in pixels (x along the rows, y down the rows) and the
+# height of the correlation peak, which is 1 for a perfect match and close
+# to 0 if the images have nothing in common.
+def PhaseCorrelate(a, b):
+    h, w = a.shape
+    # Taper the edges, so the edges of the images don't match each other
+    window = np.outer(np.hanning(h), np.hanning(w)).astype(np.float32)
+    cross = np.fft.rfft2(b * window) * np.conj(np.fft.rfft2(a * window))
+    cross /= np.abs(cross) + 1e-9
+    corr = np.fft.irfft2(cross, (h, w))
+    iy, ix = np.unravel_index(np.argmax(corr), corr.shape)
+    peak = corr[iy, ix]
+
+    # Find the peak to a fraction of a pixel from a parabola through the
+    # peak and the points either side
+    def Vertex(left, right):
+        d = left - 2.0*peak + right
+        return 0.5 * (left - right) / d if d < 0 else 0.0
+    y = Vertex(corr[iy-1, ix], corr[(iy+1) % h, ix])
+    x = Vertex(corr[iy, ix-1], corr[iy, (ix+1) % w])
+
+    # Shifts of more than half the image wrap round to negative shifts
+    y += (iy + h//2) % h - h//2
+    x += (ix + w//2) % w - w//2
+    return float(x), float(y), float(peak)
+
+# Finds how the stars in image b have moved from where they are in image a,
+# both prepared by TrackImage. Returns the shift of the centre of the image
+# (x, y in pixels), the rotation about the centre (radians, from x towards
+# y) and the height of the correlation peak.
+# The rotation is found by measuring the shift of each quarter of the area
+# the images have in common, and fitting a shift and rotation to them.
+def ImageOffset(a, b):
+    x, y, peak = PhaseCorrelate(a, b)
+    if peak < TRACK_MIN_PEAK:
+        return x, y, 0.0, peak
+
+    h, w = a.shape
+    ix, iy = int(round(x)), int(round(y))
+    top, bottom = max(0, -iy), min(h, h - iy)
+    left, right = max(0, -ix), min(w, w - ix)
+    if bottom - top < 64 or right - left < 64:
+        return x, y, 0.0, peak
+    midy, midx = (top + bottom)//2, (left + right)//2
+
+    rows = []
+    shifts = []
+    for y0, y1 in ((top, midy), (midy, bottom)):
+        for x0, x1 in ((left, midx), (midx, right)):
+            tx, ty, tpeak = PhaseCorrelate(a[y0:y1, x0:x1],
+                                           b[y0+iy:y1+iy, x0+ix:x1+ix])
+            if tpeak < TRACK_MIN_PEAK:
+                continue
+            # Centre of the quarter, from the centre of the image
+            px = (x0 + x1)/2.0 - w/2.0
+            py = (y0 + y1)/2.0 - h/2.0
+            # Shift = centre shift + rotation * distance from centre
+            rows += [[1.0, 0.0, -py], [0.0, 1.0, px]]
+            shifts += [ix + tx, iy + ty]
+    if len(rows) < 6:
+        return x, y, 0.0, peak
+
+    x, y, rot = np.linalg.lstsq(np.array(rows), np.array(shifts),
+                                rcond=None)[0]
+    return float(x), float(y), float(rot), peak
+
+# Works out the RA and Dec of the centre of an image from its offset from
+# a solved image. solution is the RA, Dec, scale, position angle and
+# mirroring of the solved image, and x, y, rot as given by ImageOffset.
+def TrackedPosition(solution, x, y, rot):
+    ra, dec, scale, pa, mirrored = solution
+    # The new centre was at this position in the solved image
+    dx = -(x*math.cos(rot) + y*math.sin(rot))
+    dy = -(-x*math.sin(rot) + y*math.cos(rot))
+    # Offset towards the top and right of the solved image, in radians
+    up = -dy * scale / 3600.0 * math.pi / 180.0
+    side = (-dx if mirrored else dx) * scale / 3600.0 * math.pi / 180.0
+    # Offset towards north and east, using the position angle of the top
+    north = up*cosd(pa) - side*sind(pa)
+    east = up*sind(pa) + side*cosd(pa)
+
+    # Move from the centre along the tangent plane and back onto the sky
+    C = [cosd(dec)*math.cos(ra*math.pi/12.0),
+         cosd(dec)*math.sin(ra*math.pi/12.0), sind(dec)]
+    N = [-sind(dec)*math.cos(ra*math.pi/12.0),
+         -sind(dec)*math.sin(ra*math.pi/12.0), cosd(dec)]
+    E = VCross(N, C)
+    V = UVec([C[i] + north*N[i] + east*E[i] for i in range(3)])
+    newra = math.atan2(V[1], V[0]) * 12.0 / math.pi % 24.0
+    newdec = math.asin(V[2]) * 180.0 / math.pi
+    return newra, newdec
+
+# Tracking can instead use the stars that TSX finds in each image, which it
+# writes to a .SRC file next to the image. The brightest stars of the new
+# image are matched to those of the solved image by the shapes of the
+# triangles they make, then the shift and rotation fitted to all the
+# matched stars.
+
+# Finds the stars in the last image and writes them to its .SRC file
+INVENTORY_SCRIPT = " \
+    /* Java Script */\
+    ccdsoftCameraImage.AttachToActiveImager();\
+    ccdsoftCameraImage.ShowInventory();\
+    "
+
+TRACK_STARS = 30         # Number of the brightest stars used to match
+TRACK_NEIGHBOURS = 5     # Triangles are made from each star's nearest stars
+TRACK_TRIANGLE_TOL = 0.01 # How closely the shapes of triangles must match
+TRACK_MATCH_TOL = 2.0    # Pixels a matched star can be from where expected
+
+# Name of the list of stars TSX writes for an image
+def SRCFileName(fitsfilename):
+    return fitsfilename.replace(".fit", ".SRC")
+
+# Reads a .SRC file. This is taken to be a table with the x and y
+# position (pixels) and magnitude of a star on each line - lines that don't
+# start with three numbers, such as headings, are skipped. Returns a list
+# of (x, y, magnitude), brightest first.
+def ReadSRCFile(path):
+    stars = []
+    with open(path, errors="replace") as f:
+        for line in f:
+            fields = line.split()
+            try:
+                stars.append((float(fields[0]), float(fields[1]),
+                              float(fields[2])))
+            except (ValueError, IndexError):
+                continue
+    stars.sort(key=lambda star: star[2])
+    return stars
+
+# Makes triangles from each star and pairs of its nearest neighbours.
+# Returns a list of (shape, vertices), where shape is the lengths of the
+# middle and shortest sides divided by the longest, and the vertices are
+# the indexes of the stars opposite the longest, middle and shortest sides.
+def StarTriangles(points):
+    triangles = set()
+    for i, p in enumerate(points):
+        near = sorted(range(len(points)), key=lambda j: abs(points[j] - p))
+        near = near[1:TRACK_NEIGHBOURS+1]
+        for n, j in enumerate(near):
+            for k in near[n+1:]:
+                triangles.add(tuple(sorted((i, j, k))))
+    out = []
+    for tri in triangles:
+        # Each side, with the vertex opposite it
+        sides = sorted(((abs(points[tri[(n+1) % 3]] - points[tri[(n+2) % 3]]),
+                         tri[n]) for n in range(3)), reverse=True)
+        if sides[2][0] <= 0:
+            continue
+        out.append(((sides[1][0]/sides[0][0], sides[2][0]/sides[0][0]),
+                    (sides[0][1], sides[1][1], sides[2][1])))
+    return out
+
+# Fits new = a*old + b to matched points (complex x + iy), i.e. a shift,
+# rotation and scale
+def FitSimilarity(pairs):
+    n = len(pairs)
+    mold = sum(p[0] for p in pairs) / n
+    mnew = sum(p[1] for p in pairs) / n
+    num = sum((new - mnew) * (old - mold).conjugate() for old, new in pairs)
+    den = sum(abs(old - mold)**2 for old, new in pairs)
+    a = num / den if den > 0 else 1.0
+    return a, mnew - a*mold
+
+# Finds how the stars in a new image have moved from where they are in the
+# solved image, given the stars from both as read by ReadSRCFile and the
+# size of the images. Returns the same as ImageOffset, but with the number
+# of matched stars in place of the correlation peak.
+def StarOffset(ref, new, width, height):
+    refpts = [complex(x, y) for x, y, mag in ref]
+    newpts = [complex(x, y) for x, y, mag in new]
+
+    # Index the shapes of the triangles in the solved image on a grid, so
+    # similar triangles in the new image can be looked up directly
+    grid = collections.defaultdict(list)
+    for shape, verts in StarTriangles(refpts[:TRACK_STARS]):
+        cell = (int(shape[0] / TRACK_TRIANGLE_TOL),
+                int(shape[1] / TRACK_TRIANGLE_TOL))
+        grid[cell].append((shape, verts))
+
+    # Each pair of similar triangles votes for its stars matching
+    votes = collections.Counter()
+    for shape, verts in StarTriangles(newpts[:TRACK_STARS]):
+        cx = int(shape[0] / TRACK_TRIANGLE_TOL)
+        cy = int(shape[1] / TRACK_TRIANGLE_TOL)
+        for cell in [(cx+i, cy+j) for i in (-1, 0, 1) for j in (-1, 0, 1)]:
+            for refshape, refverts in grid.get(cell, ()):
+                if abs(refshape[0] - shape[0]) < TRACK_TRIANGLE_TOL and \
+                   abs(refshape[1] - shape[1]) < TRACK_TRIANGLE_TOL:
+                    for pair in zip(refverts, verts):
+                        votes[pair] += 1
+
+    # Take the best supported matches, each star only once
+    pairs = []
+    usedref, usednew = set(), set()
+    for (i, j), n in votes.most_common():
+        if n < 2:
+            break
+        if i not in usedref and j not in usednew:
+            usedref.add(i)
+            usednew.add(j)
+            pairs.append((refpts[i], newpts[j]))
+    if len(pairs) < 3:
+        return 0.0, 0.0, 0.0, 0
+
+    # Some of the matches may be wrong, so try the shift and rotation given
+    # by each two of the best matches and keep the matches which agree with
+    # the one most agree with. Then match all the stars to where that says
+    # they should be and fit the shift and rotation to them.
+    best = []
+    for n, first in enumerate(pairs[:10]):
+        for second in pairs[n+1:10]:
+            a, b = FitSimilarity([first, second])
+            agree = [p for p in pairs
+                     if abs(a*p[0] + b - p[1]) < TRACK_MATCH_TOL]
+            if len(agree) > len(best):
+                best = agree
+    if len(best) < 3:
+        return 0.0, 0.0, 0.0, 0
+    a, b = FitSimilarity(best)
+    cells = collections.defaultdict(list)
+    for p in newpts:
+        cells[(int(p.real // TRACK_MATCH_TOL),
+               int(p.imag // TRACK_MATCH_TOL))].append(p)
+    pairs = []
+    for p in refpts:
+        q = a*p + b
+        cx, cy = int(q.real // TRACK_MATCH_TOL), int(q.imag // TRACK_MATCH_TOL)
+        near = [r for i in (-1, 0, 1) for j in (-1, 0, 1)
+                for r in cells.get((cx+i, cy+j), ())
+                if abs(r - q) < TRACK_MATCH_TOL]
+        if len(near) == 1:
+            pairs.append((p, near[0]))
+    if len(pairs) < 3:
+        return 0.0, 0.0, 0.0, 0
+    a, b = FitSimilarity(pairs)
+
+    # Shift of the centre of the image and rotation about it
+    centre = complex(width/2.0, height/2.0)
+    shift = a*centre + b - centre
+    return shift.real, shift.imag, cmath.phase(a), len(pairs)
+
+# Takes images and finds where they point, by tracking from the last
+# solved image where possible. method is "image" to compare the pixels of
+# the images, or "stars" to match the stars TSX finds in them. next()
+# returns the same results as CaptureAndSolve.
+class ImageTracker:
+    def __init__(self, exp, bin, scale, method="image"):
+        self.exp = exp
+        self.bin = bin
+        self.scale = scale
+        self.method = method
+        self.reference = None # Pixels or stars of the last solved image
+        self.solution = None  # RA, Dec, scale, PA and mirroring of it
+        self.tracked = 0      # Number of images tracked since it was solved
+        self.readable = True  # False if the images can't be read
+        self.weight = 1.0     # How much worse the last result is than a solve
+
+    # Reads what is needed to track an image: the prepared pixels, or the
+    # stars from its .SRC file and the size of the image
+    def Read(self, path):
+        return Traced("read", path, self.ReadFile, keep=False)
+
+    def ReadFile(self, path):
+        if self.method == "stars":
+            header, offset = ReadFITSHeader(path)
+            return ReadSRCFile(SRCFileName(path)), \
+                int(header["NAXIS1"]), int(header["NAXIS2"])
+        return TrackImage(ReadFITSImage(path))
+
+    # Finds the offset of an image from the solved image, as ImageOffset,
+    # or None if they can't be compared
+    def Offset(self, ref, new):
+        offset = Traced("offset", None, lambda path: self.Compare(ref, new))
+        return tuple(offset) if offset is not None else None
+
+    def Compare(self, ref, new):
+        if self.method == "stars":
+            if ref[1:] != new[1:]:
+                return None
+            return StarOffset(ref[0], new[0], new[1], new[2])
+        if ref.shape != new.shape:
+            return None
+        return ImageOffset(ref, new)
+
+    # Is the match between the images good enough to use?
+    def Good(self, offset):
+        if self.method == "stars":
+            return offset[3] >= TRACK_MIN_STARS
+        return offset[3] >= TRACK_MIN_PEAK
+
+    # stats is filled in as by CaptureAndSolve when an image is solved. The
+    # number of stars is None for a tracked image.
+    def next(self, stats=None):
+        # Take the image, then read its HA and LST and find the stars in it
+        # if they are needed
+        if stats is not None:
+            stats["exposed"] = clock.time()
+        tsx.send(TakeImageScript(self.exp, self.bin, True))
+        with timing.Stage("exposure"):
+            path = WaitForExposure(self.exp)
+        if path is None:
+            return None, None, 1, 1, 0.0, 0.0
+        batch = TSXBatch()
+        ihalst = AddHAandLST(batch, path)
+        if self.method == "stars" and self.readable:
+            istars = batch.add(INVENTORY_SCRIPT)
+        results = batch.run(cancel=stop_event) if batch.fragments else []
+
+        # Find how far the stars have moved since the last solved image
+        image = None
+        offset = None
+        if self.method == "stars" and self.readable and \
+           not results[istars].ok:
+            print(logtime() + "Could not find stars: " + results[istars].error)
+        elif self.readable:
+            try:
+                with timing.Stage("read"):
+                    image = self.Read(path)
+            except (OSError, ValueError, KeyError) as e:
+                print(logtime() + "Can't read image to track it, " + \
+                      "plate solving every image: " + str(e))
+                self.readable = False
+        if image is not None and self.reference is not None:
+            start = time.perf_counter()
+            with timing.Stage("track"):
+                offset = self.Offset(self.reference, image)
+        if offset is not None:
+            if verbose:
+                print("Tracked x %.2f y %.2f rot %.4f deg match %.3f in %.0f ms"
+                      % (offset[0], offset[1], math.degrees(offset[2]),
+                         offset[3], (time.perf_counter() - start)*1000.0))
+
+            if self.Good(offset) and self.tracked < TRACK_SOLVE_EVERY - 1:
+                ra, dec = TrackedPosition(self.solution, *offset[:3])
+                ha, lst = ReadHAandLST(results, ihalst, path)
+                RemoveImageFiles(path)
+                self.tracked += 1
+                if stats is not None:
+                    stats["stars"] = None
+                    stats["seconds"] = 0.0
+                # Can be no better than the solve tracked from, and gets
+                # worse as the match gets poorer
+                if self.method == "stars":
+                    self.weight = 1.0 + TRACK_MIN_STARS / offset[3]
+                else:
+                    self.weight = 1.0 + TRACK_MIN_PEAK / offset[3]
+                return ha, lst, 0 if lst is not None else 1, 0, ra, dec
+            if not self.Good(offset):
+                print(logtime() + "Lost track of the stars, plate solving")
+
+        # Plate solve the image, and track from it if it solves
+        self.weight = 1.0
+        batch = TSXBatch()
+        ilink = batch.add(ImageLinkPathScript(path, self.scale),
+                          stage="imagelink")
+        iresults = batch.add(IMAGE_LINK_RESULTS_SCRIPT, ParseImageLinkResults,
+                             "results")
+        iscale = batch.add(IMAGE_LINK_SCALE_SCRIPT, ParseImageLinkScale,
+                           "results")
+        istars = batch.add(IMAGE_LINK_STARS_SCRIPT, lambda data: int(data[0]),
+                           "results")
+        start = clock.monotonic()
+        solved = batch.run(cancel=stop_event)
+        SolveStats(stats, solved[istars], clock.monotonic() - start)
+        # Read the results as if the HA and LST were in the same batch
+        n = len(results)
+        ha, lst, ierr, ierrsolve, ra, dec, fitsfilename = \
+            ReadSolveResults(results + solved, ihalst, n + ilink, n + iresults,
+                             path)
+
+        if ierr == 0 and ierrsolve == 0 and solved[iscale].ok and \
+           image is not None:
+            if verbose and offset is not None and self.Good(offset):
+                tra, tdec = TrackedPosition(self.solution, *offset[:3])
+                print("Tracking error RA %.1f\" Dec %.1f\"" %
+                      ((tra - ra) * 54000.0 * cosd(dec), (tdec - dec) * 3600.0))
+            # Use the stars found by the plate solve, which are the ones it
+            # has checked against the catalogue
+            if self.method == "stars":
+                try:
+                    image = self.Read(path)
+                except (OSError, ValueError, KeyError):
+                    pass
+            self.reference = image
+            self.solution = (ra, dec) + solved[iscale].value
+            self.tracked = 0
+        RemoveImageFiles(path)
+        return ha, lst, ierr, ierrsolve, ra, dec
+
+# Adjusts the exposure and binning as the sky changes, to the shortest
+# that still plate solve reliably. After AUTO_GOOD plate solves in a row
+# with at least twice AUTO_MIN_STARS stars, the images are made quicker:
+# the binning is raised if downloading and solving take longer than the
+# exposure, otherwise the exposure is shortened. A failed solve, or one
+# with fewer than AUTO_MIN_STARS stars, undoes the last change or lengthens
+# the exposure, and twice as many good solves are then needed before
+# trying to speed up again.
+class ExposureControl:
+    def __init__(self, exp, bin, scale):
+        self.exp = exp
+        self.bin = bin
+        self.minbin = bin       # Never bin less than the starting binning
+        self.binscale = scale / bin # Arcsec/pixel unbinned
+        self.good = 0           # Good solves in a row
+        self.needed = AUTO_GOOD # Good solves needed before speeding up
+        self.last = None        # Last change made to speed up
+
+    # Arcsec/pixel for plate solving at the current binning
+    def Scale(self):
+        return self.binscale * self.bin
+
+    # Describes the current settings
+    def Describe(self):
+        return "exposure " + ("%g" % self.exp) + "s, binning " + \
+            str(self.bin) + "x" + str(self.bin)
+
+    # Updates the settings after an image. solved says whether it was
+    # plate solved (or tracked), and stats is as filled in by
+    # CaptureAndSolve. Returns a message describing any change, or None.
+    def update(self, solved, stats):
+        stars = stats.get("stars")
+        seconds = stats.get("seconds", 0.0)
+
+        if not solved or (stars is not None and stars < AUTO_MIN_STARS):
+            self.good = 0
+            self.needed = min(2 * self.needed, AUTO_GOOD * 16)
+            if self.last == "bin" and self.bin > self.minbin:
+                self.bin -= 1
+            elif self.exp < CAM_MAX_DURATION:
+                self.exp = round(min(CAM_MAX_DURATION, self.exp * 1.5), 2)
+            else:
+                return None
+            self.last = None
+            reason = "Plate solve failed" if not solved else \
+                "Only " + str(stars) + " stars found"
+            return reason + ", now using " + self.Describe()
+
+        # Tracked images say nothing about how well images solve, and only
+        # speed up if there are stars to spare
+        if stars is None:
+            return None
+        if stars < 2 * AUTO_MIN_STARS:
+            self.good = 0
+            return None
+        self.good += 1
+        if self.good < self.needed:
+            return None
+
+        self.good = 0
+        self.needed = max(AUTO_GOOD, self.needed // 2)
+        if self.bin < CAM_MAX_BINNING and \
+           (seconds > self.exp or self.exp <= CAM_MIN_DURATION):
+            self.bin += 1
+            self.last = "bin"
+        elif self.exp > CAM_MIN_DURATION:
+            self.exp = round(max(CAM_MIN_DURATION, self.exp * 0.7), 2)
+            self.last = "exp"
+        else:
+            return None
+        return "Solving with " + str(stars) + " stars, now using " + \
+            self.Describe()
+
+# Next utility functions to calculate sin and cos in degrees
+def sind(ang):
+    return math.sin(ang*math.pi/180.0)
+
+def cosd(ang):
+    return math.cos(ang*math.pi/180.0)
+
+def acosd(cosval):
+    return math.acos(cosval)*180.0/math.pi
+
+# A utility function to return LST for rise and set
+def LSTRise(alt, lat, dec, ra):
+    cosh = (sind(alt)-sind(lat)*sind(dec))/cosd(lat)/cosd(dec)
+    if cosh > 1:
+        return 1000.0
+    if cosh < -1:
+        return -1000.0
+
+    # Can work out H
+    H = acosd(cosh)/15.0
+    return -H+ra
+
+def LSTSet(alt, lat, dec, ra):
+    cosh = (sind(alt)-sind(lat)*sind(dec))/cosd(lat)/cosd(dec)
+    if cosh > 1:
+        return -1000.0
+    if cosh < -1:
+        return 1000.0
+
+    # Can work out H
+    H = acosd(cosh)/15.0
+    return H+ra
+
+# A function to keep time within range of 12 to 36 hours
+# so times from mid-day through midnight to the following mid-day
+# are in sequence.
+# Special cases:
+# If range is > 100, then never rises
+# If range is < 100, then never sets
+def range24(t):
+    # Deal wilth special cases
+    if t > 100: return 1000.0
+    if t < -100.0: return -1000.0
+    
+    i = math.floor(t/24)
+    t -= i * 24
+    if t < 12: t +=24 
+    return t
+
+# Formats decimal time nicely
+def formatdectime(t):
+    if t > 24: t-= 24.0
+    h = math.floor(t)
+    m = math.floor((t-h)*60)
+    return '%02d:%02d' % (h, m)
+
+# A utility function to return latitude, longitude, current LST and UT.
+LAT_LONG_LST_UT_SCRIPT = " \
+    /* Java Script */\
+    var Out=\"\";\
+    var dLat;\
+    var dLon;\
+    var dLST;\
+    var UT;\
+    var sk6DocProp_Latitude = 0;\
+    var sk6DocProp_Longitude = 1;\
+    var sk6DocProp_JulianDateNow=9;\
+    sky6StarChart.DocumentProperty(sk6DocProp_Latitude);\
+    dLat = sky6StarChart.DocPropOut;\
+    sky6StarChart.DocumentProperty(sk6DocProp_Longitude);\
+    dLon = sky6StarChart.DocPropOut;\
+    sky6Utils.ComputeLocalSiderealTime();\
+    dLST = sky6Utils.dOut0;\
+    sky6Utils.ComputeUniversalTime();\
+    dUT = sky6Utils.dOut0;\
+    Out += String(dLat) + \"|\";\
+    Out += String(dLon) + \"|\";\
+    Out += String(dLST) + \"|\";\
+    Out += String(dUT);\
+    "
+
+def ParseLatLongLstUT(data):
+    return float(data[0]), float(data[1]), float(data[2]),\
+        float(data[3])
+
+# Latitude and longitude of the site as set in TSX, and how far TSX's
+# sidereal time is from the one worked out here from this computer's clock
+# (e.g. if TSX runs on another computer). Read once a session.
+site = None
+
+def SetSite(lat, lon, lst):
+    global site
+    offset = (lst - Astrometry.LST(lon, clock.time()) + 12.0) % 24.0 - 12.0
+    site = (lat, lon, offset)
+    if abs(offset) * 3600.0 > 1.0:
+        queue.put(logtime() + "TSX sidereal time is %.1f" % (offset*3600.0) + \
+                  " seconds from this computer's, allowing for it")
+
+def LatLongLstUT():
+    if site is None:
+        lat, lon, lst, ut = ParseLatLongLstUT(TSXSendTry(LAT_LONG_LST_UT_SCRIPT))
+        SetSite(lat, lon, lst)
+    lat, lon, offset = site
+    t = clock.time()
+    return lat, lon, (Astrometry.LST(lon, t) + offset) % 24.0, \
+        (t / 3600.0) % 24.0
+
+######################### PLANNING #####################################
+# Where the mount is pointing
+MOUNT_POSITION_SCRIPT = " \
+    /* Java Script */\
+    sky6RASCOMTele.GetRaDec();\
+    out = sky6RASCOMTele.dRa + '|' + sky6RASCOMTele.dDec;\
+    "
+
+# Returns the likely (1 sigma) errors in arcsec of the alt and az
+# adjustments from images at hour angles ha1 and ha2 (hours) and
+# declination dec, at latitude lat, with noise arcsec of error in the
+# position of each image. ha1, ha2 and dec may be NumPy arrays if m is np.
+# The polar axis is found from how the mount turned between the images,
+# so is less certain the closer together they are. The adjustments are
+# found from how the second image moves as the mount is adjusted, which
+# can't be told apart for altitude and azimuth when it is due east or west
+# of the zenith (e.g. at the zenith or on the east-west axis). Agrees with
+# simulated images put through PASolve and SolveRotation to about 30%.
+def PlanErrors(lat, ha1, ha2, dec, noise, m=math):
+    axis = noise / math.sqrt(2.0) / \
+        (m.sin(m.radians(7.5 * abs(ha2 - ha1))) + 1e-9)
+    h, d, phi = m.radians(15.0 * ha2), m.radians(dec), math.radians(lat)
+    east = m.cos(d) * m.sin(h)
+    north = m.sin(d) * math.cos(phi) - m.cos(d) * m.cos(h) * math.sin(phi)
+    up = m.sin(d) * math.sin(phi) + m.cos(d) * m.cos(h) * math.cos(phi)
+    alt = noise * m.sqrt(1.0 - up * up) / (abs(north) + 1e-9)
+    az = noise * m.sqrt(1.0 - east * east) / (abs(north) + 1e-9)
+    return m.sqrt(axis * axis + alt * alt), \
+        m.sqrt((axis / math.cos(phi)) ** 2 + az * az)
+
+# Estimated seconds to slew between two positions, with both axes moving
+# at once
+def SlewTime(ha1, dec1, ha2, dec2):
+    return max(abs(ha2 - ha1) * 15.0, abs(dec2 - dec1)) / PLAN_SLEW_RATE + \
+        PLAN_SETTLE
+
+# Chooses where to take the alignment images, at latitude lat, with the
+# mount pointing at hour angle ha0 and declination dec0 (None if not
+# known). Every pair of positions every quarter hour of HA at each 5
+# degrees of declination, on one side of the meridian within PLAN_MIN_HA
+# and PLAN_MAX_HA and above PLAN_MIN_ALT (the second for PLAN_ADJUST_TIME
+# after it is reached), is considered, and the quickest to slew to which
+# is accurate to PLAN_ACCURACY chosen. If none is, the most accurate is.
+# The mount's position is used as the first if it will do. Returns the
+# hour angles and declination of the images, whether the first is where
+# the mount is, the estimated seconds of slewing and the larger likely
+# error in arcsec, or None if no positions are high enough.
+def PlanPoints(lat, ha0=None, dec0=None):
+    sign = 1.0 if lat >= 0 else -1.0
+    steps = int(round((PLAN_MAX_HA - PLAN_MIN_HA) / 0.25))
+    has = [PLAN_MIN_HA + 0.25 * i for i in range(steps + 1)]
+    decs = [sign * (PLAN_MIN_DEC + 5.0 * i) for i in
+            range(int(round((PLAN_MAX_DEC - PLAN_MIN_DEC) / 5.0)) + 1)]
+    reusable = ha0 is not None and \
+        PLAN_MIN_DEC <= sign * dec0 <= PLAN_MAX_DEC
+    if reusable:
+        decs.append(dec0)
+
+    candidates = []
+    for dec in decs:
+        # HA range above PLAN_MIN_ALT
+        rise = LSTRise(PLAN_MIN_ALT, lat, dec, 0.0)
+        fall = LSTSet(PLAN_MIN_ALT, lat, dec, 0.0)
+        for side in (1.0, -1.0):
+            points = [(side * ha, False) for ha in has]
+            if reusable and dec == dec0 and \
+               PLAN_MIN_HA <= side * ha0 <= PLAN_MAX_HA:
+                points.append((ha0, True))
+            for ha1, here in points:
+                if not rise <= ha1 <= fall:
+                    continue
+                if here:
+                    seconds = 0.0
+                elif ha0 is not None:
+                    seconds = SlewTime(ha0, dec0, ha1, dec)
+                else:
+                    seconds = PLAN_SETTLE
+                for ha2, _ in points:
+                    later = ha2 + PLAN_ADJUST_TIME
+                    if ha2 != ha1 and rise <= ha2 and later <= fall and \
+                       PLAN_MIN_HA <= side * later <= PLAN_MAX_HA:
+                        candidates.append((ha1, ha2, dec, here, seconds + \
+                                           SlewTime(ha1, dec, ha2, dec)))
+    if not candidates:
+        return None
+
+    if usenumpy and np is not None:
+        ha1, ha2, dec = np.array([c[:3] for c in candidates]).T
+        alt, az = PlanErrors(lat, ha1, ha2, dec, PLAN_NOISE, np)
+        errors = np.maximum(alt, az).tolist()
+    else:
+        errors = [max(PlanErrors(lat, c[0], c[1], c[2], PLAN_NOISE))
+                  for c in candidates]
+    plans = [c + (error,) for c, error in zip(candidates, errors)]
+    good = [plan for plan in plans if plan[5] <= PLAN_ACCURACY]
+    if good:
+        return min(good, key=lambda plan: (plan[4], plan[5]))
+    return min(plans, key=lambda plan: plan[5])
+
+# Plans where to take the alignment images from where the mount is
+# pointing, telling the user. Returns the hour angles and declination of
+# the images, and whether the first is where the mount is.
+def PlanAlignment(lat, lst):
+    data = TSXSendTry(MOUNT_POSITION_SCRIPT)
+    try:
+        ha0 = (lst - float(data[0]) + 12.0) % 24.0 - 12.0
+        dec0 = float(data[1])
+    except (IndexError, ValueError):
+        print(logtime() + "Could not read the mount position: " + data[0])
+        ha0 = dec0 = None
+    plan = PlanPoints(lat, ha0, dec0)
+    if plan is None:
+        queue.put(logtime() + "Nowhere is high enough for the alignment " + \
+                  "images, using HAI1, HAI2 and PA_DEC")
+        return HAI1, HAI2, PA_DEC, False
+    ha1, ha2, dec, here, seconds, error = plan
+    queue.put(logtime() + "Alignment images at HA " + HourFormat(ha1) + \
+              (" (where the mount is)" if here else "") + " and " + \
+              HourFormat(ha2) + ", Dec " + DegFormat(dec) + \
+              ", about %.0f s of slewing" % seconds)
+    if error > PLAN_ACCURACY:
+        queue.put(logtime() + "No positions give the accuracy wanted, " + \
+                  "errors may be %.0f\"" % error)
+    return ha1, ha2, dec, here
+
+# Utility routines
+# Nicely formats time for a logoutput
+def logtime():
+    return time.strftime("[%d-%m-%Y %H:%M:%S] ",
+                         time.localtime(clock.time()))
+
+# Next takes a string which is decimal time and turns it into a time
+def format_time(dectimestring):
+    dectime = float(dectimestring)
+    hour = int(dectime);
+    min = int((dectime - hour)*60)
+    sec = int((dectime - hour)*3600-min*60+0.5)
+    tstring = '%02d:%02d:%02d' % (hour, min, sec)
+    return tstring
+
+# Utility routine that calculates a decimal time from a time structure
+def decimaltime(ts):
+    d = ts.tm_hour+ts.tm_min/60.0+ts.tm_sec/3600.0
+    return d
+
+# Calculate Alt Az from HA DEC at the site
+def AltAzfromHADEC(HA, Dec):
+    return AltAzfromHADECLat(HA, Dec, LatLongLstUT()[0])
+
+# Calculate Alt Az from HA DEC
+def AltAzfromHADECLat(HA, Dec, lat):
+    return Astrometry.AltAzfromHADEC(HA, Dec, lat)
+
+def HADECfromAltAz(Alt, Az):
+    return Astrometry.HADECfromAltAz(Alt, Az, LatLongLstUT()[0])
+
+# Routine to dry and work out rotation that will take (Alt1, Az1) to (Alt2, Az2)
+
+# Routine to look for brute force best solution of rotation
+def BruteRotationSearch(Alt, Az, AltTarget, AzTarget):
+    # Set resolution of first search to 2 arcmin
+    res1 = 6/60
+    # Set resolution of search to 5 arsec
+    res2 = 10/3600
+    
+    V = VfromAltAz(Alt, Az)
+    VTarget = VfromAltAz(AltTarget, AzTarget)
+
+    # Fix to a standard range - 10 degrees altitude, 25 degrees azimuth
+    trange = 10
+    prange = 25
+
+    # Use the vectorised search if NumPy is available, otherwise
+    # fall back to the pure python loops
+    if usenumpy and np is not None:
+        search = RotationSearchNumpy
+    else:
+        search = RotationSearch
+
+    (tsoln, psoln) = search(V, VTarget, 0, trange, res1, 0, \
+                            prange, res1)
+    # Now refine it further
+    (tsoln, psoln) = search(V, VTarget, tsoln, res1*2, res2, \
+                            psoln, res1*2, res2)
+    return (tsoln, psoln)
+    
+# Routine to find the rotation by iterative least squares rather than a grid
+# search. Uses Levenberg-Marquardt with analytic derivatives of VAltAzRotate.
+# Returns the theta, phi solution and the number of iterations used.
+def LMRotationSearch(Alt, Az, AltTarget, AzTarget, tol=1e-9, maxiter=50):
+    V = VfromAltAz(Alt, Az)
+    VTarget = VfromAltAz(AltTarget, AzTarget)
+
+    # Work in radians, starting from no rotation
+    thetar = 0.0
+    phir = 0.0
+    lam = 1e-3
+
+    def residual(thetar, phir):
+        R = VAltAzRotate(V, thetar*180.0/math.pi, phir*180.0/math.pi)
+        return VSub(R, VTarget)
+
+    r = residual(thetar, phir)
+    cost = VDot(r, r)
+    niter = 0
+    while niter < maxiter:
+        niter += 1
+        ct = math.cos(thetar)
+        st = math.sin(thetar)
+        cp = math.cos(phir)
+        sp = math.sin(phir)
+
+        # Rotation around Z axis and its derivative with respect to phi
+        V1  = [cp*V[0] - sp*V[1], sp*V[0] + cp*V[1], V[2]]
+        dV1 = [-sp*V[0] - cp*V[1], cp*V[0] - sp*V[1], 0.0]
+
+        # Derivatives of the final vector with respect to theta and phi
+        Jt = [0.0, -st*V1[1] + ct*V1[2], -ct*V1[1] - st*V1[2]]
+        Jp = [dV1[0], ct*dV1[1], -st*dV1[1]]
+
+        # Normal equations for the 2x2 system, with LM damping
+        a = VDot(Jt, Jt)
+        b = VDot(Jt, Jp)
+        c = VDot(Jp, Jp)
+        gt = VDot(Jt, r)
+        gp = VDot(Jp, r)
+
+        while True:
+            ad = a * (1 + lam)
+            cd = c * (1 + lam)
+            det = ad*cd - b*b
+            if det == 0.0:
+                return thetar*180.0/math.pi, phir*180.0/math.pi, niter
+            dt = -( cd*gt - b*gp)/det
+            dp = -(-b*gt + ad*gp)/det
+            rnew = residual(thetar+dt, phir+dp)
+            costnew = VDot(rnew, rnew)
+            if costnew <= cost:
+                # Step accepted - move towards Gauss-Newton
+                lam = lam / 10.0
+                break
+            # Step rejected - move towards gradient descent
+            lam = lam * 10.0
+            if lam > 1e10:
+                return thetar*180.0/math.pi, phir*180.0/math.pi, niter
+
+        thetar += dt
+        phir += dp
+        r = rnew
+        cost = costnew
+        if abs(dt) < tol and abs(dp) < tol:
+            break
+
+    return thetar*180.0/math.pi, phir*180.0/math.pi, niter
+
+# Works out the rotation using the solver selected by ROT_SOLVER. The
+# grid search is only a fallback: near the zenith a small change in the
+# target moves the rotation a long way, so the best point of its coarse
+# grid can be degrees from the exact solution LM finds.
+def SolveRotation(Alt, Az, AltTarget, AzTarget):
+    if ROT_SOLVER == "lm":
+        theta, phi, niter = LMRotationSearch(Alt, Az, AltTarget, AzTarget)
+        if verbose: print("LM iterations:", niter)
+        # Near the east-west axis there can be a second solution. Only
+        # accept a solution within the range searched by the brute force
+        # routine, otherwise fall back to it.
+        if abs(theta) <= 10 and abs(phi) <= 25:
+            return (theta, phi)
+    return BruteRotationSearch(Alt, Az, AltTarget, AzTarget)
+
+def RotationSearch(V, VTarget, tmid, trange, tinc, pmid, prange, pinc):
+    # Initialise best solution
+    tsoln = tmid
+    psoln = pmid
+    solmax = VDot(VTarget, VAltAzRotate(V, tsoln, psoln))
+
+    # Double loop to test best solution
+    t = tmid-trange
+    while t < tmid + trange:
+        p = pmid - prange
+        while p < pmid + prange:
+            sol = VDot(VTarget, VAltAzRotate(V, t, p))
+            if sol > solmax:
+                solmax = sol
+                tsoln = t
+                psoln = p
+            p += pinc
+        t += tinc
+
+    return (tsoln, psoln)
+
+def RotationSearchNumpy(V, VTarget, tmid, trange, tinc, pmid, prange, pinc):
+    # Same search as RotationSearch, but evaluates the whole theta, phi
+    # grid in one go using NumPy arrays. The grid points and the choice of
+    # best solution (first maximum, must beat the starting point) match
+    # the python loops above.
+    tsoln = tmid
+    psoln = pmid
+    solmax = VDot(VTarget, VAltAzRotate(V, tsoln, psoln))
+
+    # Grid of values to test - arange stops short of the end point in
+    # the same way as the while loops
+    t = np.arange(tmid - trange, tmid + trange, tinc)
+    p = np.arange(pmid - prange, pmid + prange, pinc)
+    if t.size == 0 or p.size == 0:
+        return (tsoln, psoln)
+
+    thetar = t * math.pi / 180.0
+    phir   = p * math.pi / 180.0
+    ct = np.cos(thetar)[:, np.newaxis]
+    st = np.sin(thetar)[:, np.newaxis]
+    cp = np.cos(phir)
+    sp = np.sin(phir)
+
+    # Rotation around Z axis only depends on phi
+    V1x = cp * V[0] - sp * V[1]
+    V1y = sp * V[0] + cp * V[1]
+
+    # Rotation around X axis, then dot product with target, for every
+    # combination of theta (rows) and phi (columns)
+    sol = VTarget[0] * V1x + \
+          VTarget[1] * (ct * V1y + st * V[2]) + \
+          VTarget[2] * (-st * V1y + ct * V[2])
+
+    ibest = np.argmax(sol)
+    it, ip = np.unravel_index(ibest, sol.shape)
+    if sol[it, ip] > solmax:
+        tsoln = float(t[it])
+        psoln = float(p[ip])
+
+    return (tsoln, psoln)
+
+        
+# Routine to rotate Alt, Az by Theta and Phi
+def RotateAltAz(Alt, Az, theta, phi):
+    # First turn into a vector
+    V = VfromAltAz(Alt, Az)
+    # Then rotate by theta, phi
+    V1 = VAltAzRotate(V, theta, phi)
+    # Then return new AltAz location
+    return VecToAltAz(V1)
+
+# Next a series of funtions to help with vectors
+def VfromAltAz(Alt, Az):
+    # Calculates a 3D unit vector in the direction of Alt Az
+    # First convert to radians
+    V=[0,0,0]
+    Altr = Alt * math.pi / 180.0
+    Azr  = Az * math.pi / 180.0
+
+    # Now can calculate the vector
+    V[0] = math.cos(Altr) * math.sin(Azr)
+    V[1] = math.cos(Altr) * math.cos(Azr)
+    V[2] = math.sin(Altr)
+    return V
+
+def VecToAltAz(V):
+    # Calculates the alt/az postion from a unit vector, V
+    # Will return Az in the range of -180 to 180.
+    Alt = math.asin(V[2]) * 180/math.pi
+    Az = math.atan2(V[0], V[1]) * 180/math.pi
+
+    return Alt, Az
+
+def VAltAzRotate(V, theta, phi):
+    # Rotates V firsty by phi degrees counter clockwise around Z axis
+    # then by theta degrees clockwise around X axis. This convention
+    # should rotate the telescope axis back to the pole given the alt,az
+    # offset of the axis from the pole as input.
+
+    # First convert to radians
+    thetar = theta * math.pi / 180.0
+    phir = phi * math.pi / 180.0
+
+    # Now rotate around Z axis
+    V1=[0.0,0.0,0.0]
+    V1[0] = math.cos(phir) * V[0] - math.sin(phir) * V[1]
+    V1[1] = math.sin(phir) * V[0] + math.cos(phir) * V[1]
+    V1[2] = V[2]
+
+    # Finally around the X axis
+    V2=[0.0,0.0,0.0]
+    V2[0] = V1[0]
+    V2[1] = math.cos(thetar) * V1[1] + math.sin(thetar) * V1[2]
+    V2[2] = -math.sin(thetar) * V1[1] + math.cos(thetar) * V1[2]
+
+    return V2
+    
+def VSub(V1, V2):
+    # Calculates V1-V2 and returns
+    V = [V1[0] - V2[0], V1[1] - V2[1], V1[2] - V2[2]]
+    return V
+
+def VDot(V1, V2):
+    # Calculates dot product of two vectors
+    return V1[0]*V2[0]+V1[1]*V2[1]+V1[2]*V2[2]
+
+def UVec(V):
+    # returns unit vector in same direction as V
+    norm = math.sqrt(VDot(V,V))
+    UV = [element / norm for element in V]
+    return UV
+    
+def VCross(V1, V2):
+    # Calculates cross product of two vectors
+    V = [0,0,0]
+    V[0] = V1[1]*V2[2]-V1[2]*V2[1]
+    V[1] = V1[2]*V2[0]-V1[0]*V2[2]
+    V[2] = V1[0]*V2[1]-V1[1]*V2[0]
+    return V
+    
+def VGCC(SZ,CZ,SA,CA,phi):
+    # Returns a vector on the great circle defined by SZ, CZ, SA, CA at position Phi
+    # If equation for great circle in y-z plane is [0, sin(phi), cos(phi)]
+    # Then equation for rotated great circle is
+    # [ -SZ CA cos(phi) - SA sin(phi), -SZ SA cos(phi) + CA sin(phi), CZ cos(phi)]
+    return [ -SZ*CA*math.cos(phi) - SA*math.sin(phi),
+        -SZ*SA*math.cos(phi) + CA*math.sin(phi), CZ*math.cos(phi)]
+
+def Cosang(SZ,CZ,SA,CA,phi, V1, V2):
+    # Calculates the angle between the two image locations and the potential polar axis
+    # First calculate the postion of the potential polar axis
+    gcc = VGCC(SZ,CZ,SA,CA,phi)
+    a1 = UVec(VCross(gcc, V1))
+    a2 = UVec(VCross(gcc, V2))
+    return VDot(a1,a2)
+    
+# Next routine solves for the polar axis given data from the two images
+def PASolve(RA1, DEC1, LST1, THA1, RA2, DEC2, LST2, THA2):
+    # Inputs for the routine are:
+    # RA1, DEC1 - the platsolved RA and DEC in JNow.
+    # LST1      - the local siderial time as recorded in the first image
+    # THA1      - the hour angle as reported from the telescope
+    # The inputs labeled '2' are the same but for the second image
+    
+    # Other variables:
+    # HA1       - the hour angle in radians for the first image from RA1 and LST1.
+    # HA2       - the hour angle in radians for the second image from RA1 and LST1.
+    # D1        - Dec in radians for first image
+    # D2        - Dec in radians for second image
+    # V1        - Vector in direction of image 1
+    # V2        - Vector in direction of image 2
+    # DV        - Difference between V2 and V2
+    # ADV       - norm of DV
+    # DVA       - unit vector of DV (DV divided by ADV).
+    # SZ        - Sin of angle between the horizon and DVA
+    # CZ        - Cos of angle between the horizon and DVA
+    # AZD       - azimuthal direction of DVA measured from the x-axis
+    # SA        - Sin of AZD
+    # CA        - Cos of AZD
+    
+    # First determine hour angles in radians for the two images
+    HA1 = (LST1 - RA1)/24.0*2*math.pi
+    HA2 = (LST2 - RA2)/24.0*2*math.pi
+    
+    # Now the DEC in radians for the two images
+    D1 = DEC1 * math.pi/180.0
+    D2 = DEC2 * math.pi/180.0
+    
+    # Now work out vectors for the positions of image 1 and 2.
+    # Using co-ordinate system aligned with North and South Celestial Poles.
+    # Z axis pointing to North, Y aligned with Meridian, and X perpendicular to both
+    # pointing to Horizon
+    
+    V1 = [math.cos(D1) * math.sin(HA1), math.cos(D1) * math.cos(HA1), math.sin(D1)]
+    V2 = [math.cos(D2) * math.sin(HA2), math.cos(D2) * math.cos(HA2), math.sin(D2)]
+    
+    # Now calculate the differnce between the two vectors, then the unit vector in that direction
+    DV = VSub(V2,V1)
+    DVA = UVec(DV)
+    
+    # Now want to create equation for great circle perpendicular to DVA
+    # This will contain the pole since must be equidistant from each image since a pure rotation
+    # around the RA telescope axis
+    # Can do this by rotating the unit circle in the y-z plane.
+    # First rotate around the y axis so that the height of the transformed x-axis matches the
+    # z value of DVA.
+    # Second rotation is around z to align transformed x-axis with DVA.
+    SZ = DVA[2]
+    CZ = math.sqrt(1-SZ*SZ)
+    AZD = math.atan2(DVA[1], DVA[0])
+    SA = math.sin(AZD)
+    CA = math.cos(AZD)
+    
+    # If equation for great circle in y-z plane is [0, sin(phi), cos(phi)]
+    # Then equation for rotated great circle is
+    # [ -SZ CA cos(phi) - SA sin(phi), -SZ SA cos(phi) + CA sin(phi), CA cos(phi)]
+    # This is encoded in the function Cosang
+    
+    # Calculate the cos of the angle between the telescope HA positons
+    CosHASep = math.cos((THA1 - THA2)*math.pi/12.0)
+    
+    # Solution shoudl be somewhere near the pole - solve using numerical NR soln
+    Phi = 0.0
+    EPS = 0.0001
+    EPSSOLN = 0.0000001
+    DC = Cosang(SZ,CZ,SA,CA,Phi, V1, V2) - CosHASep
+    while abs(DC) > EPSSOLN:
+        DCPlus = Cosang(SZ,CZ,SA,CA,Phi+EPS, V1, V2) - CosHASep
+        DCMinus = Cosang(SZ,CZ,SA,CA,Phi-EPS, V1, V2) - CosHASep
+        DCGradient = (DCPlus-DCMinus)/EPS/2.0
+        Phi -= DC/DCGradient
+        DC = Cosang(SZ,CZ,SA,CA,Phi, V1, V2) - CosHASep
+    
+    # Calculate vector for polar axis
+    PA =VGCC(SZ,CZ,SA,CA,Phi)
+    
+    # Now calculate RA and DEC
+    PADEC = math.asin(PA[2])*180/math.pi
+    PAHA = math.atan2(PA[0], PA[1])*12/math.pi
+    
+    if verbose: print("Phi:", Phi*180.0/math.pi)
+
+    return PAHA, PADEC
+
+# Solves for the polar axis from any number of images. samples is a list of
+# (RA, DEC, LST, THA) for each image, as for PASolve. The mount is taken to
+# point at the same declination about its own axis for every image, at the
+# hour angle reported by the telescope. The axis, a zero point for the
+# reported hour angle and the declination are fitted by least squares
+# (Gauss-Newton), and images which fit badly are given less weight (Huber
+# weights) so one bad plate solve or LST doesn't spoil the result.
+# Needs NumPy. Returns PAHA, PADEC as PASolve and the residual of each
+# image in arcsec, or None if there is no solution. The images in test, if
+# any, are not fitted but their residuals from the fit are added to the end.
+def PASolveN(samples, maxiter=20, test=()):
+    # Directions of the images, in the same frame as PASolve, and the
+    # telescope hour angles in radians
+    def directions(samples):
+        s = np.asarray(samples, dtype=float).reshape(-1, 4)
+        ha = (s[:, 2] - s[:, 0]) * math.pi / 12.0
+        dec = np.radians(s[:, 1])
+        return np.stack([np.cos(dec)*np.sin(ha), np.cos(dec)*np.cos(ha),
+                         np.sin(dec)], axis=1), s[:, 3] * math.pi / 12.0
+
+    V, h = directions(samples)
+    n = len(V)
+    dec = np.arcsin(np.clip(V[:, 2], -1.0, 1.0))
+    ones = np.ones(n)
+
+    # M rotates the mount's frame onto the sky and d is the declination
+    M = np.eye(3)
+    d = float(np.mean(dec))
+    weights = ones
+    for reweight in range(5):
+        for iteration in range(maxiter):
+            p = np.stack([math.cos(d)*np.sin(h), math.cos(d)*np.cos(h),
+                          math.sin(d)*ones], axis=1)
+            dp = np.stack([-math.sin(d)*np.sin(h), -math.sin(d)*np.cos(h),
+                           math.cos(d)*ones], axis=1)
+            r = V - p @ M.T
+            # Change in M p for a small rotation w of the mount frame is
+            # M (w x p) = -M [p]x w
+            px = np.zeros((n, 3, 3))
+            px[:, 0, 1], px[:, 0, 2] = -p[:, 2], p[:, 1]
+            px[:, 1, 0], px[:, 1, 2] = p[:, 2], -p[:, 0]
+            px[:, 2, 0], px[:, 2, 1] = -p[:, 1], p[:, 0]
+            J = np.concatenate([-M @ px, (dp @ M.T)[:, :, None]], axis=2)
+            JW = J * weights[:, None, None]
+            try:
+                step = np.linalg.solve(np.einsum("nij,nik->jk", JW, J),
+                                       np.einsum("nij,ni->j", JW, r))
+            except np.linalg.LinAlgError:
+                return None
+            # Update M by the rotation w (Rodrigues' formula)
+            w = step[:3]
+            angle = np.linalg.norm(w)
+            if angle > 0:
+                k = w / angle
+                K = np.array([[0.0, -k[2], k[1]], [k[2], 0.0, -k[0]],
+                              [-k[1], k[0], 0.0]])
+                M = M @ (np.eye(3) + math.sin(angle)*K +
+                         (1.0 - math.cos(angle))*(K @ K))
+            d += step[3]
+            if np.max(np.abs(step)) < 1e-12:
+                break
+
+        # Residuals, then weights for the next fit: full weight within
+        # 1.345 sigma, less for images further away
+        p = np.stack([math.cos(d)*np.sin(h), math.cos(d)*np.cos(h),
+                      math.sin(d)*ones], axis=1)
+        residual = np.linalg.norm(V - p @ M.T, axis=1)
+        sigma = max(1.4826 * float(np.median(residual)),
+                    AXIS_MIN_NOISE / 3600.0 * math.pi / 180.0)
+        weights = np.minimum(1.0, 1.345 * sigma / np.maximum(residual, 1e-15))
+
+    if len(test):
+        V, h = directions(test)
+        p = np.stack([math.cos(d)*np.sin(h), math.cos(d)*np.cos(h),
+                      math.sin(d)*np.ones(len(h))], axis=1)
+        residual = np.concatenate([residual,
+                                   np.linalg.norm(V - p @ M.T, axis=1)])
+
+    # The axis is where the mount frame's pole points
+    PA = M[:, 2]
+    PADEC = math.asin(PA[2])*180/math.pi
+    PAHA = math.atan2(PA[0], PA[1])*12/math.pi
+    return PAHA, PADEC, np.degrees(residual) * 3600.0
+
+# Next function formats the degrees as degrees, minutes and arcsec
+def DegFormat(angle):
+    degree_sign= '\N{DEGREE SIGN}'
+    # Cope with 
+    if angle >= 0:
+        angsign = ""
+    else:
+        angsign = "-"
+        angle = -angle
+
+    # The plus 0.5/3600 is to cope with rounding to 1 arc second
+    deg = int(angle+0.5/3600)
+    angle -= deg
+    angle *= 60
+    # The plus 0.5/60 is to cope with rounding to 1 arc second
+    minutes = int(angle+0.5/60)
+    angle -= minutes
+    angle *= 60
+    seconds = int(angle+0.5)
+    out = angsign+str(deg) + degree_sign + " " + str(minutes) + "' " + str(seconds) + '"'
+    return out
+
+# Next function formats hour angles as hours, minutes and arcsec
+
+def HourFormat(angle):
+    # Cope with positive an negative angles
+    if angle > 0:
+        strsign = ""
+    else:
+        angle = -angle
+        strsign = "-"
+        
+    deg = int(angle+0.5/3600) # Copes with rouding to nearest second
+    angle -= deg
+    angle *= 60
+    minutes = int(angle+0.5/60) # Copes with rouding to nearest second
+    angle -= minutes
+    angle *= 60
+    seconds = int(angle+0.5)
+    out = strsign + str(deg) + "h " + str(minutes) + "' " + str(seconds) + '"'
+    return out
+
+def GetTestImageLinkResults(path):
+    MESSAGE = " \
+    /* Java Script */\
+    ccdsoftCameraImage.Path = \"" + path + "\";\
+    ccdsoftCameraImage.Open();\
+    ha = ccdsoftCameraImage.FITSKeyword(\"TELEHA\");\
+    lst = ccdsoftCameraImage.FITSKeyword(\"LST\");\
+    psra = ccdsoftCameraImage.FITSKeyword(\"CRVAL1\");\
+    psdec = ccdsoftCameraImage.FITSKeyword(\"CRVAL2\");\
+    ccdsoftCameraImage.Close();\
+    out = ha + '|' + lst + '|' + psra + '|' + psdec;\
+    "
+    data = TSXSendTry(MESSAGE)
+    ha, lst = ParseImageHAandLST(data)
+    return ha, lst, float(data[2]), float(data[3])
+
+def GetTestDat(tha, lst ,ra, dec, i):
+    return (tha[i], lst[i], ra[i], dec[i])
+
+# Works out where an image would be if the mount were aligned, given the
+# polar axis (PAHA, PADEC) and the alt and az of the image. Returns the alt
+# and az of the polar axis (az between -180 and 180), and the alt, az, HA
+# and Dec of where the image would be.
+def AlignmentTarget(PAHA, PADEC, lat, Alt, Az):
+    PAAlt, PAAz = AltAzfromHADECLat(PAHA, PADEC, lat)
+    
+    # Calculate difference from 360 if > 180.
+    if PAAz > 180.0:
+        PAAz = PAAz - 360.0
+
+    # Work out target Alt Az when successful PA
+    TargetAlt, TargetAz = RotateAltAz(Alt, Az, PAAlt-lat, PAAz)
+    
+    if TargetAz > 180.0:
+        TargetAz = TargetAz - 360.0
+        
+    # Work out target HA, Dec when successful PA
+    TargetHA, TargetDec = Astrometry.HADECfromAltAz(TargetAlt, TargetAz, lat)
+    return PAAlt, PAAz, TargetAlt, TargetAz, TargetHA, TargetDec
+
+# Works out the adjustment from a solved image (JNow RA and Dec, and its
+# LST), given where the second image would have been with the mount aligned
+# (TargetHA, TargetDec from AlignmentTarget) and its LST. Returns theta,
+# phi as for SolveRotation, with the signs for the hemisphere.
+def ImageAdjustment(ira, idec, ilst, lat, ilst2, TargetHA, TargetDec):
+    # Calculate true iha from solved RA and Dec
+    iha = ilst-ira
+    # Calculate Alt and Az from Ha and Dec
+    ialt, iaz = AltAzfromHADECLat(iha, idec, lat)
+    if iaz > 180:
+        iaz =iaz - 360
+        if verbose :
+            print("New Alt", DegFormat(ialt), "New Az", DegFormat(iaz))
+        
+    # Now work out where Target postion would have rotated to
+    iha2 = ilst - ilst2 + TargetHA
+
+    TargetAlt, TargetAz = AltAzfromHADECLat(iha2, TargetDec, lat)
+
+    if TargetAz > 180:
+        TargetAz = TargetAz - 360.0
+
+    if verbose:
+        print("TargetAlt", DegFormat(TargetAlt), "TargetAz", DegFormat(TargetAz))
+        print("ImageAlt", DegFormat(ialt), "ImageAz", DegFormat(iaz))
+
+    theta, phi = SolveRotation(ialt, iaz, TargetAlt, TargetAz)
+    # Adjust theta, phi depending on the hemisphere:
+    # Code below mutiplies by -1 if southern hemisphere, 1 if Northern
+    theta = theta * math.copysign(1, lat)
+    phi   = phi   * math.copysign(1, lat)
+    return theta, phi
+
+# Describes how well the images fitted the polar axis, given the residual
+# of each image from PASolveN
+def AxisSummary(residuals):
+    rms = math.sqrt(sum(r*r for r in residuals) / len(residuals))
+    return "Polar axis fixed from " + str(len(residuals)) + \
+        " images, rms residual " + DegFormat(rms/3600.0) + \
+        ", worst " + DegFormat(max(residuals)/3600.0)
+
+# Smooths the adjustments worked out from each image, which jitter with the
+# seeing and errors in the plate solves. theta and phi are each estimated
+# by a Kalman filter which takes the adjustment to drift slowly between
+# images. A change too big to be noise is taken to be the mount being
+# adjusted, and the estimate starts again from the new value. So is a
+# smaller change which lasts, which the filter would only slowly follow:
+# the images since the estimate was last trusted are compared with it, and
+# once their differences the same way add up (a CUSUM test) the estimate
+# starts again from their mean.
+class AlignmentFilter:
+    def __init__(self):
+        self.value = None # Estimated theta and phi
+        self.var = None   # Variance of each
+        self.time = None  # When they were last updated
+        self.runs = [None, None] # For each, while it may have changed: the
+                                 # estimate and variance before, and for
+                                 # changes up and down, the sum of the
+                                 # differences in sigma and the number and
+                                 # sum of the images in it
+
+    # Adds the theta and phi from an image. weight is how many times larger
+    # its error is than for a plate solved image, and now when it was
+    # measured (clock.monotonic(), by default now). Returns the estimated
+    # theta and phi and their 1 sigma errors, all in degrees.
+    def update(self, theta, phi, weight=1.0, now=None):
+        if now is None:
+            now = clock.monotonic()
+        noise = (SMOOTH_NOISE * weight)**2
+        if self.value is None:
+            self.value = [theta, phi]
+            self.var = [noise, noise]
+        else:
+            drift = SMOOTH_DRIFT**2 * (now - self.time)
+            for i, measured in enumerate((theta, phi)):
+                var = self.var[i] + drift
+                change = measured - self.value[i]
+                if change**2 > SMOOTH_STEP**2 * (var + noise):
+                    self.value[i] = measured
+                    self.var[i] = noise
+                    self.runs[i] = None
+                    continue
+
+                if self.runs[i] is None:
+                    self.runs[i] = [self.value[i], var, [0.0, 0, 0.0],
+                                    [0.0, 0, 0.0]]
+                before, vbefore, up, down = self.runs[i]
+                sigmas = (measured - before) / math.sqrt(vbefore + noise)
+                for run, sign in ((up, 1.0), (down, -1.0)):
+                    run[0] += sign * sigmas - 0.5
+                    run[1] += 1
+                    run[2] += measured
+                    if run[0] <= 0.0:
+                        run[:] = [0.0, 0, 0.0]
+                shifted = max((up, down), key=lambda run: run[0])
+                if shifted[0] > SMOOTH_SHIFT:
+                    self.value[i] = shifted[2] / shifted[1]
+                    self.var[i] = noise / shifted[1]
+                    self.runs[i] = None
+                    continue
+                if not (up[1] or down[1]):
+                    self.runs[i] = None
+
+                gain = var / (var + noise)
+                self.value[i] += gain * change
+                self.var[i] = (1.0 - gain) * var
+        self.time = now
+        return self.value[0], self.value[1], \
+            math.sqrt(self.var[0]), math.sqrt(self.var[1])
+
+# Works out the adjustments from the images in worker processes, so that
+# neither taking the next image nor the display (which share the GIL with
+# the PA thread) wait for the calculations. With no workers, or where they
+# can't be started, the calculations are done in the calling thread. The
+# workers are forked, so are only used on Linux - started any other way
+# they would import PAUI.py again and open another window.
+class ComputeExecutor:
+    def __init__(self, workers=0):
+        self.pool = None
+        if workers > 0 and sys.platform.startswith("linux"):
+            try:
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    workers, multiprocessing.get_context("fork"),
+                    initializer=ComputeSetup, initargs=(ComputeSettings(),))
+                # Start the workers now rather than with the first image
+                self.pool.submit(abs, 0).result()
+            except (OSError, concurrent.futures.BrokenExecutor) as e:
+                print(logtime() + "Cannot start the worker processes, so " + \
+                      "the adjustments are worked out here: " + str(e))
+                self.Close()
+
+    # Runs func(*args) in a worker. Returns a future which is done once
+    # done(future) has been called with the future of the result, from
+    # whichever thread gets the result - so done must be thread safe. If
+    # done raises an exception, so does the future.
+    def submit(self, func, *args, done=None):
+        reported = concurrent.futures.Future()
+        def report(future):
+            if isinstance(future.exception(), concurrent.futures.BrokenExecutor):
+                # The worker died, so carry on without them
+                print(logtime() + "Worker process stopped, so the " + \
+                      "adjustments are worked out here")
+                self.Close(wait=False)
+                future = self.Run(func, *args)
+            try:
+                if done is not None:
+                    done(future)
+            except Exception as e:
+                reported.set_exception(e)
+            else:
+                reported.set_result(None)
+
+        future = None
+        pool = self.pool
+        if pool is not None:
+            try:
+                future = pool.submit(func, *args)
+            except RuntimeError: # Broken, or closed by report
+                pass
+        if future is None:
+            future = self.Run(func, *args)
+        future.add_done_callback(report)
+        return reported
+
+    # Runs func(*args) here, returning a future of the result. The session
+    # profiler, if there is one, profiles it.
+    def Run(self, func, *args):
+        future = concurrent.futures.Future()
+        if timing.profiler is not None:
+            timing.profiler.enable()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            if timing.profiler is not None:
+                timing.profiler.disable()
+        return future
+
+    # Stops the workers, waiting for the work they are doing if wait is set
+    def Close(self, wait=True):
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait)
+
+# Settings the calculations use, for the workers
+def ComputeSettings():
+    return {"ROT_SOLVER": ROT_SOLVER, "usenumpy": usenumpy,
+            "AXIS_MAX_RESIDUAL": AXIS_MAX_RESIDUAL,
+            "AXIS_REJECT": AXIS_REJECT, "AXIS_MIN_NOISE": AXIS_MIN_NOISE}
+
+# Sets up a worker process. It starts as a copy of the PA routine, locks
+# and all, so it keeps its own time, prints nothing and leaves Ctrl-C to
+# the PA routine.
+def ComputeSetup(settings):
+    global clock, verbose
+    globals().update(settings)
+    clock = time
+    verbose = False
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Arcsec an image may be from the axis and still be used for it, given the
+# residuals of the images it is fitted to. Slowly turning an adjustment
+# knob moves each image only a little further, so once there are enough
+# images to tell, the limit is set by how well they fit.
+def AxisLimit(residuals):
+    n = len(residuals)
+    if n < 4:
+        return AXIS_MAX_RESIDUAL
+    rms = math.sqrt(sum(r*r for r in residuals) / (n - 2))
+    return min(AXIS_MAX_RESIDUAL, AXIS_REJECT * max(rms, AXIS_MIN_NOISE))
+
+# Works out the adjustment from a solved image, in a worker. frame is
+# (samples, sample, lat, I2Alt, I2Az, ilst2, TargetHA, TargetDec), where
+# sample is (RA, DEC, LST, THA) of the image, as for PASolve, samples the
+# images the polar axis is fitted to (None if it is no longer refined) and
+# the rest as for AlignmentTarget and ImageAdjustment. The image is tested
+# against the axis fitted without it - so an image taken as the mount is
+# adjusted can't drag the axis along with it - and if it fits, the target
+# is worked out from the axis refitted with it. Returns the image's
+# residual in arcsec from the axis without it (None if not tested), the
+# refit (as for PASolveN, None if the image wasn't used), the target HA
+# and Dec used, theta and phi, and the seconds taken by each stage.
+def ReduceFrame(frame):
+    samples, sample, lat, I2Alt, I2Az, ilst2, TargetHA, TargetDec = frame
+    seconds = {}
+    residual = fit = None
+    if samples is not None:
+        start = clock.monotonic()
+        tested = PASolveN(samples, test=[sample])
+        if tested is not None:
+            residual = tested[2][-1]
+            if residual < AxisLimit(tested[2][:-1]):
+                fit = PASolveN(samples + [sample])
+        seconds["pasolve"] = clock.monotonic() - start
+        if fit is not None:
+            TargetHA, TargetDec = \
+                AlignmentTarget(fit[0], fit[1], lat, I2Alt, I2Az)[4:]
+
+    start = clock.monotonic()
+    ira, idec, ilst, iha = sample
+    theta, phi = ImageAdjustment(ira, idec, ilst, lat, ilst2,
+                                 TargetHA, TargetDec)
+    seconds["rotation"] = clock.monotonic() - start
+    return residual, fit, (TargetHA, TargetDec), theta, phi, seconds
+
+# Works out the session's calculations. Set up by AlignmentSession.
+compute = ComputeExecutor()
+
+# Works out the adjustment from each image after the first two with
+# compute, while the next image is taken, and reports them in turn:
+# refines the polar axis with the images for as long as they fit it (see
+# AXIS_FIT), smooths the adjustments and puts them on the queue. Each image
+# waits for the one before, whose fit it uses - normally long since done.
+class FrameReducer:
+    def __init__(self, queue, lat, I2Alt, I2Az, ilst2, TargetHA, TargetDec,
+                 samples, fitting, smoothing):
+        self.queue = queue
+        self.site = (lat, I2Alt, I2Az, ilst2)
+        self.target = (TargetHA, TargetDec)
+        self.samples = samples
+        self.fitting = fitting
+        self.rejected = 0 # Number of images in a row which didn't fit
+        self.smoothing = smoothing
+        self.pending = None
+
+    # Starts on image n, solved at sample (RA, DEC, LST, THA). weight is as
+    # for AlignmentFilter, and exposed when its exposure started.
+    def submit(self, n, sample, weight=1.0, exposed=None):
+        self.wait()
+        frame = (list(self.samples) if self.fitting else None, sample) + \
+            self.site + self.target
+        sent, measured = clock.time(), clock.monotonic()
+        self.pending = compute.submit(
+            ReduceFrame, frame,
+            done=lambda future: self.report(future, n, sample, weight,
+                                            exposed, sent, measured))
+
+    # Waits until the last image has been reported
+    def wait(self):
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            pending.result()
+
+    def report(self, future, n, sample, weight, exposed, sent, measured):
+        residual, fit, target, theta, phi, seconds = future.result()
+        for stage, taken in seconds.items():
+            timing.Add(stage, taken, sent)
+
+        # Use the image for the polar axis if it fits
+        if self.fitting:
+            if fit is not None:
+                self.samples.append(sample)
+                self.rejected = 0
+                self.target = target
+                if verbose:
+                    print("Axis residuals", \
+                          " ".join("%.1f" % r for r in fit[2]))
+                if len(self.samples) >= AXIS_MAX_IMAGES:
+                    self.fitting = False
+                    self.queue.put(logtime() + AxisSummary(fit[2]))
+            else:
+                self.rejected += 1
+                if residual is not None:
+                    self.queue.put(logtime() + "Image is " + \
+                                   DegFormat(residual/3600.0) + \
+                                   " from the polar axis, not used for it")
+                # Two in a row means the mount has moved
+                if self.rejected >= 2:
+                    self.fitting = False
+                    self.queue.put(logtime() + "Mount has been adjusted. " + \
+                                   AxisSummary(PASolveN(self.samples)[2]))
+
+        if SMOOTH:
+            theta, phi, etheta, ephi = \
+                self.smoothing.update(theta, phi, weight, measured)
+        else:
+            etheta, ephi = SMOOTH_NOISE * weight, SMOOTH_NOISE * weight
+
+        if simulating: # Test of interface
+            # Gradually increase theta and phi
+            theta = (theta+n*0.1)*(-1)**n
+            phi = (phi+n*0.1)*(-1)**n
+
+        # Sent as of when the image was measured, so its dispatch and
+        # photon times are those of its frame
+        self.queue.put(Adjustment(theta, phi, etheta, ephi, sent, exposed))
+        if phi > 0:
+            self.queue.put(logtime()+"Azimuth: Rotate mount counter clockwise by " + \
+                  DegFormat(abs(phi)) + " +/- " + DegFormat(ephi))
+        else:
+            self.queue.put(logtime()+"Azimuth: Rotate mount clockwise by " + \
+                  DegFormat(abs(phi)) + " +/- " + DegFormat(ephi))
+
+        if theta > 0:
+            self.queue.put(logtime()+"Altitude: lower mount by " + \
+                  DegFormat(abs(theta)) + " +/- " + DegFormat(etheta))
+        else:
+            self.queue.put(logtime()+ "Altitude: raise mount by " + \
+                  DegFormat(abs(theta)) + " +/- " + DegFormat(etheta))
+
+# Resets image bin and filter state
+# Puts the binning, filter and subframe back as they were before the PA
+# routine, in one round trip. TSX only changes the ones which differ.
+def RestoreCameraState():
+    global initfilter, initsubframe
+    batch = TSXBatch()
+    batch.add(SYNCHRONOUS_SCRIPT)
+    ibin = batch.add(RestoreBinScript(initbin), lambda data: int(data[0]))
+    if initsubframe is not None:
+        isub = batch.add(SetSubframeScript(*initsubframe))
+    if CAM_FILTER != "":
+        ifilter = batch.add(RestoreFilterScript(initfilter))
+    results = batch.run()
+
+    if results[ibin].ok:
+        queue.put(logtime()+"Reset camera bin state")
+    else:
+        print(logtime() + "Could not reset binning: " + results[ibin].error)
+    if initsubframe is not None:
+        initsubframe = None
+        if results[isub].ok:
+            queue.put(logtime()+"Reset camera subframe")
+        else:
+            print(logtime() + "Could not reset subframe: " + results[isub].error)
+    if CAM_FILTER != "":
+        if results[ifilter].ok:
+            queue.put(logtime()+"Reset filter wheel position")
+        else:
+            print(logtime() + "Could not reset filter: " + results[ifilter].error)
+    devicecache.Save()
+        
+# Runs the PA routine in the worker thread. Whatever stops it, tidies up
+# and only then reports Finished, so a new session can't be started while
+# this one is still using the connection, recorder and timing report.
+# compute is the session's executor for the calculations, closed once here.
+def RunPolarAlign(queue, compute):
+    try:
+        try:
+            try:
+                PolarAlign(queue)
+            except TSXCancelled:
+                # Asked to stop part way through taking an image or slewing
+                StopDevices()
+                queue.put(logtime() + "Stopped polar alignment routine")
+                RestoreCameraState()
+        except TSXConnectionError as e:
+            if verbose: print(e)
+            if isinstance(e, ReplayError):
+                queue.put("!"+logtime()+"Replay stopped: "+str(e))
+            elif isinstance(e, TSXTimeoutError):
+                queue.put("!"+logtime()+"TSX stopped responding: "+str(e))
+            else:
+                queue.put("!"+logtime()+"Could not connect to TSX. Is TSX runnng?")
+                queue.put("!"+logtime()+"Have you enabled the TSX TCP server?")
+        except Exception as e:
+            # E.g. a reply from TSX which can't be read. Put the camera back
+            # if TSX is still talking to us.
+            sessionlog.exception("Polar alignment failed")
+            queue.put("!"+logtime()+"Polar alignment failed: "+repr(e))
+            with contextlib.suppress(Exception):
+                RestoreCameraState()
+    finally:
+        try:
+            # Waits for, and reports, the image being worked out
+            compute.Close()
+            tsx.close()
+            StopRecording()
+            WriteTimingReport()
+            if isinstance(tsx, TSXReplay) and tsx.Remaining():
+                print(logtime() + "%d records of the trace were not replayed" %
+                      tsx.Remaining())
+        finally:
+            finish_async_code()
+
+def PolarAlign(queue):
+    global initbin
+    
+    # if using test data from Mathematica, read in from file
+    if testdata:
+        # Store current bin state
+        initbin = GetImageBin()
+        lstdat = []
+        thadat = []
+        radat = []
+        decdat = []
+        npoints = 0
+        
+        for line in open("test.data"):
+            listWords = line.split("\t")
+            if listWords[0] != "\n":
+                lstdat.append(float(listWords[0]))
+                thadat.append(float(listWords[1]))
+                radat.append(float(listWords[2]))
+                decdat.append(float(listWords[3]))
+                npoints += 1
+
+    else:
+        # Start up - connect to all devices and store the current bin and
+        # filter state - exit if there is an error
+        err = BringUpDevices()
+        if err:
+            queue.put("!"+err)
+            return
+        
+    # Now slew to first target point
+    # First Get Long, Lat, LST and UT (only need LST) to convert to RA
+    lat, longitude, LST, UT =  LatLongLstUT()
+    ha1, ha2, dec, here = HAI1, HAI2, PA_DEC, False
+    # Simulated DSS images are of the usual positions
+    if PLAN_POINTS and not testdata and not simulating:
+        ha1, ha2, dec, here = PlanAlignment(lat, LST)
+    
+    RA1 = LST - ha1
+    
+    if end_async_code_check():
+        queue.put(logtime() + "Stopped polar aligment routine.")
+        # Restore initial camera state
+        RestoreCameraState()
+        
+        return
+
+    else:
+        timing.StartFrame(1)
+        if not testdata:
+            # Ensure mount is unparked
+            unpark()
+            if not here:
+                queue.put(logtime() + "Slewing to first polar alignment point")
+                SlewToRaAndDec(RA1, dec, "PA 1")
+        
+    if end_async_code_check():
+        queue.put(logtime() + "Completed Slewing")
+        # Restore initial camera state
+        RestoreCameraState()
+
+        return
+    else:
+        if not testdata:
+            queue.put(logtime() + "Taking first image")
+            # Take, read headers and plate solve in one round trip
+            iha1, ilst1, ierr, ierrsolve, ira1, idec1 = \
+                CaptureAndSolve(CAM_DURATION, CAM_BINNING, CAM_SCALE, stats={})
+        
+    #iha1, ilst1, ira1, idec1 = GetTestImageLinkResults("/home/stellarmate/TheSkyXImages/February 24 2024/PA_1_4x4_4.000secs_-10.00C_00001422.fit")
+    if testdata:
+        iha1, ilst1, ira1, idec1 = GetTestDat(thadat, lstdat, radat, decdat, 0)
+    else:
+        if simulating: # DSS images do not containt HA and LST data
+            iha1 = ha1
+
+        if (ierr > 0 or ierrsolve > 0):
+            queue.put("!"+logtime()+"Exiting. Could not image link image")
+            # Restore initial camera state
+            RestoreCameraState()
+            return
+    
+        queue.put(logtime() + "Image HA: " + HourFormat(iha1) + " LST: " + HourFormat(ilst1))
+        queue.put(logtime() + "Solved image RA: " + HourFormat(ira1) + \
+              " and Dec: " + DegFormat(idec1))
+    timing.EndFrame()
+    
+    # Repeat for second point
+    lat, longitude, LST, UT =  LatLongLstUT()
+    RA2 = LST - ha2
+
+    if end_async_code_check():
+        queue.put(logtime() + "Completed taking first image")
+        # Restore initial camera state
+        RestoreCameraState()
+        return
+    
+    else:
+        timing.StartFrame(2)
+        if not testdata:
+            queue.put(logtime() + "Slewing to second polar alignment point")
+            SlewToRaAndDec(RA2, dec, "PA 2")
+
+    if end_async_code_check():
+        queue.put(logtime() + "Completed slewing to second alignment point")
+        # Restore initial camera state
+        RestoreCameraState()
+        return
+    
+    else:
+        if not testdata:
+            queue.put(logtime() + "Taking second image")
+            solve2 = {}
+            iha2, ilst2, ierr, ierrsolve, ira2, idec2 = \
+                CaptureAndSolve(CAM_DURATION, CAM_BINNING, CAM_SCALE,
+                                stats=solve2)
+
+    if testdata:
+        iha2, ilst2, ira2, idec2 = GetTestDat(thadat, lstdat, radat, decdat, 1)
+    else:
+        if simulating: # DSS images don't contain HA and LST data 
+            iha2 = ha2
+
+        if (ierr > 0 or ierrsolve > 0):
+            queue.put("!"+logtime()+"Exiting. Could not image link image")
+            # Restore initial camera state
+            RestoreCameraState()
+            return
+
+        queue.put(logtime() + "Image HA: " + HourFormat(iha2) + \
+                  " LST: " + HourFormat(ilst2))
+        queue.put(logtime() + "Solved image RA: " + HourFormat(ira2) + \
+                      " and Dec: " + DegFormat(idec2))
+    
+    # Set up variables for polar alignment solution
+    D1 = idec1
+    RA1 = ira1
+    LST1 = ilst1
+    THA1 = iha1
+    D2 = idec2
+    RA2 = ira2
+    LST2 = ilst2
+    THA2 = iha2
+    
+    # Test out polar alignment solution
+    #D1 = 60.0
+    #RA1 = 0.0
+    #LST1 = 0.0
+    #THA1 = 0.0
+    #D2= 61.848
+    #LST2 = 0.0
+    #RA2 = 21.3226
+    #THA2 = 3.0
+    
+    with timing.Stage("pasolve"):
+        PAHA, PADEC = PASolve(RA1, D1, LST1, THA1, RA2, D2, LST2, THA2)
+    
+    # Now work out alt az of last image so can compare against new images
+    I2HA = ilst2 - ira2
+    I2Alt, I2Az = AltAzfromHADECLat(I2HA, idec2, lat)
+
+    # Work out where the last image would be with the mount aligned
+    PAAlt, PAAz, TargetAlt, TargetAz, TargetHA, TargetDec = \
+        AlignmentTarget(PAHA, PADEC, lat, I2Alt, I2Az)
+        
+    queue.put(logtime()+"PA Alt: "+ DegFormat(PAAlt) +  " PAAz: "+ DegFormat(PAAz))
+    queue.put(logtime()+ "Alt change: " + DegFormat(PAAlt-lat) + \
+              " Az Change: " + DegFormat(PAAz))
+
+    with timing.Stage("rotation"):
+        theta, phi = SolveRotation(I2Alt, I2Az, TargetAlt, TargetAz)
+    # Adjust theta, phi depending on the hemisphere:
+    # Code below mutiplies by -1 if southern hemisphere, 1 if Northern
+    theta = theta * math.copysign(1, lat)
+    phi   = phi   * math.copysign(1, lat)
+
+    # Smooth the adjustments from here on, starting from this one
+    smoothing = AlignmentFilter()
+    theta, phi, etheta, ephi = smoothing.update(theta, phi)
+    if not SMOOTH:
+        etheta, ephi = SMOOTH_NOISE, SMOOTH_NOISE
+    
+    queue.put(Adjustment(theta, phi, etheta, ephi, clock.time(),
+                         None if testdata else solve2.get("exposed")))
+    timing.EndFrame()
+    if phi > 0:
+        queue.put(logtime()+"Azimuthal: Rotate counter clockwise by " + \
+                  DegFormat(abs(phi)) + " +/- " + DegFormat(ephi))
+    else:
+        queue.put(logtime()+"Azimuthal: Rotate clockwise by " + \
+                  DegFormat(abs(phi)) + " +/- " + DegFormat(ephi))
+        
+    if theta > 0:
+        queue.put(logtime()+"Altitude: lower axis by " + \
+              DegFormat(abs(theta)) + " +/- " + DegFormat(etheta))
+    else:
+        queue.put(logtime()+ "Altitude: raise axis by " +  \
+              DegFormat(abs(theta)) + " +/- " + DegFormat(etheta))
+        
+    # Read out no more of the sensor than the solves need
+    if CAM_ROI and not testdata and not simulating and \
+       solve2.get("stars") is not None:
+        SetROI(solve2["stars"], solve2.get("scale", CAM_SCALE), CAM_BINNING)
+
+    # Refine the polar axis with the images taken from here on, for as long
+    # as they fit with the first two, i.e. until the mount is adjusted
+    fitting = AXIS_FIT and np is not None and not simulating
+    samples = [(RA1, D1, LST1, THA1), (RA2, D2, LST2, THA2)]
+    # Work out the adjustments while the next image is taken
+    reducer = FrameReducer(queue, lat, I2Alt, I2Az, ilst2, TargetHA,
+                           TargetDec, samples, fitting, smoothing)
+
+    # Comparing images needs NumPy to read them
+    tracking = CAM_TRACK and not testdata
+    if tracking and TRACK_METHOD == "image" and np is None:
+        queue.put("<"+logtime()+"NumPy is not installed so can't track images>")
+        tracking = False
+    if tracking:
+        tracker = ImageTracker(CAM_DURATION, CAM_BINNING, CAM_SCALE,
+                               TRACK_METHOD)
+    elif CAM_PIPELINE and not testdata:
+        pipeline = CapturePipeline(CAM_DURATION, CAM_BINNING, CAM_SCALE)
+
+    # Speed up the images while they plate solve reliably
+    control = ExposureControl(CAM_DURATION, CAM_BINNING, CAM_SCALE)
+
+    n = 1
+    while (not end_async_code_check()) and \
+          (True if not testdata else n < npoints-1):
+        n += 1
+        timing.StartFrame(n + 1)
+        queue.put(logtime() + "Taking image")
+        stats = {}
+        #imagepath = "/home/stellarmate/TheSkyXImages/February 24 2024/PA_2_4x4_4.000secs_-10.00C_0000" + str(1422+n) +".fit"
+        #iha, ilst, ira, idec = GetTestImageLinkResults(imagepath)
+        if testdata:
+            iha, ilst, ira, idec = GetTestDat(thadat, lstdat, radat, decdat, n)
+            ierr = 0
+            ierrsolve = 0
+            # Stand in for the time taken to take an image
+            clock.sleep(2)
+        elif tracking:
+            # Track the stars from the last solved image, or solve this one
+            iha, ilst, ierr, ierrsolve, ira, idec = tracker.next(stats=stats)
+        elif CAM_PIPELINE:
+            # Solve this image while the next one is taken
+            iha, ilst, ierr, ierrsolve, ira, idec = pipeline.next(stats=stats)
+
+            if simulating: # DSS images don't contin HA and LST data 
+                iha = ha2
+        else:
+            # Take, read headers and plate solve in one round trip
+            iha, ilst, ierr, ierrsolve, ira, idec = \
+                CaptureAndSolve(control.exp, control.bin, control.Scale(),
+                                stats=stats)
+
+            if simulating: # DSS images don't contin HA and LST data 
+                iha = ha2
+
+        if CAM_AUTO and not testdata:
+            change = control.update(ierr == 0 and ierrsolve == 0, stats)
+            if change is not None:
+                queue.put(logtime() + change)
+                if tracking:
+                    tracker.exp, tracker.bin, tracker.scale = \
+                        control.exp, control.bin, control.Scale()
+                elif CAM_PIPELINE:
+                    pipeline.exp, pipeline.bin, pipeline.scale = \
+                        control.exp, control.bin, control.Scale()
+            
+        if (ierr ==0 and ierrsolve == 0):
+            # iha is the telescope's hour angle, so the image can refine
+            # the polar axis. Tracked images can be less accurate than
+            # solved ones.
+            reducer.submit(n, (ira, idec, ilst, iha),
+                           tracker.weight if tracking else 1.0,
+                           stats.get("exposed"))
+        else:            
+            queue.put("<"+logtime()+"Could not plate solve image>")
+        timing.EndFrame()
+    reducer.wait()
+
+    if CAM_PIPELINE and not testdata and not tracking:
+        pipeline.finish()
+
+    queue.put(logtime()+"Completed Polar Alignment")
+    # Restore initial camera state
+    RestoreCameraState()
+
+    return
+
+# Message strings which may be put on the queue, e.g. by older code:
+#    Starting with |: contains the latest calculated adjustment factors
+#                    and their 1 sigma errors, as |alt|az|alterr|azerr|
+#    Starting with <: a warning message. No new data but routine will continue
+#    Starting with !: an error message. The routine will stop
+#    Other:         : contains an informational message
+# Returns the message as a dictionary with a type of "adjust", "warning",
+# "error" or "info".
+def DecodeMessage(message):
+    message = message.rstrip("\n")
+    if message[:1] == "|":
+        vals = message.split("|")
+        out = {"type": "adjust", "alt": float(vals[1]), "az": float(vals[2])}
+        # 1 sigma errors, if given
+        if len(vals) > 4 and vals[3] and vals[4]:
+            out["alt_error"] = float(vals[3])
+            out["az_error"] = float(vals[4])
+        return out
+    if message[:1] == "<":
+        end_text = message.find(">")
+        return {"type": "warning", "text": message[1:end_text]}
+    if message[:1] == "!":
+        return {"type": "error", "text": message[1:]}
+    return {"type": "info", "text": message}
+
+# Turns a message string into an event
+def MakeEvent(message):
+    out = DecodeMessage(message)
+    if out["type"] == "adjust":
+        return Adjustment(out["alt"], out["az"], out.get("alt_error"),
+                          out.get("az_error"), clock.time())
+    return Message(out["type"], out["text"], clock.time())
+
+# Returns an event as a dictionary, in the same form as DecodeMessage but
+# with its time and a type of "finished" for Finished
+def EventDict(event):
+    if isinstance(event, Adjustment):
+        out = {"type": "adjust", "alt": event.alt, "az": event.az}
+        if event.alt_error is not None and event.az_error is not None:
+            out["alt_error"] = event.alt_error
+            out["az_error"] = event.az_error
+        if event.exposed is not None:
+            out["exposed"] = event.exposed
+    elif isinstance(event, Finished):
+        out = {"type": "finished"}
+    else:
+        out = {"type": event.type, "text": event.text}
+    out["time"] = event.time
+    return out
+
+# Turns a dictionary from EventDict back into an event, e.g. for a program
+# reading the lines printed by main
+def EventFromDict(out):
+    if out["type"] == "adjust":
+        return Adjustment(out["alt"], out["az"], out.get("alt_error"),
+                          out.get("az_error"), out["time"],
+                          out.get("exposed"))
+    if out["type"] == "finished":
+        return Finished(out["time"])
+    return Message(out["type"], out["text"], out["time"])
+
+######################### DASHBOARD ####################################
+# The dashboard page. It is sent once, and then kept up to date by the
+# events sent by Dashboard.
+DASHBOARD_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Polar Alignment</title>
+<style>
+body { font-family: Helvetica, sans-serif; margin: 1em; }
+#axes { display: flex; gap: 3em; text-align: center; }
+.arrow { font-size: 60px; } .value { font-size: 28px; }
+.sigma, #timing, #log { font-size: 13px; } #timing { color: #555; }
+#log { white-space: pre-wrap; } .warning { color: #c60; } .error { color: red; }
+</style></head><body>
+<div id="axes">
+<div>Altitude<div id="alt-arrow" class="arrow">&uarr;</div>
+<div id="alt" class="value">Waiting</div><div id="ae" class="sigma"></div></div>
+<div>Azimuth<div id="az-arrow" class="arrow">&#10226;</div>
+<div id="az" class="value">Waiting</div><div id="ze" class="sigma"></div></div>
+</div>
+<p id="timing"></p><p id="status"></p><div id="log"></div>
+<script>
+var adjust, timing, lines, type;
+function $(id) { return document.getElementById(id); }
+function colour(s) { s = Math.abs(s); return s > 3600 ? "red" : s > 612 ? "#c90" : "green"; }
+function dms(s) {
+  s = Math.abs(s);
+  return Math.floor(s / 3600) + "\\u00b0 " + Math.floor(s / 60) % 60 + "' " + s % 60 + '"';
+}
+function waiting(text) {
+  ["alt", "az"].forEach(function(axis) {
+    $(axis).textContent = text; $(axis).style.color = "black";
+  });
+  $("ae").textContent = $("ze").textContent = "";
+}
+function reset() {
+  adjust = {}; timing = {}; lines = []; type = "info";
+  waiting("Waiting"); $("timing").textContent = $("log").textContent = "";
+  $("status").textContent = "";
+}
+function showAdjust() {
+  $("alt").textContent = dms(adjust.alt); $("az").textContent = dms(adjust.az);
+  $("alt-arrow").textContent = adjust.alt > 0 ? "\\u2193" : "\\u2191";
+  $("az-arrow").textContent = adjust.az > 0 ? "\\u27f2" : "\\u27f3";
+  $("alt").style.color = $("alt-arrow").style.color = colour(adjust.alt);
+  $("az").style.color = $("az-arrow").style.color = colour(adjust.az);
+  if (adjust.ae !== undefined) {
+    $("ae").textContent = "\\u00b1 " + dms(adjust.ae);
+    $("ze").textContent = "\\u00b1 " + dms(adjust.ze);
+  }
+}
+function on(name, show) {
+  source.addEventListener(name, function(e) { show(JSON.parse(e.data)); });
+}
+var source = new EventSource("events");
+source.onerror = function() { $("status").textContent = "Reconnecting..."; };
+on("reset", reset);
+on("adjust", function(d) { Object.assign(adjust, d); showAdjust(); });
+on("message", function(d) {
+  if (d.type) type = d.type;
+  if (type == "warning") waiting("Waiting");
+  if (type == "error") waiting("Error");
+  lines.push([type, d.text]);
+  if (lines.length > MAX_LINES) lines.shift();
+  $("log").textContent = "";
+  lines.forEach(function(line) {
+    var div = document.createElement("div");
+    div.className = line[0]; div.textContent = line[1];
+    $("log").appendChild(div);
+  });
+});
+on("timing", function(d) {
+  if ("frame" in d) timing = {};
+  Object.assign(timing, d);
+  var text = "Image " + timing.frame + ":";
+  for (var stage in timing)
+    if (stage != "frame") text += " " + stage + " " + timing[stage].toFixed(2) + " s";
+  $("timing").textContent = text;
+});
+on("finished", function() { $("status").textContent = "Finished"; });
+</script></body></html>
+""".replace("MAX_LINES", str(DASHBOARD_LINES))
+
+# Returns a Server-Sent Event, ready to send
+def SSEvent(name, data):
+    return ("event: " + name + "\ndata: " + \
+            json.dumps(data, separators=(",", ":"), ensure_ascii=False) + \
+            "\n\n").encode("utf-8")
+
+# Returns the values in new which differ from those in old, and updates old
+def Changes(old, new):
+    changed = {key: value for key, value in new.items()
+               if old.get(key) != value}
+    old.update(changed)
+    return changed
+
+# Sends the events from the PA routine, and the time each image took, to
+# the dashboard pages as Server-Sent Events. Each holds only what has
+# changed, so an update is a few hundred bytes:
+#    reset     {} - forget everything, e.g. when a new session starts
+#    adjust    {"alt": 1800, "az": -600, "ae": 36, "ze": 36} - the
+#              adjustment and its 1 sigma errors (if known) in arcsec
+#    message   {"type": "info", "text": "..."} - type is left out if it is
+#              the same as for the last message
+#    timing    {"frame": 3, "imagelink": 2.1, ...} - seconds for each stage
+#              of the latest image. A new frame is sent in full.
+#    finished  {} - the PA routine has finished
+# A page which connects (or reconnects) is first sent everything so far.
+class Dashboard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = []
+        self.adjust = {}
+        self.timing = {}
+        self.lines = collections.deque(maxlen=DASHBOARD_LINES)
+        self.finished = False
+
+    # Queues an event for every page. A page with DASHBOARD_QUEUE waiting,
+    # e.g. over a stalled link, is sent None to drop it instead; its browser
+    # connects again and is sent everything afresh. Called with lock held.
+    def Send(self, name, data):
+        data = SSEvent(name, data)
+        for client in list(self.clients):
+            if client.qsize() < DASHBOARD_QUEUE:
+                client.put(data)
+            else:
+                client.put(None)
+                self.clients.remove(client)
+
+    def NewSession(self):
+        with self.lock:
+            self.adjust = {}
+            self.timing = {}
+            self.lines.clear()
+            self.finished = False
+            self.Send("reset", {})
+
+    def Publish(self, event):
+        with self.lock:
+            if isinstance(event, Adjustment):
+                values = {"alt": event.alt, "az": event.az,
+                          "ae": event.alt_error, "ze": event.az_error}
+                changed = Changes(self.adjust, {
+                    key: int(round(value * 3600))
+                    for key, value in values.items() if value is not None})
+                if changed:
+                    self.Send("adjust", changed)
+            elif isinstance(event, Finished):
+                self.finished = True
+                self.Send("finished", {})
+            else:
+                data = {"text": event.text}
+                if not self.lines or self.lines[-1][0] != event.type:
+                    data["type"] = event.type
+                self.lines.append((event.type, event.text))
+                self.Send("message", data)
+
+    # Sends the stage times of a frame from StageTimer
+    def Timing(self, frame):
+        values = {stage: round(seconds, 2) for stage, seconds in frame.items()
+                  if stage not in ("frame", "time")}
+        values["frame"] = frame["frame"]
+        with self.lock:
+            if self.timing.get("frame") != frame["frame"]:
+                self.timing = {}
+            changed = Changes(self.timing, values)
+            if changed:
+                self.Send("timing", changed)
+
+    # Adds a page, which is sent the events put on client (a queue) from
+    # now on. Returns the events describing everything so far.
+    def Connect(self, client):
+        with self.lock:
+            events = [b"retry: 2000\n\n", SSEvent("reset", {})]
+            for kind, text in self.lines:
+                events.append(SSEvent("message", {"type": kind, "text": text}))
+            if self.adjust:
+                events.append(SSEvent("adjust", self.adjust))
+            if self.timing:
+                events.append(SSEvent("timing", self.timing))
+            if self.finished:
+                events.append(SSEvent("finished", {}))
+            self.clients.append(client)
+            return events
+
+    def Disconnect(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+# Serves the dashboard page, and the events to keep it up to date
+class DashboardHandler(http.server.BaseHTTPRequestHandler):
+    # Seconds a page may take to accept data before it is dropped
+    timeout = 4 * DASHBOARD_KEEPALIVE
+
+    def do_GET(self):
+        if self.path == "/":
+            page = DASHBOARD_PAGE.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+        elif self.path == "/events":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            client = SimpleQueue()
+            try:
+                for data in self.server.dashboard.Connect(client):
+                    self.wfile.write(data)
+                while True:
+                    try:
+                        data = client.get(timeout=DASHBOARD_KEEPALIVE)
+                    except Empty:
+                        data = b":\n\n"
+                    if data is None:
+                        break # Dropped for not keeping up
+                    self.wfile.write(data)
+            except OSError:
+                pass # The page has been closed
+            finally:
+                self.server.dashboard.Disconnect(client)
+        else:
+            self.send_error(404)
+
+    # Requests aren't printed, as stdout may be the JSON lines
+    def log_message(self, format, *args):
+        pass
+
+# The dashboard, once started. It is kept for later sessions.
+dashboard = None
+
+def StartDashboard():
+    global dashboard
+    if not DASHBOARD_PORT:
+        return
+    if dashboard is None:
+        try:
+            server = http.server.ThreadingHTTPServer(
+                (DASHBOARD_HOST, DASHBOARD_PORT), DashboardHandler)
+        except OSError as e:
+            print(logtime() + "Cannot start the dashboard: " + str(e))
+            return
+        server.daemon_threads = True
+        server.dashboard = dashboard = Dashboard()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        sessionlog.info("Dashboard on port %d", DASHBOARD_PORT)
+    dashboard.NewSession()
+
+# Runs the PA routine in its own thread. Only one session can run at a time.
+# Its events are put on queue, an EventBus. on_finish is called from the
+# PA thread when it has finished.
+class AlignmentSession:
+    def __init__(self, on_finish=None):
+        self.queue = EventBus()
+        self.stop_event = threading.Event()
+        self.on_finish = on_finish
+        self.thread = None
+        self.timing = StageTimer(PROFILE)
+        self.compute = None
+
+    def start(self):
+        global queue, stop_event, async_running, on_finish, timing, compute
+        if async_running:
+            raise RuntimeError("Polar alignment is already running")
+        queue = self.queue
+        timing = self.timing
+        stop_event = self.stop_event
+        on_finish = self.on_finish
+        async_running = True
+        StartSessionLog()
+        sessionlog.info("Session started: TSX %s:%d, %gs bin %d, filter %s, "
+                        "pipeline %s, track %s, auto %s, roi %s", TSX_HOST,
+                        TSX_PORT, CAM_DURATION, CAM_BINNING, CAM_FILTER,
+                        CAM_PIPELINE, CAM_TRACK, CAM_AUTO, CAM_ROI)
+        StartRecording()
+        StartDashboard()
+        # Profiling needs the calculations done in this process
+        compute = self.compute = ComputeExecutor(0 if PROFILE else
+                                                 COMPUTE_WORKERS)
+        self.thread = threading.Thread(target=RunPolarAlign,
+                                       args=(queue, self.compute))
+        self.thread.start()
+
+    # Asks the PA routine to stop once it is safe to do so
+    def stop(self):
+        self.stop_event.set()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    # Returns the events from the PA routine as dictionaries (see
+    # EventDict) as they arrive, until it has finished
+    def messages(self, poll=0.1):
+        while True:
+            event = self.queue.get(timeout=poll)
+            if event is None:
+                if not self.running() and self.queue.empty():
+                    return
+                continue
+            yield EventDict(event)
+            if isinstance(event, Finished):
+                return
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Polar alignment using "
+                                     "TSX. Prints updates as JSON lines.")
+    parser.add_argument("--host", default=TSX_HOST,
+                        help="address of the TSX TCP server")
+    parser.add_argument("--port", type=int, default=TSX_PORT,
+                        help="port of the TSX TCP server")
+    parser.add_argument("--exposure", type=float, default=CAM_DURATION,
+                        help="seconds for each image")
+    parser.add_argument("--binning", type=int, default=CAM_BINNING)
+    parser.add_argument("--scale", type=float, default=CAM_SCALE,
+                        help="arcsec/pixel of the binned image")
+    parser.add_argument("--filter", default=CAM_FILTER,
+                        help="filter to use for plate solving")
+    parser.add_argument("--pipeline", action="store_true",
+                        default=CAM_PIPELINE,
+                        help="take the next image while the last is solved")
+    parser.add_argument("--track", action="store_true", default=CAM_TRACK,
+                        help="track the stars between plate solves")
+    parser.add_argument("--track-method", choices=["image", "stars"],
+                        default=TRACK_METHOD,
+                        help="compare the images, or the stars TSX finds")
+    parser.add_argument("--solve-every", type=int, default=TRACK_SOLVE_EVERY,
+                        help="when tracking, plate solve every n images")
+    parser.add_argument("--auto", action="store_true", default=CAM_AUTO,
+                        help="adjust the exposure and binning to the "
+                        "quickest that plate solve")
+    parser.add_argument("--min-exposure", type=float, default=CAM_MIN_DURATION,
+                        help="shortest exposure when adjusting it")
+    parser.add_argument("--max-exposure", type=float, default=CAM_MAX_DURATION,
+                        help="longest exposure when adjusting it")
+    parser.add_argument("--max-binning", type=int, default=CAM_MAX_BINNING,
+                        help="most binning when adjusting it")
+    parser.add_argument("--roi", action="store_true", default=CAM_ROI,
+                        help="read out only as much of the sensor as is "
+                        "needed to plate solve")
+    parser.add_argument("--no-plan", dest="plan", action="store_false",
+                        default=PLAN_POINTS,
+                        help="take the images at --dec, --ha1 and --ha2 "
+                        "instead of choosing where")
+    parser.add_argument("--accuracy", type=float, default=PLAN_ACCURACY,
+                        help="when choosing where to take the images, the "
+                        "likely error wanted in arcsec")
+    parser.add_argument("--dec", type=float, default=PA_DEC,
+                        help="declination of the two alignment images")
+    parser.add_argument("--ha1", type=float, default=HAI1,
+                        help="hour angle of the first image")
+    parser.add_argument("--ha2", type=float, default=HAI2,
+                        help="hour angle of the second image")
+    parser.add_argument("--solver", choices=["brute", "lm"],
+                        default=ROT_SOLVER,
+                        help="how to work out the adjustment for each image")
+    parser.add_argument("--no-smooth", dest="smooth", action="store_false",
+                        default=SMOOTH,
+                        help="don't smooth the adjustments over several "
+                        "images")
+    parser.add_argument("--workers", type=int, default=COMPUTE_WORKERS,
+                        help="processes to work out the adjustments in (0 "
+                        "to work them out in the PA thread)")
+    parser.add_argument("--frames", type=int, default=0,
+                        help="stop after this many adjustments (0 for no "
+                        "limit)")
+    parser.add_argument("--log", default=LOG_FILE,
+                        help="file to keep the session log in (\"\" for "
+                        "none)")
+    parser.add_argument("--timing-dir", default=TIMING_DIR,
+                        help="directory for the timing report of each "
+                        "session (\"\" for none)")
+    parser.add_argument("--profile", action="store_true", default=PROFILE,
+                        help="profile the calculations, saved with the "
+                        "timing report")
+    parser.add_argument("--record-dir", default=RECORD_DIR,
+                        help="directory to record each session in (\"\" "
+                        "for none)")
+    parser.add_argument("--replay", metavar="TRACE",
+                        help="replay a recorded session instead of using "
+                        "TSX, with the settings it was recorded with")
+    parser.add_argument("--fast", action="store_true",
+                        help="when replaying, don't wait for TSX or the "
+                        "camera")
+    parser.add_argument("--dashboard", type=int, default=DASHBOARD_PORT,
+                        metavar="PORT",
+                        help="show the alignment on a web page on this port "
+                        "(0 for none)")
+    parser.add_argument("--dashboard-host", default=DASHBOARD_HOST,
+                        metavar="ADDRESS",
+                        help="address the web page is served on - \"\" for "
+                        "every address, so other computers can see it")
+    parser.add_argument("--stop-on-eof", action="store_true",
+                        help="stop when stdin is closed, for when run by "
+                        "another program")
+    parser.add_argument("--verbose", action="store_true", default=verbose)
+    return parser.parse_args(argv)
+
+# Sets the module settings from the command line arguments
+def ApplyArgs(args):
+    global TSX_HOST, TSX_PORT, CAM_DURATION, CAM_BINNING, CAM_SCALE, \
+        CAM_FILTER, CAM_PIPELINE, CAM_TRACK, TRACK_METHOD, \
+        TRACK_SOLVE_EVERY, CAM_AUTO, CAM_MIN_DURATION, CAM_MAX_DURATION, \
+        CAM_MAX_BINNING, CAM_ROI, PA_DEC, HAI1, HAI2, PLAN_POINTS, \
+        PLAN_ACCURACY, ROT_SOLVER, SMOOTH, COMPUTE_WORKERS, LOG_FILE, \
+        TIMING_DIR, PROFILE, RECORD_DIR, DASHBOARD_PORT, DASHBOARD_HOST, \
+        verbose
+    TSX_HOST = args.host
+    TSX_PORT = args.port
+    tsx.host = args.host
+    tsx.port = args.port
+    CAM_DURATION = args.exposure
+    CAM_BINNING = args.binning
+    CAM_SCALE = args.scale
+    CAM_FILTER = args.filter
+    CAM_PIPELINE = args.pipeline
+    CAM_TRACK = args.track
+    TRACK_METHOD = args.track_method
+    TRACK_SOLVE_EVERY = args.solve_every
+    CAM_AUTO = args.auto
+    CAM_MIN_DURATION = args.min_exposure
+    CAM_MAX_DURATION = args.max_exposure
+    CAM_MAX_BINNING = args.max_binning
+    CAM_ROI = args.roi
+    PA_DEC = args.dec
+    HAI1 = args.ha1
+    HAI2 = args.ha2
+    PLAN_POINTS = args.plan
+    PLAN_ACCURACY = args.accuracy
+    ROT_SOLVER = args.solver
+    SMOOTH = args.smooth
+    COMPUTE_WORKERS = args.workers
+    LOG_FILE = args.log
+    TIMING_DIR = args.timing_dir
+    PROFILE = args.profile
+    RECORD_DIR = args.record_dir
+    DASHBOARD_PORT = args.dashboard
+    DASHBOARD_HOST = args.dashboard_host
+    verbose = args.verbose
+
+# Runs the alignment from the command line, writing each message as a line
+# of JSON to stdout. Anything else the engine prints goes to stderr so the
+# output can be read by another program.
+def main(argv=None):
+    args = ParseArgs(argv)
+    ApplyArgs(args)
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    if args.replay:
+        try:
+            StartReplay(args.replay, args.fast)
+        except (OSError, ValueError, KeyError, EOFError) as e:
+            print("Cannot replay " + args.replay + ": " + str(e))
+            return 2
+
+    session = AlignmentSession()
+
+    # First Ctrl-C stops, abandoning the image or slew in progress unless
+    # STOP_ABORT is False, and a second one exits
+    def interrupt(signum, frame):
+        if session.stop_event.is_set():
+            raise KeyboardInterrupt
+        session.stop()
+    signal.signal(signal.SIGINT, interrupt)
+
+    # Whoever started us stops us by closing stdin. It's read without
+    # sys.stdin, whose lock would be held by this thread in the compute
+    # workers forked while it waits, hanging them when they close stdin.
+    def watch():
+        while os.read(sys.stdin.fileno(), 4096):
+            pass
+        session.stop()
+    if args.stop_on_eof:
+        threading.Thread(target=watch, daemon=True).start()
+
+    session.start()
+    nadjust = 0
+    error = False
+    finished = False
+    for message in session.messages():
+        out.write(json.dumps(message) + "\n")
+        out.flush()
+        if message["type"] == "error":
+            error = True
+        if message["type"] == "adjust":
+            session.timing.Shown(message["time"], message.get("exposed"))
+            nadjust += 1
+            if args.frames and nadjust >= args.frames:
+                session.stop()
+        finished = message["type"] == "finished"
+    session.join()
+    if not finished:
+        out.write(json.dumps({"type": "finished", "time": clock.time()}) + \
+                  "\n")
+        out.flush()
+    StopSessionLog()
+    return 1 if error else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,435 @@
+#!/usr/bin/env -S python3 -u
+#
+# Polar aligns several piers at once, each with its own TSX, e.g. all the
+# piers under a roll-off roof at dusk. Each pier is aligned by its own copy
+# of PAEngine.py, run as a separate program with its own TSX address,
+# camera settings, log, timing reports and recordings, so the piers are
+# aligned at the same time (the whole site takes as long as the slowest
+# pier) and a problem with one pier can't hold up the others. Their
+# adjustments are shown side by side in one window.
+#
+# To run this program type:
+#
+# PASite.py or python3 PASite.py --help
+#
+# Set up the piers in PIERS below, or in a JSON file given with --piers
+# holding a list in the same form. Other options are passed on to
+# PAEngine.py for every pier, e.g. --exposure 2. With --no-window each
+# update is printed as a line of JSON, as by PAEngine.py, with the name of
+# its pier added, e.g.
+#
+# {"pier": "Pier 1", "type": "adjust", "alt": 0.5, "az": -0.33, ...}
+
+import argparse
+import json
+import os.path
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# The window is optional, e.g. on a computer without a display
+try:
+    import tkinter as tk
+    from tkinter import messagebox
+except ImportError:
+    tk = None
+
+# The settings, and how the updates are passed back, are as for PAEngine.py
+import PAEngine
+from PAEngine import EventBus, Adjustment, Message, Finished, DegFormat, \
+    logtime, EventDict, EventFromDict
+
+# The piers. Each has a name and the address of its TSX TCP server, and
+# may have any of the settings PAEngine.py takes on the command line, by
+# their long names without the "--", e.g. "exposure": 2.0, "binning": 2,
+# "filter": "Lum". Switches are given as true, e.g. "pipeline": True,
+# "no-smooth": True. Anything not given is as set in PAEngine.py.
+PIERS = [
+    {"name": "Pier 1", "host": "127.0.0.1", "port": 3040},
+]
+
+# Piers shown in each row of the window
+COLUMNS      = 3
+
+# Seconds to wait for the piers to stop when the window is closed, before
+# giving up on them
+CLOSE_WAIT   = 30.0
+
+######################### CODE #########################################
+# PAEngine.py, which aligns each pier
+ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "PAEngine.py")
+
+# Name of a pier for its files, e.g. "Pier 1" -> "Pier-1"
+def PierSlug(name):
+    return re.sub(r"[^A-Za-z0-9]+", "-", name).strip("-") or "pier"
+
+# Returns the command line options for PAEngine.py from the settings of a
+# pier. Unless they are given, its session log is kept next to LOG_FILE
+# and its timing reports and recordings in a directory of their own, all
+# named after the pier.
+def PierArgs(settings):
+    settings = dict(settings)
+    slug = PierSlug(settings.pop("name"))
+    if "log" not in settings and PAEngine.LOG_FILE:
+        base, ext = os.path.splitext(PAEngine.LOG_FILE)
+        settings["log"] = base + "-" + slug + ext
+    for key, directory in (("timing-dir", PAEngine.TIMING_DIR),
+                           ("record-dir", PAEngine.RECORD_DIR)):
+        if key not in settings and directory:
+            settings[key] = os.path.join(directory, slug)
+    argv = []
+    for key, value in settings.items():
+        option = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(option)
+        elif value is not False and value is not None:
+            argv += [option, str(value)]
+    return argv
+
+# Reads the piers from a JSON file, in the same form as PIERS
+def ReadPiers(path):
+    with open(path) as f:
+        piers = json.load(f)
+    if not isinstance(piers, list) or \
+       not all(isinstance(pier, dict) and "name" in pier for pier in piers):
+        raise ValueError("expected a list of piers, each with a name")
+    return piers
+
+# One pier being aligned. Runs PAEngine.py for it and puts what it prints
+# on queue as events, as an AlignmentSession would. Can be started again
+# once it has finished.
+class Pier:
+    def __init__(self, settings, common=()):
+        self.name = settings["name"]
+        # Options for every pier come first, so the pier's own win
+        self.argv = list(common) + PierArgs(settings)
+        self.queue = EventBus()
+        self.process = None
+        self.finished = threading.Event()
+        self.finished.set()
+
+    # Checks the settings, raising ValueError if PAEngine.py won't take
+    # them (it prints why)
+    def Check(self):
+        try:
+            PAEngine.ParseArgs(self.argv)
+        except SystemExit:
+            raise ValueError("the settings for " + self.name + " are wrong")
+
+    def start(self):
+        if not self.finished.is_set():
+            return
+        self.finished.clear()
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, ENGINE, "--stop-on-eof"] + self.argv,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, text=True, bufsize=1)
+        except OSError as e:
+            self.queue.put(Message("error", logtime() + "Could not start " + \
+                                   "the alignment: " + str(e),
+                                   PAEngine.clock.time()))
+            self.queue.put(Finished(PAEngine.clock.time()))
+            self.finished.set()
+            return
+        threading.Thread(target=self.ReadEvents, daemon=True).start()
+        threading.Thread(target=self.ReadErrors, daemon=True).start()
+
+    # Asks the alignment to stop, as the Stop button does
+    def stop(self):
+        if self.running():
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    # Waits up to timeout seconds for the pier to finish. Returns True if
+    # it has.
+    def join(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    # Gives up on the alignment, e.g. if it won't stop
+    def kill(self):
+        if self.running():
+            self.process.kill()
+
+    # Turns each line printed by PAEngine.py into an event
+    def ReadEvents(self):
+        finished = False
+        for line in self.process.stdout:
+            try:
+                event = EventFromDict(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                event = Message("info", line.rstrip(), PAEngine.clock.time())
+            finished = isinstance(event, Finished)
+            self.queue.put(event)
+        code = self.process.wait()
+        if not finished:
+            self.queue.put(Message("error", logtime() + "Alignment ended " + \
+                                   "unexpectedly (exit code " + str(code) + \
+                                   ")", PAEngine.clock.time()))
+            self.queue.put(Finished(PAEngine.clock.time()))
+        self.finished.set()
+
+    # Passes on anything else PAEngine.py prints (which is also in the
+    # pier's log), marked with the pier
+    def ReadErrors(self):
+        for line in self.process.stderr:
+            sys.stderr.write("[" + self.name + "] " + line)
+
+######################### WITHOUT A WINDOW #############################
+# Prints the events from every pier as lines of JSON until they have all
+# finished. The first Ctrl-C stops every pier, a second one exits. Returns 1
+# if any pier had an error.
+def RunConsole(piers):
+    out = sys.stdout
+    wake = threading.Event()
+    for pier in piers:
+        pier.queue.wakeup = wake.set
+
+    stopping = threading.Event()
+    def interrupt(signum, frame):
+        if stopping.is_set():
+            raise KeyboardInterrupt
+        stopping.set()
+        for pier in piers:
+            pier.stop()
+    signal.signal(signal.SIGINT, interrupt)
+
+    for pier in piers:
+        pier.start()
+    error = False
+    while True:
+        done = all(pier.finished.is_set() for pier in piers)
+        wake.wait(0.5)
+        wake.clear()
+        for pier in piers:
+            for event in pier.queue.drain():
+                out.write(json.dumps(dict(pier=pier.name,
+                                          **EventDict(event))) + "\n")
+                if isinstance(event, Message) and event.type == "error":
+                    error = True
+        out.flush()
+        if done:
+            return 1 if error else 0
+
+######################### WINDOW #######################################
+# Routine to create colours for the text, as in PAUI.py
+def colour_scale(val):
+    if abs(val) > 1:
+        return 'red'
+    if abs(val) > 0.17:
+        return 'yellow'
+    return 'green'
+
+# Shows the adjustments for one pier, and its latest message
+class PierPanel:
+    def __init__(self, parent, pier):
+        self.pier = pier
+        self.frame = tk.LabelFrame(parent, text=pier.name, padx=10, pady=5)
+        self.alt_arrow = tk.Label(self.frame, text="↑", font=("Helvetica", 30))
+        self.alt_arrow.grid(row=0, column=0, padx=20)
+        self.alt_text = tk.Label(self.frame, text="Waiting",
+                                 font=("Helvetica", 16))
+        self.alt_text.grid(row=1, column=0)
+        self.alt_error = tk.Label(self.frame, text="", font=("Helvetica", 10))
+        self.alt_error.grid(row=2, column=0)
+        self.az_arrow = tk.Label(self.frame, text="⟲", font=("Helvetica", 30))
+        self.az_arrow.grid(row=0, column=1, padx=20)
+        self.az_text = tk.Label(self.frame, text="Waiting",
+                                font=("Helvetica", 16))
+        self.az_text.grid(row=1, column=1)
+        self.az_error = tk.Label(self.frame, text="", font=("Helvetica", 10))
+        self.az_error.grid(row=2, column=1)
+        self.status = tk.Label(self.frame, text="", font=("Helvetica", 10),
+                               width=40, wraplength=300, justify=tk.LEFT,
+                               anchor="w")
+        self.status.grid(row=3, column=0, columnspan=2, sticky="we")
+
+    def show_waiting(self, text):
+        self.alt_text.config(text=text, fg="black")
+        self.az_text.config(text=text, fg="black")
+        self.alt_error.config(text="")
+        self.az_error.config(text="")
+
+    # Shows the events which have arrived since the last time, as PAUI.py
+    # does
+    def show_events(self):
+        for event in self.pier.queue.drain(coalesce=True):
+            if isinstance(event, Adjustment):
+                self.alt_text.config(text=DegFormat(abs(event.alt)),
+                                     fg=colour_scale(event.alt))
+                self.az_text.config(text=DegFormat(abs(event.az)),
+                                    fg=colour_scale(event.az))
+                if event.alt_error is not None and event.az_error is not None:
+                    self.alt_error.config(text="± " + \
+                                          DegFormat(event.alt_error))
+                    self.az_error.config(text="± " + DegFormat(event.az_error))
+                self.alt_arrow.config(text="↓" if event.alt > 0 else "↑",
+                                      fg=colour_scale(event.alt))
+                self.az_arrow.config(text="⟲" if event.az > 0 else "⟳",
+                                     fg=colour_scale(event.az))
+            elif isinstance(event, Finished):
+                pass
+            elif event.type == "warning":
+                self.show_waiting("Waiting")
+                self.status.config(text=event.text, fg="black")
+            elif event.type == "error":
+                self.show_waiting("Error")
+                self.status.config(text=event.text, fg="red")
+            else:
+                self.status.config(text=event.text, fg="black")
+
+# Shows every pier in one window, with Start and Stop buttons for them all
+def RunWindow(piers):
+    root = tk.Tk()
+    root.title("Polar Alignment - " + str(len(piers)) + " piers")
+
+    grid = tk.Frame(root)
+    grid.pack(side=tk.TOP, padx=10, pady=10)
+    panels = []
+    for i, pier in enumerate(piers):
+        panel = PierPanel(grid, pier)
+        panel.frame.grid(row=i // COLUMNS, column=i % COLUMNS, padx=5, pady=5,
+                         sticky="n")
+        panels.append(panel)
+
+    button_frame = tk.Frame(root)
+    button_frame.pack(side=tk.TOP, pady=10)
+    tpoint_pointing_disabled = [False]
+    closed = [False]
+
+    def start_action():
+        if not tpoint_pointing_disabled[0]:
+            if messagebox.askquestion("Pointing", "Have you disabled Tpoint "
+                                      "pointing corrections on every "
+                                      "pier?") == "no":
+                return
+            tpoint_pointing_disabled[0] = True
+        for panel in panels:
+            panel.show_waiting("Waiting")
+            panel.status.config(text=logtime() + "Starting", fg="black")
+            panel.pier.start()
+        start_button.config(state='disabled')
+        stop_button.config(state='normal')
+        root.after(100, poll_events)
+
+    def stop_action():
+        for pier in piers:
+            pier.stop()
+        stop_button.config(state='disabled')
+
+    start_button = tk.Button(button_frame, text="Start all",
+                             command=start_action)
+    start_button.pack(side=tk.LEFT, padx=10)
+    stop_button = tk.Button(button_frame, text="Stop all",
+                            command=stop_action, state='disabled')
+    stop_button.pack(side=tk.LEFT, padx=10)
+
+    # Events from the piers wake up the window, as in PAUI.py, or are
+    # checked for every 0.1 seconds if Tcl can't be woken from another
+    # thread
+    def show_events(tkevent=None):
+        if closed[0]:
+            return
+        for panel in panels:
+            panel.show_events()
+        if all(pier.finished.is_set() for pier in piers) and \
+           all(pier.queue.empty() for pier in piers):
+            start_button.config(state='normal')
+            stop_button.config(state='disabled')
+
+    def wakeup():
+        try:
+            root.event_generate("<<PAEvents>>", when="tail")
+        except (tk.TclError, RuntimeError):
+            pass # Window has been closed
+
+    threaded_tcl = root.tk.eval("info exists tcl_platform(threaded)") == "1" \
+        or float(root.tk.call("info", "tclversion")) >= 9
+    root.bind("<<PAEvents>>", show_events)
+    if threaded_tcl:
+        for pier in piers:
+            pier.queue.wakeup = wakeup
+
+    def poll_events():
+        show_events()
+        if not threaded_tcl and not closed[0] and \
+           not all(pier.finished.is_set() for pier in piers):
+            root.after(100, poll_events)
+
+    # Stops every pier before closing, giving up on any that take more
+    # than CLOSE_WAIT seconds between them. Tk keeps running meanwhile, as
+    # in PAUI.py.
+    def on_closing():
+        if closed[0]:
+            return
+        closed[0] = True
+        for pier in piers:
+            pier.queue.wakeup = None
+            pier.stop()
+        close_when_stopped(time.monotonic() + CLOSE_WAIT)
+
+    def close_when_stopped(deadline):
+        waiting = [pier for pier in piers if not pier.finished.is_set()]
+        if waiting and time.monotonic() < deadline:
+            root.after(100, close_when_stopped, deadline)
+            return
+        for pier in waiting:
+            pier.kill()
+        root.destroy()
+
+    root.protocol("WM_DELETE_WINDOW", on_closing)
+    root.mainloop()
+    return 0
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Polar align several "
+                                     "piers at once. Other options are "
+                                     "passed on to PAEngine.py for every "
+                                     "pier.")
+    parser.add_argument("--piers", metavar="FILE",
+                        help="JSON file listing the piers, as PIERS")
+    parser.add_argument("--no-window", dest="window", action="store_false",
+                        help="print the updates as JSON lines instead of "
+                        "showing them")
+    return parser.parse_known_args(argv)
+
+def main(argv=None):
+    args, common = ParseArgs(argv)
+    settings = PIERS
+    if args.piers:
+        try:
+            settings = ReadPiers(args.piers)
+        except (OSError, ValueError) as e:
+            print("Cannot read the piers from " + args.piers + ": " + str(e),
+                  file=sys.stderr)
+            return 2
+    names = [pier["name"] for pier in settings]
+    if len(set(names)) != len(names):
+        print("Each pier needs a different name", file=sys.stderr)
+        return 2
+    piers = [Pier(pier, common) for pier in settings]
+    try:
+        for pier in piers:
+            pier.Check()
+    except ValueError as e:
+        print("Cannot align: " + str(e), file=sys.stderr)
+        return 2
+
+    if not args.window:
+        return RunConsole(piers)
+    if tk is None:
+        print("Tkinter is not installed, so use --no-window", file=sys.stderr)
+        return 2
+    return RunWindow(piers)
+
+if __name__ == "__main__":
+    sys.exit(main())
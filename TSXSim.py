@@ -0,0 +1,1584 @@
+#!/usr/bin/env -S python3 -u
+#
+# Stand in for TheSkyX TCP server, used to test and benchmark PAUI.py
+# without a real TSX, mount or camera.
+#
+# To run this program type:
+#
+# TSXSim.py or python3 TSXSim.py --help
+#
+# It listens on port 3040 like TSX and runs the java script sent to it
+# using a small interpreter which understands the parts of java script and
+# the TSX objects used by PAUI.py:
+#    sky6RASCOMTele, ccdsoftCamera, ccdsoftCameraImage, ImageLink,
+#    ImageLinkResults, sky6Utils and sky6StarChart
+#
+# The mount is modelled with a polar axis that is misaligned by a given
+# amount in altitude and azimuth. Slews, exposures, downloads and plate
+# solves take (scaled) real time, and plate solves can be made to fail at
+# random. Images are written as FITS files containing a simulated star
+# field, with TELEHA and LST in the header as TSX would write them.
+#
+# When stopped with Ctrl-C a summary of the cycle times is printed.
+
+import socketserver
+import threading
+import argparse
+import math
+import os
+import random
+import re
+import struct
+import tempfile
+import time
+from array import array
+
+# Shared with PAEngine.py, so the simulated TSX does its sums the same way
+from Astrometry import sind, cosd, MatVec, MatMul, RotX, RotZ, RADecToVec, \
+    VecToRADec, AltAzfromHADEC, HADECfromAltAz, JulianDate, LST, \
+    Precess2000ToNow, PrecessNowTo2000, ReadFITSHeader
+
+######################### JAVA SCRIPT ##################################
+# A small java script interpreter. Only covers the parts of the language
+# used in the scripts sent by PAUI.py.
+
+# Value used for the java script undefined
+class Undefined:
+    def __repr__(self):
+        return "undefined"
+
+undefined = Undefined()
+
+# Raised when the script ends part way through a statement - more of it
+# has probably still to arrive
+class JSIncomplete(Exception):
+    pass
+
+class JSSyntaxError(Exception):
+    pass
+
+# A java script exception. value is what was thrown.
+class JSThrow(Exception):
+    def __init__(self, value):
+        Exception.__init__(self, value)
+        self.value = value
+
+# A java script Error object, e.g. thrown by a TSX object
+class JSError:
+    def __init__(self, name, message):
+        self.name = name
+        self.message = message
+
+    def __str__(self):
+        return self.name + ": " + self.message
+
+def jserror(name, message):
+    return JSThrow(JSError(name, message))
+
+class JSArray:
+    def __init__(self, items):
+        self.items = items
+
+    def push(self, *values):
+        self.items.extend(values)
+        return len(self.items)
+
+    def join(self, sep=","):
+        return jsstr(sep).join(jsstr(v) for v in self.items)
+
+    @property
+    def length(self):
+        return len(self.items)
+
+TOKEN_RE = re.compile(r"""
+    (?P<space>\s+|//[^\n]*|/\*.*?\*/) |
+    (?P<number>\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?) |
+    (?P<name>[A-Za-z_$][A-Za-z0-9_$]*) |
+    (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*') |
+    (?P<op>===|!==|\+\+|--|\+=|-=|==|!=|<=|>=|&&|\|\||[-+*/%<>=!?:;,.(){}\[\]])
+    """, re.VERBOSE | re.DOTALL)
+
+KEYWORDS = {"var", "if", "else", "for", "while", "try", "catch", "finally",
+            "throw", "true", "false", "null", "undefined", "typeof",
+            "function", "return", "new"}
+
+def unescape(body):
+    out = []
+    i = 0
+    while i < len(body):
+        c = body[i]
+        if c != "\\":
+            out.append(c)
+            i += 1
+            continue
+        i += 1
+        c = body[i]
+        if c == "u":
+            out.append(chr(int(body[i+1:i+5], 16)))
+            i += 5
+            continue
+        out.append({"n": "\n", "t": "\t", "r": "\r", "b": "\b",
+                    "f": "\f", "0": "\0"}.get(c, c))
+        i += 1
+    return "".join(out)
+
+def tokenize(src):
+    tokens = []
+    pos = 0
+    while pos < len(src):
+        m = TOKEN_RE.match(src, pos)
+        if m is None:
+            if src[pos] in "\"'" or src.startswith("/*", pos):
+                raise JSIncomplete()
+            raise JSSyntaxError("Unexpected character " + repr(src[pos]))
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group()
+        if kind == "space":
+            continue
+        if kind == "number":
+            tokens.append(("num", float(text)))
+        elif kind == "string":
+            tokens.append(("str", unescape(text[1:-1])))
+        elif kind == "name" and text in KEYWORDS:
+            tokens.append(("kw", text))
+        elif kind == "name":
+            tokens.append(("name", text))
+        else:
+            tokens.append(("op", text))
+    tokens.append(("eof", None))
+    return tokens
+
+# Parser - builds a tree of tuples, first item gives the type of node
+class Parser:
+    def __init__(self, src):
+        self.tokens = tokenize(src)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset]
+
+    def next(self):
+        tok = self.tokens[self.pos]
+        if tok[0] == "eof":
+            raise JSIncomplete()
+        self.pos += 1
+        return tok
+
+    def accept(self, kind, value=None):
+        tok = self.peek()
+        if tok[0] == kind and (value is None or tok[1] == value):
+            self.pos += 1
+            return tok
+        return None
+
+    def expect(self, kind, value=None):
+        tok = self.peek()
+        if tok[0] == "eof":
+            raise JSIncomplete()
+        if tok[0] != kind or (value is not None and tok[1] != value):
+            raise JSSyntaxError("Expected " + str(value or kind) + \
+                                " but found " + str(tok[1]))
+        self.pos += 1
+        return tok
+
+    def program(self):
+        body = []
+        while self.peek()[0] != "eof":
+            body.append(self.statement())
+        return ("block", body)
+
+    def statement(self):
+        tok = self.peek()
+        if tok == ("op", "{"):
+            return self.block()
+        if tok == ("op", ";"):
+            self.next()
+            return ("empty",)
+        if tok == ("kw", "var"):
+            self.next()
+            decls = []
+            while True:
+                name = self.expect("name")[1]
+                init = None
+                if self.accept("op", "="):
+                    init = self.assignment()
+                decls.append((name, init))
+                if not self.accept("op", ","):
+                    break
+            self.endstatement()
+            return ("var", decls)
+        if tok == ("kw", "if"):
+            self.next()
+            self.expect("op", "(")
+            cond = self.expression()
+            self.expect("op", ")")
+            then = self.statement()
+            other = None
+            if self.accept("kw", "else"):
+                other = self.statement()
+            return ("if", cond, then, other)
+        if tok == ("kw", "for"):
+            self.next()
+            self.expect("op", "(")
+            init = None
+            if not self.accept("op", ";"):
+                init = self.statement()
+            cond = None
+            if self.peek() != ("op", ";"):
+                cond = self.expression()
+            self.expect("op", ";")
+            update = None
+            if self.peek() != ("op", ")"):
+                update = self.expression()
+            self.expect("op", ")")
+            return ("for", init, cond, update, self.statement())
+        if tok == ("kw", "while"):
+            self.next()
+            self.expect("op", "(")
+            cond = self.expression()
+            self.expect("op", ")")
+            return ("for", None, cond, None, self.statement())
+        if tok == ("kw", "try"):
+            self.next()
+            body = self.block()
+            name = None
+            handler = None
+            final = None
+            if self.accept("kw", "catch"):
+                self.expect("op", "(")
+                name = self.expect("name")[1]
+                self.expect("op", ")")
+                handler = self.block()
+            if self.accept("kw", "finally"):
+                final = self.block()
+            return ("try", body, name, handler, final)
+        if tok == ("kw", "throw"):
+            self.next()
+            value = self.expression()
+            self.endstatement()
+            return ("throw", value)
+        expr = self.expression()
+        self.endstatement()
+        return ("expr", expr)
+
+    # Semicolons are optional at the end of a block or the script
+    def endstatement(self):
+        if self.accept("op", ";"):
+            return
+        if self.peek()[0] == "eof" or self.peek() == ("op", "}"):
+            return
+        raise JSSyntaxError("Expected ; but found " + str(self.peek()[1]))
+
+    def block(self):
+        self.expect("op", "{")
+        body = []
+        while not self.accept("op", "}"):
+            body.append(self.statement())
+        return ("block", body)
+
+    def expression(self):
+        expr = self.assignment()
+        while self.accept("op", ","):
+            expr = ("comma", expr, self.assignment())
+        return expr
+
+    def assignment(self):
+        target = self.conditional()
+        tok = self.peek()
+        if tok[0] == "op" and tok[1] in ("=", "+=", "-="):
+            if target[0] not in ("name", "member", "index"):
+                raise JSSyntaxError("Invalid assignment")
+            self.next()
+            return ("assign", tok[1], target, self.assignment())
+        return target
+
+    def conditional(self):
+        cond = self.binary(0)
+        if self.accept("op", "?"):
+            then = self.assignment()
+            self.expect("op", ":")
+            return ("cond", cond, then, self.assignment())
+        return cond
+
+    PRECEDENCE = [["||"], ["&&"], ["==", "!=", "===", "!=="],
+                  ["<", ">", "<=", ">="], ["+", "-"], ["*", "/", "%"]]
+
+    def binary(self, level):
+        if level == len(self.PRECEDENCE):
+            return self.unary()
+        left = self.binary(level + 1)
+        while True:
+            tok = self.peek()
+            if tok[0] == "op" and tok[1] in self.PRECEDENCE[level]:
+                self.next()
+                left = ("binary", tok[1], left, self.binary(level + 1))
+            else:
+                return left
+
+    def unary(self):
+        tok = self.peek()
+        if tok[0] == "op" and tok[1] in ("-", "+", "!"):
+            self.next()
+            return ("unary", tok[1], self.unary())
+        if tok[0] == "op" and tok[1] in ("++", "--"):
+            self.next()
+            return ("update", tok[1], self.postfix(), True)
+        if tok == ("kw", "typeof"):
+            self.next()
+            return ("typeof", self.unary())
+        expr = self.postfix()
+        tok = self.peek()
+        if tok[0] == "op" and tok[1] in ("++", "--"):
+            self.next()
+            return ("update", tok[1], expr, False)
+        return expr
+
+    def postfix(self):
+        expr = self.primary()
+        while True:
+            if self.accept("op", "."):
+                expr = ("member", expr, self.next()[1])
+            elif self.accept("op", "["):
+                index = self.expression()
+                self.expect("op", "]")
+                expr = ("index", expr, index)
+            elif self.accept("op", "("):
+                args = []
+                if not self.accept("op", ")"):
+                    while True:
+                        args.append(self.assignment())
+                        if self.accept("op", ")"):
+                            break
+                        self.expect("op", ",")
+                expr = ("call", expr, args)
+            else:
+                return expr
+
+    def primary(self):
+        tok = self.next()
+        if tok[0] == "num":
+            return ("const", tok[1])
+        if tok[0] == "str":
+            return ("const", tok[1])
+        if tok[0] == "name":
+            return ("name", tok[1])
+        if tok[0] == "kw":
+            if tok[1] == "true":
+                return ("const", True)
+            if tok[1] == "false":
+                return ("const", False)
+            if tok[1] == "null":
+                return ("const", None)
+            if tok[1] == "undefined":
+                return ("const", undefined)
+        if tok == ("op", "("):
+            expr = self.expression()
+            self.expect("op", ")")
+            return expr
+        if tok == ("op", "["):
+            items = []
+            if not self.accept("op", "]"):
+                while True:
+                    items.append(self.assignment())
+                    if self.accept("op", "]"):
+                        break
+                    self.expect("op", ",")
+            return ("array", items)
+        raise JSSyntaxError("Unexpected " + str(tok[1]))
+
+# Conversions following the java script rules
+def jsstr(value):
+    if value is undefined:
+        return "undefined"
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "Infinity" if value > 0 else "-Infinity"
+        if value == int(value) and abs(value) < 1e21:
+            return str(int(value))
+        text = repr(value)
+        if "e" in text:
+            mant, exp = text.split("e")
+            text = mant + "e" + ("+" if exp[0] != "-" else "-") + \
+                exp.lstrip("+-").lstrip("0")
+        return text
+    if isinstance(value, int):
+        return str(value)
+    return str(value)
+
+def jsnum(value):
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value is None:
+        return 0.0
+    if isinstance(value, str):
+        try:
+            return float(value.strip() or "0")
+        except ValueError:
+            return math.nan
+    return math.nan
+
+def jstruth(value):
+    if value is undefined or value is None:
+        return False
+    if isinstance(value, str):
+        return value != ""
+    if isinstance(value, (int, float)):
+        return value != 0 and not math.isnan(value)
+    return bool(value)
+
+# Marks a statement which has no value (e.g. var) for working out the
+# value of the script, which TSX returns
+EMPTY = object()
+
+class Interpreter:
+    def __init__(self, host):
+        self.globals = dict(host)
+        self.globals["String"] = lambda value=undefined: jsstr(value)
+        self.globals["Number"] = lambda value=0.0: jsnum(value)
+        self.globals["eval"] = self.eval
+        self.globals["Math"] = JSMath()
+        self.globals["Date"] = JSDate()
+
+    # Runs a script and returns its value
+    def run(self, src):
+        tree = Parser(src).program()
+        value = self.execute(tree, self.globals)
+        return undefined if value is EMPTY else value
+
+    def eval(self, src=undefined):
+        if not isinstance(src, str):
+            return src
+        try:
+            return self.run(src)
+        except (JSIncomplete, JSSyntaxError) as e:
+            raise jserror("SyntaxError", str(e) or "Unexpected end of script")
+
+    def execute(self, node, scope):
+        kind = node[0]
+        if kind == "block":
+            value = EMPTY
+            for statement in node[1]:
+                result = self.execute(statement, scope)
+                if result is not EMPTY:
+                    value = result
+            return value
+        if kind == "expr":
+            return self.evaluate(node[1], scope)
+        if kind == "var":
+            for name, init in node[1]:
+                value = undefined if init is None else \
+                    self.evaluate(init, scope)
+                if init is not None or name not in scope:
+                    scope[name] = value
+            return EMPTY
+        if kind == "empty":
+            return EMPTY
+        if kind == "if":
+            if jstruth(self.evaluate(node[1], scope)):
+                return self.execute(node[2], scope)
+            if node[3] is not None:
+                return self.execute(node[3], scope)
+            return EMPTY
+        if kind == "for":
+            _, init, cond, update, body = node
+            value = EMPTY
+            if init is not None:
+                self.execute(init, scope)
+            while cond is None or jstruth(self.evaluate(cond, scope)):
+                result = self.execute(body, scope)
+                if result is not EMPTY:
+                    value = result
+                if update is not None:
+                    self.evaluate(update, scope)
+            return value
+        if kind == "try":
+            _, body, name, handler, final = node
+            try:
+                try:
+                    return self.execute(body, scope)
+                except JSThrow as e:
+                    if handler is None:
+                        raise
+                    # The catch variable is global here, which is good
+                    # enough for the scripts this is used for
+                    scope[name] = e.value
+                    return self.execute(handler, scope)
+            finally:
+                if final is not None:
+                    self.execute(final, scope)
+        if kind == "throw":
+            raise JSThrow(self.evaluate(node[1], scope))
+        raise JSSyntaxError("Unknown statement " + kind)
+
+    def evaluate(self, node, scope):
+        kind = node[0]
+        if kind == "const":
+            return node[1]
+        if kind == "name":
+            if node[1] not in scope:
+                raise jserror("ReferenceError", node[1] + " is not defined")
+            return scope[node[1]]
+        if kind == "member":
+            return self.getmember(self.evaluate(node[1], scope), node[2])
+        if kind == "index":
+            obj = self.evaluate(node[1], scope)
+            index = self.evaluate(node[2], scope)
+            if isinstance(obj, JSArray):
+                i = int(jsnum(index))
+                return obj.items[i] if 0 <= i < len(obj.items) else undefined
+            return self.getmember(obj, jsstr(index))
+        if kind == "call":
+            func = self.evaluate(node[1], scope)
+            args = [self.evaluate(arg, scope) for arg in node[2]]
+            if not callable(func):
+                raise jserror("TypeError", self.describe(node[1]) + \
+                              " is not a function")
+            return func(*args)
+        if kind == "array":
+            return JSArray([self.evaluate(item, scope) for item in node[1]])
+        if kind == "assign":
+            _, op, target, expr = node
+            value = self.evaluate(expr, scope)
+            if op != "=":
+                old = self.evaluate(target, scope)
+                value = self.add(old, value) if op == "+=" else \
+                    jsnum(old) - jsnum(value)
+            self.store(target, value, scope)
+            return value
+        if kind == "update":
+            _, op, target, prefix = node
+            old = jsnum(self.evaluate(target, scope))
+            new = old + 1 if op == "++" else old - 1
+            self.store(target, new, scope)
+            return new if prefix else old
+        if kind == "unary":
+            value = self.evaluate(node[2], scope)
+            if node[1] == "-":
+                return -jsnum(value)
+            if node[1] == "+":
+                return jsnum(value)
+            return not jstruth(value)
+        if kind == "typeof":
+            try:
+                value = self.evaluate(node[1], scope)
+            except JSThrow:
+                return "undefined"
+            if value is undefined:
+                return "undefined"
+            if isinstance(value, str):
+                return "string"
+            if isinstance(value, bool):
+                return "boolean"
+            if isinstance(value, (int, float)):
+                return "number"
+            return "function" if callable(value) else "object"
+        if kind == "cond":
+            if jstruth(self.evaluate(node[1], scope)):
+                return self.evaluate(node[2], scope)
+            return self.evaluate(node[3], scope)
+        if kind == "comma":
+            self.evaluate(node[1], scope)
+            return self.evaluate(node[2], scope)
+        if kind == "binary":
+            op = node[1]
+            left = self.evaluate(node[2], scope)
+            if op == "&&":
+                return self.evaluate(node[3], scope) if jstruth(left) else left
+            if op == "||":
+                return left if jstruth(left) else self.evaluate(node[3], scope)
+            right = self.evaluate(node[3], scope)
+            if op == "+":
+                return self.add(left, right)
+            if op in ("==", "==="):
+                return self.equal(left, right)
+            if op in ("!=", "!=="):
+                return not self.equal(left, right)
+            if op in ("<", ">", "<=", ">=") and isinstance(left, str) and \
+               isinstance(right, str):
+                a, b = left, right
+            else:
+                a, b = jsnum(left), jsnum(right)
+            if op == "-":
+                return a - b
+            if op == "*":
+                return a * b
+            if op == "/":
+                if b == 0:
+                    return math.nan if a == 0 else math.copysign(math.inf, a)
+                return a / b
+            if op == "%":
+                return math.fmod(a, b) if b != 0 else math.nan
+            if op == "<":
+                return a < b
+            if op == ">":
+                return a > b
+            if op == "<=":
+                return a <= b
+            if op == ">=":
+                return a >= b
+        raise JSSyntaxError("Unknown expression " + kind)
+
+    def add(self, left, right):
+        if isinstance(left, str) or isinstance(right, str) or \
+           not isinstance(left, (int, float, bool, type(None), Undefined)) or \
+           not isinstance(right, (int, float, bool, type(None), Undefined)):
+            return jsstr(left) + jsstr(right)
+        return jsnum(left) + jsnum(right)
+
+    def equal(self, left, right):
+        if isinstance(left, str) and isinstance(right, str):
+            return left == right
+        if left is undefined or right is undefined or \
+           left is None or right is None:
+            return left is right
+        if isinstance(left, (int, float, bool, str)) and \
+           isinstance(right, (int, float, bool, str)):
+            return jsnum(left) == jsnum(right)
+        return left is right
+
+    def getmember(self, obj, name):
+        if obj is undefined or obj is None:
+            raise jserror("TypeError", "Cannot read property '" + name + \
+                          "' of " + jsstr(obj))
+        if isinstance(obj, str):
+            if name == "length":
+                return len(obj)
+            if name == "split":
+                return lambda sep=undefined: JSArray(obj.split(sep)) \
+                    if sep is not undefined else JSArray([obj])
+            return undefined
+        if isinstance(obj, (JSArray, JSMath, JSDate, JSError)):
+            return getattr(obj, name, undefined)
+        if isinstance(obj, HostObject):
+            return obj.jsget(name)
+        return undefined
+
+    def store(self, target, value, scope):
+        if target[0] == "name":
+            scope[target[1]] = value
+            return
+        obj = self.evaluate(target[1], scope)
+        name = target[2] if target[0] == "member" else \
+            jsstr(self.evaluate(target[2], scope))
+        if isinstance(obj, HostObject):
+            obj.jsset(name, value)
+        elif isinstance(obj, JSArray) and target[0] == "index":
+            i = int(jsnum(name))
+            while len(obj.items) <= i:
+                obj.items.append(undefined)
+            obj.items[i] = value
+        else:
+            raise jserror("TypeError", "Cannot set property '" + name + "'")
+
+    def describe(self, node):
+        if node[0] == "name":
+            return node[1]
+        if node[0] == "member":
+            return self.describe(node[1]) + "." + node[2]
+        return "expression"
+
+class JSMath:
+    PI = math.pi
+
+    def __init__(self):
+        for name in ("sin", "cos", "tan", "asin", "acos", "atan", "atan2",
+                     "sqrt", "abs", "floor", "ceil", "round"):
+            func = getattr(math, name, None) or {"abs": abs,
+                                                 "round": round}[name]
+            setattr(self, name, (lambda f: lambda *a: float(
+                f(*[jsnum(x) for x in a])))(func))
+
+# Only Date.now, which the engine uses to time its scripts
+class JSDate:
+    def now(self):
+        return float(int(time.time() * 1000))
+
+# Base for the TSX objects. Properties are attributes whose names start
+# with "js_"; methods are attributes whose names start with "jsm_". Setting
+# a property calls set_<name> if there is one.
+class HostObject:
+    def jsget(self, name):
+        if hasattr(self, "jsm_" + name):
+            return getattr(self, "jsm_" + name)
+        if hasattr(self, "js_" + name):
+            return getattr(self, "js_" + name)
+        return undefined
+
+    def jsset(self, name, value):
+        setter = getattr(self, "set_" + name, None)
+        if setter is not None:
+            setter(value)
+        elif hasattr(self, "js_" + name):
+            setattr(self, "js_" + name, value)
+        else:
+            # TSX objects will not take new properties
+            raise jserror("TypeError", "Cannot set property " + name)
+
+######################### SKY MODEL ####################################
+
+def VfromAltAz(alt, az):
+    return [cosd(alt)*sind(az), cosd(alt)*cosd(az), sind(alt)]
+
+def VecToAltAz(v):
+    return math.degrees(math.asin(max(-1.0, min(1.0, v[2])))), \
+        math.degrees(math.atan2(v[0], v[1]))
+
+def HMSString(hours):
+    sign = "-" if hours < 0 else "+"
+    hours = abs(hours)
+    h = int(hours)
+    m = int((hours - h) * 60)
+    s = (hours - h) * 3600 - m * 60
+    return "%s%02d %02d %05.2f" % (sign, h, m, s)
+
+# The observatory: site, clock, mount with a misaligned polar axis and a
+# camera. All angles are degrees, HA and RA are hours.
+class Observatory:
+    def __init__(self, args):
+        self.args = args
+        self.lat = args.lat
+        self.lon = args.lon # West positive, as TSX
+        self.lock = threading.RLock()
+        self.random = random.Random(args.seed)
+
+        # Misalignment of the polar axis: altitude above the pole and
+        # azimuth east of north
+        self.alterror = args.alt_error / 60.0
+        self.azerror = args.az_error / 60.0
+        self.start = time.time()
+
+        # Where the mount is pointing, in its own (misaligned) frame. The
+        # mount tracks, so its HA increases with time from the last slew.
+        self.mountha = 0.0
+        self.mountdec = 90.0
+        self.slewtime = time.time()
+        self.parked = args.parked
+        self.slewabort = threading.Event() # Set to abandon the slew
+
+        self.exposures = 0
+        self.exposuretimes = []
+        self.imagedir = args.image_dir or tempfile.mkdtemp(prefix="TSXSim")
+        # The exposures are saved here, from a timer thread where failing
+        # would leave them never finishing, so make it now
+        os.makedirs(self.imagedir, exist_ok=True)
+        self.images = {} # Image path -> details of the image for solving
+
+    def Scaled(self, seconds):
+        return seconds * self.args.time_scale
+
+    def Sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(self.Scaled(seconds))
+
+    def LST(self, t=None):
+        if t is None:
+            t = time.time()
+        return LST(self.lon, t)
+
+    # Misalignment now. After the two reference images have been taken
+    # the user starts turning the knobs towards the pole.
+    def Misalignment(self, t=None):
+        if t is None:
+            t = time.time()
+        alterror, azerror = self.alterror, self.azerror
+        rate = self.args.adjust_rate / 60.0
+        if rate > 0 and self.adjuststart is not None and t > self.adjuststart:
+            total = math.hypot(alterror, azerror)
+            if total > 0:
+                f = max(0.0, 1.0 - rate * (t - self.adjuststart) / total)
+                alterror, azerror = alterror * f, azerror * f
+        return alterror, azerror
+
+    adjuststart = None
+
+    # Rotation taking the alt az frame of a perfectly aligned mount into
+    # that of the real mount
+    def MountMatrix(self, t=None):
+        alterror, azerror = self.Misalignment(t)
+        return MatMul(RotZ(-azerror), RotX(alterror))
+
+    def MountHA(self, t=None):
+        if t is None:
+            t = time.time()
+        return self.mountha + (t - self.slewtime) * 1.00273790935 / 3600.0
+
+    # True JNow RA and Dec the telescope is pointing at, plus the position
+    # angle of the top of the camera (towards the mount's pole)
+    def Pointing(self, t=None):
+        if t is None:
+            t = time.time()
+        ha = self.MountHA(t)
+        alt, az = AltAzfromHADEC(ha, self.mountdec, self.lat)
+        m = self.MountMatrix(t)
+        v = MatVec(m, VfromAltAz(alt, az))
+        talt, taz = VecToAltAz(v)
+        tha, tdec = HADECfromAltAz(talt, taz, self.lat)
+        ra = (self.LST(t) - tha) % 24.0
+
+        # Position angle - direction of the mount's pole seen from the
+        # pointing, measured from true north through east
+        pole = MatVec(m, VfromAltAz(self.lat, 0.0))
+        tpole = VfromAltAz(self.lat, 0.0)
+        pa = (PositionAngle(v, pole) - PositionAngle(v, tpole)) % 360.0
+        return ra, tdec, pa
+
+    # Slews to ra, dec unless aborted part way, when the mount is left
+    # where it was
+    def SlewTo(self, ra, dec):
+        # Mount works in its own frame, so is off target by the misalignment
+        with self.lock:
+            now = time.time()
+            newha = (self.LST(now) - ra + 12.0) % 24.0 - 12.0
+            dist = max(abs(newha - self.MountHA(now)) * 15.0,
+                       abs(dec - self.mountdec))
+            self.slewabort.clear()
+        if self.slewabort.wait(self.Scaled(dist / self.args.slew_rate +
+                                           self.args.settle_time)):
+            return
+        with self.lock:
+            now = time.time()
+            self.mountha = (self.LST(now) - ra + 12.0) % 24.0 - 12.0
+            self.mountdec = dec
+            self.slewtime = now
+
+# Angle at which direction 'to' is seen from v, from the direction of the
+# pole of the alt az frame's equator (the z axis of a frame with north
+# celestial pole target), measured via the local tangent plane
+def PositionAngle(v, to):
+    # Local north (towards z axis of the HA Dec frame) in tangent plane
+    up = [0.0, 0.0, 1.0]
+    north = Normalise(Sub(up, Scale(v, Dot(up, v))))
+    east = Cross(north, v)
+    d = Sub(to, Scale(v, Dot(to, v)))
+    return math.degrees(math.atan2(Dot(d, east), Dot(d, north)))
+
+def Dot(a, b):
+    return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+def Sub(a, b):
+    return [a[0]-b[0], a[1]-b[1], a[2]-b[2]]
+
+def Scale(a, s):
+    return [a[0]*s, a[1]*s, a[2]*s]
+
+def Cross(a, b):
+    return [a[1]*b[2]-a[2]*b[1], a[2]*b[0]-a[0]*b[2], a[0]*b[1]-a[1]*b[0]]
+
+def Normalise(a):
+    n = math.sqrt(Dot(a, a))
+    return [x / n for x in a] if n > 0 else [0.0, 0.0, 1.0]
+
+######################### STAR FIELD ###################################
+
+# Stars are generated in cells of a grid on the unit sphere, each cell
+# seeded from its position, so the same part of the sky always has the
+# same stars.
+STAR_CELL = 0.005
+
+def StarsNear(v, radius, density):
+    # density is stars per square degree
+    perCell = density * (STAR_CELL * 180.0 / math.pi) ** 2
+    r = radius * math.pi / 180.0
+    lo = [int(math.floor((x - r) / STAR_CELL)) for x in v]
+    hi = [int(math.floor((x + r) / STAR_CELL)) for x in v]
+    stars = []
+    for i in range(lo[0], hi[0] + 1):
+        for j in range(lo[1], hi[1] + 1):
+            for k in range(lo[2], hi[2] + 1):
+                rnd = random.Random(hash((i, j, k)) & 0xffffffff)
+                n = int(perCell * 3) + 1
+                for s in range(n):
+                    p = [(i + rnd.random()) * STAR_CELL,
+                         (j + rnd.random()) * STAR_CELL,
+                         (k + rnd.random()) * STAR_CELL]
+                    mag = rnd.random()
+                    u = Normalise(p)
+                    # Only keep stars which land back in this cell
+                    if [int(math.floor(x / STAR_CELL)) for x in u] != \
+                       [i, j, k]:
+                        continue
+                    if rnd.random() > 1.0 / 3.0:
+                        continue
+                    stars.append((u, mag))
+    return stars
+
+# Projects the star field around (ra, dec) onto an image. scale is
+# arcsec/pixel and pa the position angle of the top of the image.
+# Returns the stars as (x, y, flux) in pixels.
+def ProjectStars(ra, dec, pa, scale, width, height, density):
+    centre = RADecToVec(ra, dec)
+    north = Normalise(Sub([0.0, 0.0, 1.0], Scale(centre, centre[2])))
+    east = Cross(north, centre)
+    # Axes of the image on the sky
+    up = Add(Scale(north, cosd(pa)), Scale(east, sind(pa)))
+    right = Cross(up, centre)
+    radius = math.hypot(width, height) * scale / 3600.0 / 2.0
+    out = []
+    for u, mag in StarsNear(centre, radius, density):
+        d = Dot(u, centre)
+        if d <= 0:
+            continue
+        # Gnomonic projection
+        x = Dot(u, right) / d * 180.0 / math.pi * 3600.0 / scale
+        y = Dot(u, up) / d * 180.0 / math.pi * 3600.0 / scale
+        x += width / 2.0
+        y = height / 2.0 - y
+        if 0 <= x < width and 0 <= y < height:
+            out.append((x, y, 20000.0 * 10 ** (-2.0 * mag)))
+    return out
+
+def Add(a, b):
+    return [a[0]+b[0], a[1]+b[1], a[2]+b[2]]
+
+# Writes a FITS image with the given header cards (key, value, comment)
+def WriteFITS(path, width, height, stars, header, rnd):
+    sigma = 1.2
+    pixels = array("h", [0]) * (width * height)
+    for i in range(width * height):
+        pixels[i] = int(1000 + rnd.gauss(0, 10))
+    for x, y, flux in stars:
+        x0, y0 = int(x), int(y)
+        for py in range(max(0, y0 - 4), min(height, y0 + 5)):
+            for px in range(max(0, x0 - 4), min(width, x0 + 5)):
+                r2 = (px + 0.5 - x) ** 2 + (py + 0.5 - y) ** 2
+                value = pixels[py * width + px] + \
+                    flux * math.exp(-r2 / (2 * sigma * sigma)) / \
+                    (2 * math.pi * sigma * sigma)
+                pixels[py * width + px] = min(32767, int(value))
+    cards = [("SIMPLE", True, ""), ("BITPIX", 16, ""), ("NAXIS", 2, ""),
+             ("NAXIS1", width, ""), ("NAXIS2", height, "")] + header
+    text = ""
+    for key, value, comment in cards:
+        if value is True or value is False:
+            val = "%20s" % ("T" if value else "F")
+        elif isinstance(value, str):
+            val = "'%-8s'" % value.replace("'", "''")
+        elif isinstance(value, int):
+            val = "%20d" % value
+        else:
+            val = "%20.10G" % value
+        card = "%-8s= %s" % (key, val)
+        if comment:
+            card += " / " + comment
+        text += "%-80s" % card[:80]
+    text += "%-80s" % "END"
+    text += " " * (-len(text) % 2880)
+    if struct.pack("=h", 1) != struct.pack(">h", 1):
+        pixels.byteswap()
+    data = pixels.tobytes()
+    data += b"\0" * (-len(data) % 2880)
+    with open(path, "wb") as f:
+        f.write(text.encode("ascii"))
+        f.write(data)
+
+# Writes the stars found in an image to a .SRC file next to it, as a table
+# of x, y (pixels), magnitude and FWHM (pixels). Positions are measured to
+# about 0.05 pixels.
+def WriteSRC(fitspath, stars, rnd):
+    lines = ["X Y Magnitude FWHM"]
+    for x, y, flux in stars:
+        lines.append("%.3f %.3f %.3f %.2f" %
+                     (x + rnd.gauss(0, 0.05), y + rnd.gauss(0, 0.05),
+                      25.0 - 2.5 * math.log10(flux), 2.83))
+    with open(fitspath.replace(".fit", ".SRC"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+######################### TSX OBJECTS ##################################
+
+class Telescope(HostObject):
+    def __init__(self, obs):
+        self.obs = obs
+        self.js_IsConnected = 0
+        self.js_Asynchronous = 0
+        self.slew = None # Thread doing an asynchronous slew
+        self.js_dAlt = 0.0
+        self.js_dAz = 0.0
+        self.js_dRa = 0.0
+        self.js_dDec = 0.0
+
+    def jsm_Connect(self):
+        self.js_IsConnected = 1
+        return undefined
+
+    def jsm_Disconnect(self):
+        self.js_IsConnected = 0
+        return undefined
+
+    def jsm_Unpark(self):
+        self.obs.parked = False
+        return undefined
+
+    def jsm_Park(self):
+        self.obs.parked = True
+        return undefined
+
+    def jsm_Abort(self):
+        self.obs.slewabort.set()
+        return undefined
+
+    @property
+    def js_IsSlewComplete(self):
+        return 0 if self.slew is not None and self.slew.is_alive() else 1
+
+    def jsm_SlewToRaDec(self, ra, dec, name=""):
+        if not self.js_IsConnected:
+            raise jserror("Error", "Telescope not connected. Error = 200.")
+        if self.obs.parked:
+            raise jserror("Error", "The mount is parked. Error = 218.")
+        if jstruth(self.js_Asynchronous):
+            self.slew = threading.Thread(target=self.obs.SlewTo,
+                                         args=(jsnum(ra), jsnum(dec)),
+                                         daemon=True)
+            self.slew.start()
+            return undefined
+        self.obs.SlewTo(jsnum(ra), jsnum(dec))
+        return undefined
+
+    # Where the mount thinks it is pointing, in its own frame, which is off
+    # from where it really is by the misalignment
+    def jsm_GetRaDec(self):
+        now = time.time()
+        with self.obs.lock:
+            self.js_dRa = (self.obs.LST(now) - self.obs.MountHA(now)) % 24.0
+            self.js_dDec = self.obs.mountdec
+        return undefined
+
+class Camera(HostObject):
+    def __init__(self, obs):
+        self.obs = obs
+        self.js_Asynchronous = 0
+        self.js_ExposureTime = 1.0
+        self.js_AutoSaveOn = 1
+        self.js_ImageReduction = 0
+        self.js_Frame = 1
+        self.js_Delay = 0
+        self.js_BinX = 1
+        self.js_BinY = 1
+        self.js_Subframe = 0
+        self.js_SubframeLeft = 0
+        self.js_SubframeTop = 0
+        self.js_SubframeRight = obs.args.width
+        self.js_SubframeBottom = obs.args.height
+        self.js_WidthInPixels = obs.args.width
+        self.js_HeightInPixels = obs.args.height
+        self.js_LastImageFileName = ""
+        self.js_FilterIndexZeroBased = 0
+        self.filters = obs.args.filters.split(",") if obs.args.filters else []
+        self.js_lNumberFilters = len(self.filters)
+        self.connected = False
+        self.exposureend = None # Time an asynchronous exposure will finish
+
+    def jsm_Connect(self):
+        self.connected = True
+        return 0
+
+    def jsm_Disconnect(self):
+        self.connected = False
+        return 0
+
+    def jsm_filterWheelConnect(self):
+        if not self.filters:
+            raise jserror("Error", "No filter wheel. Error = 206.")
+        return 0
+
+    def jsm_szFilterName(self, i):
+        i = int(jsnum(i))
+        if 0 <= i < len(self.filters):
+            return self.filters[i]
+        raise jserror("Error", "Filter index out of range. Error = 206.")
+
+    def set_FilterIndexZeroBased(self, value):
+        i = int(jsnum(value))
+        if not 0 <= i < len(self.filters):
+            raise jserror("Error", "Filter index out of range. Error = 206.")
+        self.js_FilterIndexZeroBased = i
+
+    @property
+    def js_IsExposureComplete(self):
+        with self.obs.lock:
+            return 1 if self.exposureend is None else 0
+
+    def jsm_Abort(self):
+        with self.obs.lock:
+            self.exposureend = None
+            self.aborted = True
+        return 0
+
+    aborted = False
+
+    def jsm_TakeImage(self):
+        if not self.connected:
+            raise jserror("Error", "Camera not connected. Error = 200.")
+        with self.obs.lock:
+            if self.exposureend is not None:
+                raise jserror("Error", "Camera is busy. Error = 209.")
+            self.aborted = False
+            start = time.time()
+            exp = jsnum(self.js_ExposureTime)
+            bin = max(1, int(jsnum(self.js_BinX)))
+            # Download time goes down with the number of pixels read
+            width, height = self.ReadoutSize(bin)
+            duration = exp + self.obs.args.download_time * width * height / \
+                float(self.obs.args.width * self.obs.args.height)
+            self.obs.exposures += 1
+            self.obs.exposuretimes.append(start)
+            if self.obs.exposures == 3 and self.obs.adjuststart is None:
+                self.obs.adjuststart = start
+            ra, dec, pa = self.obs.Pointing(start)
+            details = dict(start=start, exp=exp, bin=bin, ra=ra, dec=dec,
+                           pa=pa, ha=self.obs.MountHA(start),
+                           lst=self.obs.LST(start), width=width,
+                           height=height, subframe=self.SubframeOrigin(bin))
+        if jstruth(self.js_Asynchronous):
+            with self.obs.lock:
+                self.exposureend = start + self.obs.Scaled(duration)
+            timer = threading.Timer(self.obs.Scaled(duration),
+                                    self.FinishExposure, args=(details,))
+            timer.daemon = True
+            timer.start()
+            return 0
+        self.obs.Sleep(duration)
+        self.FinishExposure(details)
+        return 0
+
+    # Size of the image read out, allowing for binning and any subframe
+    def ReadoutSize(self, bin):
+        if jstruth(self.js_Subframe):
+            width = int(jsnum(self.js_SubframeRight)) - \
+                int(jsnum(self.js_SubframeLeft))
+            height = int(jsnum(self.js_SubframeBottom)) - \
+                int(jsnum(self.js_SubframeTop))
+            return max(1, width // bin), max(1, height // bin)
+        return self.obs.args.width // bin, self.obs.args.height // bin
+
+    # Offset of the image from the centre of the sensor, in binned pixels
+    def SubframeOrigin(self, bin):
+        if jstruth(self.js_Subframe):
+            cx = (jsnum(self.js_SubframeLeft) + jsnum(self.js_SubframeRight)) / 2
+            cy = (jsnum(self.js_SubframeTop) + jsnum(self.js_SubframeBottom)) / 2
+            return ((cx - self.obs.args.width / 2.0) / bin,
+                    (cy - self.obs.args.height / 2.0) / bin)
+        return (0.0, 0.0)
+
+    def FinishExposure(self, details):
+        with self.obs.lock:
+            if self.aborted:
+                self.exposureend = None
+                return
+            n = len(self.obs.images) + 1
+            path = os.path.join(self.obs.imagedir,
+                                "PA_%dx%d_%.3fsecs_%08d.fit" %
+                                (details["bin"], details["bin"],
+                                 details["exp"], n))
+            self.obs.images[path] = details
+            rnd = random.Random(n)
+        self.WriteImage(path, details, rnd)
+        with self.obs.lock:
+            self.js_LastImageFileName = path
+            self.exposureend = None
+
+    def WriteImage(self, path, details, rnd):
+        args = self.obs.args
+        bin = details["bin"]
+        scale = args.pixel_scale * bin
+        width, height = details["width"], details["height"]
+        # Offset the field for a subframe away from the sensor centre
+        sx, sy = details["subframe"]
+        stars = ProjectStars(details["ra"], details["dec"], details["pa"],
+                             scale, args.width // bin, args.height // bin,
+                             args.star_density)
+        x0 = (args.width // bin - width) / 2.0 + sx
+        y0 = (args.height // bin - height) / 2.0 + sy
+        # Stars get brighter with longer exposures
+        gain = details["exp"] / args.reference_exposure
+        stars = [(x - x0, y - y0, f * gain) for x, y, f in stars
+                 if 0 <= x - x0 < width and 0 <= y - y0 < height]
+        details["stars"] = stars
+        # Binning lets fainter stars be found
+        details["found"] = [star for star in stars
+                            if star[2] * bin >= args.detect_flux]
+        header = [("EXPTIME", details["exp"], "Exposure time in seconds"),
+                  ("XBINNING", bin, ""), ("YBINNING", bin, ""),
+                  ("DATE-OBS", time.strftime("%Y-%m-%dT%H:%M:%S",
+                                             time.gmtime(details["start"])),
+                   "UTC start of exposure"),
+                  ("TELEHA", HMSString(details["ha"]), "Telescope hour angle"),
+                  ("LST", HMSString(details["lst"]), "Local sidereal time"),
+                  ("SITELAT", self.obs.lat, ""),
+                  ("SITELONG", self.obs.lon, "")]
+        WriteFITS(path, width, height, stars, header, rnd)
+
+class CameraImage(HostObject):
+    def __init__(self, obs, camera):
+        self.obs = obs
+        self.camera = camera
+        self.js_Path = ""
+        self.header = None
+
+    def jsm_AttachToActiveImager(self):
+        if not self.camera.js_LastImageFileName:
+            raise jserror("Error", "No active image. Error = 1003.")
+        self.js_Path = self.camera.js_LastImageFileName
+        self.header = None
+        return 0
+
+    def jsm_Open(self):
+        self.header = None
+        self.Header()
+        return 0
+
+    def jsm_Close(self):
+        self.header = None
+        return 0
+
+    def Header(self):
+        if self.header is None:
+            try:
+                self.header = ReadFITSHeader(self.js_Path)[0]
+            except (OSError, ValueError):
+                raise jserror("Error", "File not found: " + self.js_Path + \
+                              ". Error = 202.")
+        return self.header
+
+    # Finds the stars in the image and writes them to its .SRC file
+    def jsm_ShowInventory(self):
+        self.Header()
+        details = self.obs.images.get(self.js_Path)
+        if details is None:
+            raise jserror("Error", "Not a TSX image. Error = 202.")
+        self.obs.Sleep(self.obs.args.inventory_time)
+        with self.obs.lock:
+            rnd = random.Random(self.obs.random.random())
+        WriteSRC(self.js_Path, details.get("found", []), rnd)
+        return 0
+
+    def jsm_FITSKeyword(self, key):
+        header = self.Header()
+        if key not in header:
+            raise jserror("Error", "Keyword not found. Error = 250.")
+        return header[key]
+
+class ImageLinkObject(HostObject):
+    def __init__(self, obs, results):
+        self.obs = obs
+        self.results = results
+        self.js_pathToFITS = ""
+        self.js_scale = 1.0
+        self.js_unknownScale = 1
+
+    def jsm_execute(self):
+        args = self.obs.args
+        self.obs.Sleep(args.solve_time)
+        self.results.js_errorCode = 651
+        self.results.js_succeeded = 0
+        details = self.obs.images.get(self.js_pathToFITS)
+        if details is None or not os.path.exists(self.js_pathToFITS):
+            raise jserror("Error", "File not found. Error = 202.")
+        with self.obs.lock:
+            rnd = random.Random(self.obs.random.random())
+        WriteSRC(self.js_pathToFITS, details.get("found", []), rnd)
+        # Scale must be close to the real one to solve
+        scale = args.pixel_scale * details["bin"]
+        if not jstruth(self.js_unknownScale) and \
+           abs(jsnum(self.js_scale) / scale - 1.0) > 0.1:
+            raise jserror("Error", "Image link failed, no match found. " + \
+                          "Error = 651.")
+        with self.obs.lock:
+            fail = self.obs.random.random() < args.solve_failure
+            noise = [self.obs.random.gauss(0, args.solve_noise / 3600.0)
+                     for i in range(2)]
+        if fail or len(details.get("found", [])) < args.min_stars:
+            raise jserror("Error", "Image link failed, no match found. " + \
+                          "Error = 651.")
+        # Centre of the image, allowing for a subframe
+        sx, sy = details["subframe"]
+        centre = RADecToVec(details["ra"], details["dec"])
+        north = Normalise(Sub([0.0, 0.0, 1.0], Scale(centre, centre[2])))
+        east = Cross(north, centre)
+        up = Add(Scale(north, cosd(details["pa"])),
+                 Scale(east, sind(details["pa"])))
+        right = Cross(up, centre)
+        off = scale / 3600.0 * math.pi / 180.0
+        v = Normalise(Add(centre, Add(Scale(right, sx * off),
+                                      Scale(up, -sy * off))))
+        ra, dec = VecToRADec(v)
+        dec += noise[1]
+        ra += noise[0] / 15.0 / max(0.01, cosd(dec))
+        ra2000, dec2000 = PrecessNowTo2000(ra, dec, details["start"])
+        r = self.results
+        r.js_errorCode = 0
+        r.js_succeeded = 1
+        r.js_imageCenterRAJ2000 = ra2000
+        r.js_imageCenterDecJ2000 = dec2000
+        r.js_imageScale = scale
+        r.js_imagePositionAngle = details["pa"]
+        r.js_imageIsMirrored = 0
+        r.js_imageWidthInPixels = details["width"]
+        r.js_imageHeightInPixels = details["height"]
+        r.js_imageStarCount = len(details.get("found", []))
+        r.js_imageFilePath = self.js_pathToFITS
+        return undefined
+
+class ImageLinkResultsObject(HostObject):
+    def __init__(self):
+        self.js_errorCode = 0
+        self.js_succeeded = 0
+        self.js_imageCenterRAJ2000 = 0.0
+        self.js_imageCenterDecJ2000 = 0.0
+        self.js_imageScale = 0.0
+        self.js_imagePositionAngle = 0.0
+        self.js_imageIsMirrored = 0
+        self.js_imageWidthInPixels = 0
+        self.js_imageHeightInPixels = 0
+        self.js_imageStarCount = 0
+        self.js_imageFilePath = ""
+
+class Utils(HostObject):
+    def __init__(self, obs):
+        self.obs = obs
+        self.js_dOut0 = 0.0
+        self.js_dOut1 = 0.0
+        self.js_dOut2 = 0.0
+
+    def jsm_ComputeLocalSiderealTime(self):
+        self.js_dOut0 = self.obs.LST()
+        return undefined
+
+    def jsm_ComputeUniversalTime(self):
+        t = time.time()
+        self.js_dOut0 = (t / 3600.0) % 24.0
+        return undefined
+
+    def jsm_ComputeHourAngle(self, ra):
+        self.js_dOut0 = (self.obs.LST() - jsnum(ra) + 12.0) % 24.0 - 12.0
+        return undefined
+
+    def jsm_ConvertRADecToAzAlt(self, ra, dec):
+        ha = self.obs.LST() - jsnum(ra)
+        alt, az = AltAzfromHADEC(ha, jsnum(dec), self.obs.lat)
+        self.js_dOut0 = az % 360.0
+        self.js_dOut1 = alt
+        return undefined
+
+    def jsm_ConvertAzAltToRADec(self, az, alt):
+        ha, dec = HADECfromAltAz(jsnum(alt), jsnum(az), self.obs.lat)
+        self.js_dOut0 = (self.obs.LST() - ha) % 24.0
+        self.js_dOut1 = dec
+        return undefined
+
+    def jsm_Precess2000ToNow(self, ra, dec):
+        self.js_dOut0, self.js_dOut1 = Precess2000ToNow(jsnum(ra), jsnum(dec))
+        return undefined
+
+    def jsm_PrecessNowTo2000(self, ra, dec):
+        self.js_dOut0, self.js_dOut1 = PrecessNowTo2000(jsnum(ra), jsnum(dec))
+        return undefined
+
+class StarChart(HostObject):
+    def __init__(self, obs):
+        self.obs = obs
+        self.js_DocPropOut = 0.0
+
+    def jsm_DocumentProperty(self, prop):
+        prop = int(jsnum(prop))
+        if prop == 0:
+            self.js_DocPropOut = self.obs.lat
+        elif prop == 1:
+            self.js_DocPropOut = self.obs.lon
+        elif prop == 9:
+            self.js_DocPropOut = JulianDate(time.time())
+        else:
+            self.js_DocPropOut = 0.0
+        return undefined
+
+######################### SERVER #######################################
+
+class Simulator:
+    def __init__(self, args):
+        self.args = args
+        self.obs = Observatory(args)
+        camera = Camera(self.obs)
+        results = ImageLinkResultsObject()
+        self.host = {
+            "sky6RASCOMTele": Telescope(self.obs),
+            "ccdsoftCamera": camera,
+            "ccdsoftCameraImage": CameraImage(self.obs, camera),
+            "ImageLink": ImageLinkObject(self.obs, results),
+            "ImageLinkResults": results,
+            "sky6Utils": Utils(self.obs),
+            "sky6StarChart": StarChart(self.obs),
+        }
+        # TSX runs one script at a time
+        self.scriptlock = threading.Lock()
+        self.commands = 0
+        self.commandtime = 0.0
+
+    # Runs a script and returns the reply as TSX would
+    def Run(self, src):
+        with self.scriptlock:
+            start = time.monotonic()
+            self.obs.Sleep(self.args.latency)
+            try:
+                value = Interpreter(self.host).run(src)
+                reply = jsstr(value) + "|No error. Error = 0."
+            except JSThrow as e:
+                text = jsstr(e.value)
+                code = re.search(r"Error = (-?\d+)", text)
+                reply = text + "|" + text.split(". Error")[0] + \
+                    ". Error = " + (code.group(1) if code else "1") + "."
+            except JSSyntaxError as e:
+                reply = "SyntaxError: " + str(e) + \
+                    "|Syntax error. Error = 1."
+            self.commands += 1
+            self.commandtime += time.monotonic() - start
+        if self.args.verbose:
+            print(src.strip()[:200].replace("\n", " "), "->", reply[:200])
+        return reply
+
+    def Summary(self):
+        times = self.obs.exposuretimes
+        print("Scripts run:", self.commands, "taking %.2f s" % self.commandtime)
+        print("Exposures:", len(times))
+        if len(times) > 3:
+            # Ignore the two reference images and the slews
+            cycles = [b - a for a, b in zip(times[2:], times[3:])]
+            cycles.sort()
+            print("Cycle time (s): mean %.2f median %.2f min %.2f max %.2f" %
+                  (sum(cycles) / len(cycles), cycles[len(cycles) // 2],
+                   cycles[0], cycles[-1]))
+
+class Handler(socketserver.BaseRequestHandler):
+    # Reads until a complete script has arrived, runs it and replies.
+    # The connection is kept open for more scripts.
+    def handle(self):
+        sim = self.server.sim
+        buffer = b""
+        while True:
+            try:
+                chunk = self.request.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk
+            src = buffer.decode(errors="replace")
+            try:
+                Parser(src).program()
+            except JSIncomplete:
+                continue
+            except JSSyntaxError:
+                pass
+            buffer = b""
+            reply = sim.Run(src)
+            try:
+                self.request.sendall(reply.encode())
+            except OSError:
+                return
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Simulates the TheSkyX "
+                                     "TCP server for testing PAUI.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3040)
+    parser.add_argument("--lat", type=float, default=51.37,
+                        help="site latitude, degrees")
+    parser.add_argument("--lon", type=float, default=0.45,
+                        help="site longitude, degrees west positive")
+    parser.add_argument("--alt-error", type=float, default=30.0,
+                        help="polar axis altitude error, arcmin")
+    parser.add_argument("--az-error", type=float, default=-20.0,
+                        help="polar axis azimuth error, arcmin")
+    parser.add_argument("--adjust-rate", type=float, default=0.0,
+                        help="arcmin/sec the user corrects the misalignment "
+                        "after the reference images")
+    parser.add_argument("--slew-rate", type=float, default=4.0,
+                        help="mount slew rate, degrees/sec")
+    parser.add_argument("--settle-time", type=float, default=2.0,
+                        help="seconds for the mount to settle after a slew")
+    parser.add_argument("--download-time", type=float, default=2.0,
+                        help="seconds to download an unbinned full frame")
+    parser.add_argument("--solve-time", type=float, default=2.0,
+                        help="seconds for a plate solve")
+    parser.add_argument("--inventory-time", type=float, default=0.3,
+                        help="seconds to find the stars in an image")
+    parser.add_argument("--solve-failure", type=float, default=0.0,
+                        help="chance (0-1) that a plate solve fails")
+    parser.add_argument("--solve-noise", type=float, default=1.0,
+                        help="plate solve error, arcsec rms")
+    parser.add_argument("--min-stars", type=int, default=8,
+                        help="stars needed in an image to plate solve")
+    parser.add_argument("--star-density", type=float, default=300.0,
+                        help="stars per square degree")
+    parser.add_argument("--reference-exposure", type=float, default=4.0,
+                        help="exposure (seconds) in which the stars have "
+                        "200 to 20000 counts")
+    parser.add_argument("--detect-flux", type=float, default=2000.0,
+                        help="counts a star needs to be found in an "
+                        "unbinned image; binning by n finds stars n times "
+                        "fainter")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="seconds TSX takes to run any script")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="multiplies all the delays, e.g. 0 to run as "
+                        "fast as possible")
+    parser.add_argument("--width", type=int, default=1600,
+                        help="sensor width, unbinned pixels")
+    parser.add_argument("--height", type=int, default=1200,
+                        help="sensor height, unbinned pixels")
+    parser.add_argument("--pixel-scale", type=float, default=1.718,
+                        help="unbinned arcsec/pixel")
+    parser.add_argument("--filters", default="Lum,Red,Green,Blue",
+                        help="comma separated filter names, blank for no "
+                        "filter wheel")
+    parser.add_argument("--parked", action="store_true",
+                        help="start with the mount parked")
+    parser.add_argument("--image-dir", default=None,
+                        help="where to save images (default a new "
+                        "temporary directory)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed for plate solve failures and noise")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print every script and reply")
+    return parser.parse_args(argv)
+
+# Starts a simulator in a background thread and returns the server - used
+# when testing from python. Stop with server.shutdown().
+def StartSimulator(argv=None):
+    args = ParseArgs(argv)
+    server = Server((args.host, args.port), Handler)
+    server.sim = Simulator(args)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def main():
+    args = ParseArgs()
+    server = Server((args.host, args.port), Handler)
+    server.sim = Simulator(args)
+    print("Simulating TSX on %s:%d, images in %s" %
+          (args.host, args.port, server.sim.obs.imagedir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.sim.Summary()
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,11 @@ function installUI()
 	sudo mkdir -p /usr/local/bin/
 	sudo cp -f PAUI.py /usr/local/bin/
 	sudo chmod oug+x /usr/local/bin/PAUI.py
+	sudo cp -f PAEngine.py /usr/local/bin/
+	sudo chmod oug+x /usr/local/bin/PAEngine.py
+	sudo cp -f PASite.py /usr/local/bin/
+	sudo chmod oug+x /usr/local/bin/PASite.py
+	sudo cp -f Astrometry.py /usr/local/bin/
 	sudo mkdir -p /usr/share/pixmaps/
 	sudo cp -f PAIcon.png /usr/share/pixmaps
 	cp -f PA.desktop ~/Desktop